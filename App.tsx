@@ -132,9 +132,23 @@ const getClosestAspectRatio = (width: number, height: number): AspectRatio => {
   ).name;
 };
 
+// Decode a data: URL back into the bytes the user picked
+const dataUrlToBlob = (dataUrl: string): Blob => {
+  const arr = dataUrl.split(',');
+  const mime = arr[0].match(/:(.*?);/)?.[1] || 'image/jpeg';
+  const bstr = atob(arr[1]);
+  const u8arr = new Uint8Array(bstr.length);
+  for (let i = 0; i < bstr.length; i++) {
+    u8arr[i] = bstr.charCodeAt(i);
+  }
+  return new Blob([u8arr], { type: mime });
+};
+
 const App = () => {
   const [originalImage, setOriginalImage] = useState<string | null>(null);
+  const [uploadId, setUploadId] = useState<string | null>(null);
   const [generatedImage, setGeneratedImage] = useState<string | null>(null);
+  const [generatedArtifactId, setGeneratedArtifactId] = useState<string | null>(null);
   const [loading, setLoading] = useState<LoadingState>(LoadingState.IDLE);
   const [error, setError] = useState<string | null>(null);
   const [activeStyle, setActiveStyle] = useState<StyleType>('MODERN');
@@ -207,6 +221,21 @@ const App = () => {
     ));
   };
 
+  // The backend measures the palette each staged room actually rendered
+  const updateHouseDesignDNA = (id: string, measured: Partial<HouseProfile['designDNA']>) => {
+    setHouseProfiles(prev => prev.map(h =>
+      h.id === id ? {
+        ...h,
+        designDNA: {
+          ...h.designDNA,
+          ...(measured.primaryColors && { primaryColors: measured.primaryColors }),
+          ...(measured.accentColors && { accentColors: measured.accentColors }),
+          ...(measured.woodTone && { woodTone: measured.woodTone }),
+        },
+      } : h
+    ));
+  };
+
   const handleUpload = (file: File) => {
     const reader = new FileReader();
     reader.onload = (e) => {
@@ -217,7 +246,9 @@ const App = () => {
         const detectedRatio = getClosestAspectRatio(img.width, img.height);
         setAspectRatio(detectedRatio);
         setOriginalImage(base64);
+        setUploadId(null);
         setGeneratedImage(null);
+        setGeneratedArtifactId(null);
         setError(null);
         setSceneAnalysis(null);
         setLoading(LoadingState.IDLE);
@@ -233,26 +264,36 @@ const App = () => {
     setLoading(LoadingState.PROCESSING);
     setError(null);
     setGeneratedImage(null);
+    setGeneratedArtifactId(null);
     setSceneAnalysis(null);
 
-    try {
-      const formData = new FormData();
-      const arr = originalImage.split(',');
-      const mime = arr[0].match(/:(.*?);/)?.[1] || 'image/jpeg';
-      const bstr = atob(arr[1]);
-      const u8arr = new Uint8Array(bstr.length);
-      for (let i = 0; i < bstr.length; i++) {
-        u8arr[i] = bstr.charCodeAt(i);
-      }
+    const apiUrl = import.meta.env.VITE_API_URL || 'http://localhost:8000';
+
+    // Send the photo once; every restyle after that only sends its upload_id
+    const ensureUpload = async (force = false): Promise<string> => {
+      if (uploadId && !force) return uploadId;
+      const uploadData = new FormData();
+      uploadData.append('image', dataUrlToBlob(originalImage), 'room.jpg');
+      const response = await fetch(`${apiUrl}/uploads`, {
+        method: 'POST',
+        body: uploadData,
+      });
+      const data = await response.json();
+      if (!response.ok) throw new Error(data.error || 'Upload failed');
+      setUploadId(data.upload_id);
+      return data.upload_id;
+    };
 
-      const blob = new Blob([u8arr], { type: mime });
-      formData.append('image', blob, 'room.jpg');
+    const requestGeneration = (id: string) => {
+      const formData = new FormData();
+      formData.append('upload_id', id);
       formData.append('room_type', activeRoomType);
       formData.append('style', activeStyle);
       formData.append('aspect_ratio', aspectRatio);
 
       if (activeHouse) {
         formData.append('house_continuity', JSON.stringify({
+          id: activeHouse.id,
           name: activeHouse.name,
           designDNA: activeHouse.designDNA,
           roomsStaged: activeHouse.roomsStaged,
@@ -262,16 +303,28 @@ const App = () => {
       // Always enable analysis
       formData.append('enable_analysis', 'true');
 
-      const apiUrl = import.meta.env.VITE_API_URL || 'http://localhost:8000';
-      const response = await fetch(`${apiUrl}/generate-image`, {
+      return fetch(`${apiUrl}/generate-image`, {
         method: 'POST',
         body: formData,
       });
+    };
+
+    try {
+      let response = await requestGeneration(await ensureUpload());
+      if (response.status === 404) {
+        // Only an expired upload is safe to retry: nothing was generated
+        const body = await response.clone().json().catch(() => ({}));
+        if (body.code === 'upload_expired') {
+          response = await requestGeneration(await ensureUpload(true));
+        }
+      }
 
       const data = await response.json();
       if (!response.ok) throw new Error(data.error || 'Request failed');
 
-      setGeneratedImage(data.image);
+      // Generated images are served from the backend's artifact store
+      setGeneratedImage(new URL(data.image_url, apiUrl).toString());
+      setGeneratedArtifactId(data.artifact.id);
       setLoading(LoadingState.COMPLETE);
 
       if (data.scene_analysis) {
@@ -281,6 +334,9 @@ const App = () => {
 
       if (activeHouseId) {
         updateHouseRoomCount(activeHouseId);
+        if (data.house_design_dna) {
+          updateHouseDesignDNA(activeHouseId, data.house_design_dna);
+        }
       }
     } catch (err: any) {
       console.error('Generation error:', err);
@@ -290,60 +346,33 @@ const App = () => {
   };
 
   const handleDownload = (format: 'png' | 'jpg', resolution: 'original' | '4k') => {
-    if (!generatedImage) return;
-
-    const img = new window.Image();
-    img.onload = () => {
-      let targetWidth = img.width;
-      let targetHeight = img.height;
-
-      if (resolution === '4k') {
-        const ratio = img.width / img.height;
-        if (ratio >= 1) {
-          targetWidth = 3840;
-          targetHeight = Math.round(3840 / ratio);
-        } else {
-          targetHeight = 3840;
-          targetWidth = Math.round(3840 * ratio);
-        }
-      }
-
-      const canvas = document.createElement('canvas');
-      canvas.width = targetWidth;
-      canvas.height = targetHeight;
-      const ctx = canvas.getContext('2d');
-
-      if (ctx) {
-        ctx.imageSmoothingEnabled = true;
-        ctx.imageSmoothingQuality = 'high';
-
-        if (format === 'jpg') {
-          ctx.fillStyle = '#FFFFFF';
-          ctx.fillRect(0, 0, canvas.width, canvas.height);
-        }
-
-        ctx.drawImage(img, 0, 0, targetWidth, targetHeight);
-
-        const mimeType = format === 'png' ? 'image/png' : 'image/jpeg';
-        const quality = format === 'png' ? undefined : 0.95;
-        const dataUrl = canvas.toDataURL(mimeType, quality);
-
-        const resLabel = resolution === '4k' ? '_4K' : '';
-        const link = document.createElement('a');
-        link.href = dataUrl;
-        link.download = `staged_${activeRoomType.toLowerCase()}_${activeStyle.toLowerCase()}${resLabel}.${format}`;
-        document.body.appendChild(link);
-        link.click();
-        document.body.removeChild(link);
-      }
-    };
-    img.src = generatedImage;
+    if (!generatedArtifactId) return;
+
+    // The backend renders (and caches) the 4K / re-encoded derivative
+    const apiUrl = import.meta.env.VITE_API_URL || 'http://localhost:8000';
+    const resLabel = resolution === '4k' ? '_4K' : '';
+    const filename = `staged_${activeRoomType.toLowerCase()}_${activeStyle.toLowerCase()}${resLabel}.${format}`;
+    const params = new URLSearchParams({
+      format: format === 'png' ? 'png' : 'jpeg',
+      size: resolution,
+      quality: '95',
+      filename,
+    });
+
+    const link = document.createElement('a');
+    link.href = `${apiUrl}/artifacts/${generatedArtifactId}/export?${params}`;
+    link.download = filename;
+    document.body.appendChild(link);
+    link.click();
+    document.body.removeChild(link);
     setShowExportMenu(false);
   };
 
   const handleReset = () => {
     setOriginalImage(null);
+    setUploadId(null);
     setGeneratedImage(null);
+    setGeneratedArtifactId(null);
     setError(null);
     setSceneAnalysis(null);
     setLoading(LoadingState.IDLE);
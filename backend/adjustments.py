@@ -0,0 +1,227 @@
+"""Local stylistic adjustments (the frontend's StylisticSettings) for stored images.
+
+Brightness, warmth, grain, sharpness and texture are applied with NumPy
+instead of another Pro Image call, in a single pass over bands of rows:
+sharpness and texture add back the difference from a fine and a coarse
+Gaussian blur (unsharp masking and local contrast), brightness and warmth
+are folded into a single per-channel lookup table, and grain is a fixed
+noise field scaled by the slider. The blurs and the noise depend only on
+the image, so they are computed once per source and every slider tweak
+after that is a few array operations.
+
+Previews are rendered from a copy downscaled to PREVIEW_EDGE that stays in
+memory for the last few artifacts; blur radii scale with the image, so a
+preview looks like the full-resolution render. Full-resolution results are
+stored as artifact variants named after the settings, like exports; the
+caller trims them to the few most recently used per image.
+
+Minimalism changes what is in the room, which needs a new generation.
+"""
+import functools
+import io
+import threading
+from collections import OrderedDict
+from typing import NamedTuple
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+ADJUSTMENTS = ("brightness", "warmth", "grain", "sharpness", "texture")
+# Slider ranges; 0 leaves the image unchanged
+RANGES = {"brightness": (-100, 100), "warmth": (-100, 100), "grain": (0, 100),
+          "sharpness": (-100, 100), "texture": (-100, 100)}
+
+# Blur radii at this long edge, scaled for other sizes
+REFERENCE_EDGE = 1024
+FINE_RADIUS = 1.5
+COARSE_RADIUS = 12.0
+# Grain standard deviation, in 8-bit levels, at grain=100
+GRAIN_SIGMA = 18.0
+PREVIEW_QUALITY = 85
+# Rows adjusted per pass
+BAND_ROWS = 128
+VARIANT_PREFIX = "adjust-"
+
+_CHANNEL_OFFSETS = np.array([0, 256, 512], dtype=np.uint16)
+
+
+class AdjustmentError(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+class StylisticSettings(NamedTuple):
+    brightness: int = 0
+    warmth: int = 0
+    grain: int = 0
+    sharpness: int = 0
+    texture: int = 0
+
+
+def parse_settings(args):
+    """StylisticSettings from query arguments; raises AdjustmentError"""
+    minimalism = args.get("minimalism")
+    if minimalism not in (None, "", "0"):
+        raise AdjustmentError("minimalism changes the furnishings and needs a new generation (POST /generate-image)", 422)
+
+    values = {}
+    for name in ADJUSTMENTS:
+        raw = args.get(name)
+        try:
+            value = int(raw) if raw not in (None, "") else 0
+        except ValueError:
+            raise AdjustmentError(f"{name} must be an integer")
+        low, high = RANGES[name]
+        if not low <= value <= high:
+            raise AdjustmentError(f"{name} must be between {low} and {high}")
+        values[name] = value
+    return StylisticSettings(**values)
+
+
+def variant_name(settings):
+    return VARIANT_PREFIX + "-".join(f"{name[0]}{value}" for name, value in zip(ADJUSTMENTS, settings))
+
+
+@functools.lru_cache(maxsize=256)
+def tone_lut(brightness, warmth):
+    """768-entry float32 table (R, G, B) applying brightness as a gamma curve
+    and warmth as opposing red and blue gains
+    """
+    x = np.arange(256, dtype=np.float32) / 255
+    curve = x ** (2.0 ** (-brightness / 100))
+    w = warmth / 100
+    gains = (1 + 0.12 * w, 1 + 0.03 * w, 1 - 0.12 * w)
+    return np.concatenate([np.clip(curve * gain * 255, 0, 255) for gain in gains]).astype(np.float32)
+
+
+class AdjustmentSource:
+    """An RGB image plus the blurs and grain field the adjustments mix in, made on first use"""
+
+    def __init__(self, img):
+        self.image = img.convert("RGB")
+        self.pixels = np.asarray(self.image)
+        self._layers = {}
+        self._lock = threading.Lock()
+
+    def _layer(self, key, make):
+        with self._lock:
+            layer = self._layers.get(key)
+            if layer is None:
+                layer = self._layers[key] = make()
+            return layer
+
+    def blurred(self, radius):
+        scaled = radius * max(self.image.size) / REFERENCE_EDGE
+        return self._layer(("blur", radius), lambda: np.asarray(self.image.filter(ImageFilter.GaussianBlur(scaled))))
+
+    def grain(self):
+        # Fixed seed: the same settings always render the same bytes
+        shape = self.pixels.shape[:2]
+        return self._layer("grain", lambda: np.random.default_rng(0).standard_normal(shape, dtype=np.float32))
+
+
+def adjust(source, settings):
+    """The source's pixels with `settings` applied, as an HxWx3 uint8 array"""
+    pixels = source.pixels
+    if not any(settings):
+        return pixels
+
+    # Negative values blend toward the blur; -100 is the blur itself
+    details = [(source.blurred(radius), value / 100 * (boost if value > 0 else 1.0))
+               for value, radius, boost in ((settings.sharpness, FINE_RADIUS, 1.5), (settings.texture, COARSE_RADIUS, 1.0))
+               if value]
+    lut = tone_lut(settings.brightness, settings.warmth)
+    grain = source.grain() if settings.grain else None
+    grain_scale = settings.grain / 100 * GRAIN_SIGMA
+
+    # Detail, tone and grain are applied together a band of rows at a time,
+    # so the float32 intermediates stay small and in cache
+    out = np.empty_like(pixels)
+    for top in range(0, pixels.shape[0], BAND_ROWS):
+        rows = slice(top, top + BAND_ROWS)
+        if details:
+            work = pixels[rows].astype(np.float32)
+            for blurred, amount in details:
+                detail = np.subtract(pixels[rows], blurred[rows], dtype=np.float32)
+                detail *= amount
+                work += detail
+            work += 0.5
+            np.clip(work, 0, 255, out=work)
+            index = work.astype(np.uint16)
+        else:
+            index = pixels[rows].astype(np.uint16)
+        index += _CHANNEL_OFFSETS
+        band = lut[index]
+
+        if grain is not None:
+            band += grain_scale * grain[rows][..., None]
+        band += 0.5
+        np.clip(band, 0, 255, out=band)
+        out[rows] = band
+    return out
+
+
+def render_adjusted(data, settings):
+    """(bytes, MIME type) of a full-resolution image with `settings` applied;
+    JPEG sources stay JPEG, anything else becomes PNG
+    """
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    alpha = img.getchannel("A") if "A" in img.getbands() else None
+
+    out = Image.fromarray(adjust(AdjustmentSource(img), settings))
+    buf = io.BytesIO()
+    if img.format == "JPEG":
+        out.save(buf, "JPEG", quality=95, subsampling=0)
+        return buf.getvalue(), "image/jpeg"
+    if alpha is not None:
+        out.putalpha(alpha)
+    out.save(buf, "PNG", compress_level=6)
+    return buf.getvalue(), "image/png"
+
+
+def render_preview(source, settings):
+    buf = io.BytesIO()
+    Image.fromarray(adjust(source, settings)).save(buf, "JPEG", quality=PREVIEW_QUALITY)
+    return buf.getvalue()
+
+
+class PreviewSources:
+    """Downscaled AdjustmentSources for the most recently adjusted artifacts (per worker)"""
+
+    def __init__(self, edge=1024, max_entries=8):
+        self.edge = edge
+        self.max_entries = max_entries
+        self._sources = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0}
+
+    def get(self, artifact_id, read):
+        """The preview source for an artifact, decoded from read(artifact_id) on a miss; None if unknown"""
+        with self._lock:
+            source = self._sources.get(artifact_id)
+            if source is not None:
+                self._sources.move_to_end(artifact_id)
+                self._counters["hits"] += 1
+                return source
+            self._counters["misses"] += 1
+
+        data = read(artifact_id)
+        if data is None:
+            return None
+        img = Image.open(io.BytesIO(data))
+        img.draft("RGB", (self.edge, self.edge))
+        img.thumbnail((self.edge, self.edge), Image.LANCZOS, reducing_gap=2.0)
+        source = AdjustmentSource(img)
+
+        with self._lock:
+            self._sources[artifact_id] = source
+            while len(self._sources) > self.max_entries:
+                self._sources.popitem(last=False)
+        return source
+
+    def stats(self):
+        with self._lock:
+            return {**self._counters, "entries": len(self._sources)}
@@ -0,0 +1,188 @@
+"""Content-addressed cache for Gemini scene analyses.
+
+Two tiers: a bounded in-process LRU and an on-disk directory that every
+gunicorn worker on the host shares. Entries expire after a TTL and the disk
+tier is trimmed oldest-first once it grows past its byte budget.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+def image_digest(image_bytes):
+    """SHA-256 of the raw image bytes, used as the content address."""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def cache_key(digest, model, prompt_version):
+    return hashlib.sha256(f"{model}\0{prompt_version}\0{digest}".encode("utf-8")).hexdigest()
+
+
+class AnalysisCache:
+    # Disk trimming walks the whole directory, so don't do it on every write
+    TRIM_INTERVAL_SECONDS = 60
+
+    def __init__(self, directory, max_entries=256, ttl_seconds=7 * 24 * 3600,
+                 max_disk_bytes=256 * 1024 * 1024, enabled=True):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_bytes = max_disk_bytes
+        self.enabled = enabled
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_trim = 0.0
+        self._counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "writes": 0,
+            "memory_evictions": 0,
+            "disk_evictions": 0,
+        }
+
+    # ---------- public API ----------
+
+    def get(self, key):
+        return self.get_first([key])[1]
+
+    def get_first(self, keys):
+        """(key, value) for the first of `keys` with a live entry, else (None, None).
+        Counts as one lookup, however many keys it tries.
+        """
+        if not self.enabled:
+            return None, None
+
+        now = time.time()
+        for key in keys:
+            value, tier = self._lookup(key, now)
+            if value is not None:
+                with self._lock:
+                    self._counters[f"{tier}_hits"] += 1
+                return key, value
+        with self._lock:
+            self._counters["misses"] += 1
+        return None, None
+
+    def set(self, key, value):
+        if not self.enabled or value is None:
+            return
+
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now + self.ttl_seconds)
+            self._counters["writes"] += 1
+
+        self._write_disk(key, value)
+        if now - self._last_trim > self.TRIM_INTERVAL_SECONDS:
+            self._last_trim = now
+            self.trim()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters)
+            stats["memory_entries"] = len(self._memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 4) if lookups else 0.0
+        stats["enabled"] = self.enabled
+        return stats
+
+    def trim(self):
+        """Drop expired disk entries, then the oldest ones until under the byte budget."""
+        now = time.time()
+        entries = []
+        total = 0
+        for path in self._disk_paths():
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if st.st_mtime + self.ttl_seconds <= now:
+                self._unlink(path)
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_disk_bytes:
+                break
+            self._unlink(path)
+            total -= size
+
+    # ---------- internals ----------
+
+    def _lookup(self, key, now):
+        """(value, "memory" or "disk"), or (None, None); not counted"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    return value, "memory"
+                del self._memory[key]
+
+        value = self._read_disk(key, now)
+        if value is None:
+            return None, None
+        with self._lock:
+            self._remember(key, value, now + self.ttl_seconds)
+        return value, "disk"
+
+    def _remember(self, key, value, expires_at):
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self._counters["memory_evictions"] += 1
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _disk_paths(self):
+        if not os.path.isdir(self.directory):
+            return
+        for shard in os.listdir(self.directory):
+            shard_dir = os.path.join(self.directory, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for name in os.listdir(shard_dir):
+                if name.endswith(".json"):
+                    yield os.path.join(shard_dir, name)
+
+    def _read_disk(self, key, now):
+        path = self._path(key)
+        try:
+            if os.path.getmtime(path) + self.ttl_seconds <= now:
+                self._unlink(path)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+    def _write_disk(self, key, value):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename so other workers never see a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(value, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+    def _unlink(self, path):
+        try:
+            os.remove(path)
+            with self._lock:
+                self._counters["disk_evictions"] += 1
+        except OSError:
+            pass
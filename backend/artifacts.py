@@ -0,0 +1,235 @@
+"""Content-addressed store for generated images.
+
+Artifacts are written once under their SHA-256 and never change, which is
+what lets GET /artifacts/<id> hand out strong ETags and immutable
+Cache-Control headers. The default backend is a local directory; a sidecar
+JSON file next to each blob holds its MIME type and metadata, and a
+`.variants` directory maps named derivatives (exports) to their own ids.
+
+Like the upload store, reading an artifact refreshes its mtime, and the TTL
+plus an oldest-first byte-budget trim evict the least recently used ones.
+An evicted artifact takes its derivatives with it; a derivative evicted on
+its own is simply rendered again the next time it's asked for.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+ARTIFACT_ID = re.compile(r"^[0-9a-f]{64}$")
+
+
+class ArtifactStore:
+    # Trimming walks the whole directory, so don't do it on every write
+    TRIM_INTERVAL_SECONDS = 60
+
+    def __init__(self, directory, ttl_seconds=7 * 24 * 3600, max_disk_bytes=10 * 1024 * 1024 * 1024):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_bytes = max_disk_bytes
+
+        self._lock = threading.Lock()
+        self._last_trim = 0.0
+        self._counters = {"stored": 0, "reused": 0, "expired": 0, "evictions": 0}
+
+    def put(self, data, mime_type, **metadata):
+        """Store bytes (idempotently) and return the artifact id."""
+        artifact_id = hashlib.sha256(data).hexdigest()
+        blob_path = self._blob_path(artifact_id)
+        if not os.path.exists(blob_path):
+            meta = {
+                "id": artifact_id,
+                "mime_type": mime_type,
+                "bytes": len(data),
+                "created_at": time.time(),
+                **metadata,
+            }
+            # Metadata first: a blob is only visible once its sidecar exists
+            self._atomic_write(self._meta_path(artifact_id), json.dumps(meta).encode("utf-8"))
+            self._atomic_write(blob_path, data)
+            self._count("stored")
+        else:
+            self._touch(artifact_id)
+            self._count("reused")
+
+        now = time.time()
+        if now - self._last_trim > self.TRIM_INTERVAL_SECONDS:
+            self._last_trim = now
+            self.trim()
+        return artifact_id
+
+    def path(self, artifact_id):
+        """Blob path of a live artifact, or None; counts as a use for the LRU"""
+        if not ARTIFACT_ID.match(artifact_id or ""):
+            return None
+        blob_path = self._blob_path(artifact_id)
+        try:
+            if os.path.getmtime(blob_path) + self.ttl_seconds <= time.time():
+                self._remove(artifact_id)
+                self._count("expired")
+                return None
+        except OSError:
+            return None
+        self._touch(artifact_id)
+        return blob_path
+
+    def read(self, artifact_id):
+        path = self.path(artifact_id)
+        if path is None:
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def metadata(self, artifact_id):
+        if not ARTIFACT_ID.match(artifact_id or ""):
+            return None
+        try:
+            with open(self._meta_path(artifact_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+    def get_variant(self, artifact_id, variant):
+        """Artifact id of a derivative previously recorded with set_variant."""
+        derivative_id = self._variant_target(artifact_id, variant)
+        return derivative_id if self.path(derivative_id) else None
+
+    def set_variant(self, artifact_id, variant, derivative_id):
+        self._atomic_write(self._variant_path(artifact_id, variant), derivative_id.encode("ascii"))
+
+    def trim_variants(self, artifact_id, prefix, keep):
+        """Remove all but the `keep` most recently used derivatives whose
+        variant name starts with `prefix`
+        """
+        variants_dir = self._blob_path(artifact_id) + ".variants"
+        try:
+            names = [name for name in os.listdir(variants_dir) if name.startswith(prefix)]
+        except OSError:
+            return
+        if len(names) <= keep:
+            return
+        entries = []
+        for name in names:
+            derivative_id = self._variant_target(artifact_id, name)
+            used_at = 0.0
+            if derivative_id:
+                try:
+                    used_at = os.path.getmtime(self._blob_path(derivative_id))
+                except OSError:
+                    pass
+            entries.append((used_at, name, derivative_id))
+
+        entries.sort(reverse=True)
+        for _, name, derivative_id in entries[keep:]:
+            try:
+                os.remove(self._variant_path(artifact_id, name))
+            except OSError:
+                pass
+            if derivative_id and derivative_id != artifact_id:
+                self._remove(derivative_id)
+                self._count("evictions")
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def trim(self):
+        """Drop expired artifacts, then the least recently used until under the byte budget."""
+        now = time.time()
+        entries = []
+        total = 0
+        for artifact_id in self._artifact_ids():
+            try:
+                st = os.stat(self._blob_path(artifact_id))
+            except FileNotFoundError:
+                continue
+            if st.st_mtime + self.ttl_seconds <= now:
+                self._remove(artifact_id)
+                self._count("expired")
+                continue
+            entries.append((st.st_mtime, st.st_size, artifact_id))
+            total += st.st_size
+
+        entries.sort()
+        for _, _, artifact_id in entries:
+            if total <= self.max_disk_bytes:
+                break
+            # Already gone if it was a derivative of something evicted earlier
+            total -= self._remove(artifact_id)
+            self._count("evictions")
+
+    def _artifact_ids(self):
+        if not os.path.isdir(self.directory):
+            return
+        for shard in os.listdir(self.directory):
+            shard_dir = os.path.join(self.directory, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for name in os.listdir(shard_dir):
+                if ARTIFACT_ID.match(name):
+                    yield name
+
+    def _touch(self, artifact_id):
+        try:
+            os.utime(self._blob_path(artifact_id))
+        except OSError:
+            pass
+
+    def _remove(self, artifact_id):
+        """Delete an artifact and its derivatives; returns the blob bytes freed"""
+        blob_path = self._blob_path(artifact_id)
+        try:
+            freed = os.path.getsize(blob_path)
+            # Blob first, so a half-removed artifact is already invisible
+            os.remove(blob_path)
+        except OSError:
+            return 0
+        try:
+            os.remove(self._meta_path(artifact_id))
+        except OSError:
+            pass
+
+        variants_dir = blob_path + ".variants"
+        try:
+            variants = os.listdir(variants_dir)
+        except OSError:
+            variants = []
+        for variant in variants:
+            derivative_id = self._variant_target(artifact_id, variant)
+            if derivative_id and derivative_id != artifact_id:
+                freed += self._remove(derivative_id)
+        shutil.rmtree(variants_dir, ignore_errors=True)
+        return freed
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _variant_target(self, artifact_id, variant):
+        """The id a variant entry points at, or None"""
+        try:
+            with open(self._variant_path(artifact_id, variant), "r", encoding="utf-8") as f:
+                derivative_id = f.read().strip()
+        except OSError:
+            return None
+        return derivative_id if ARTIFACT_ID.match(derivative_id) else None
+
+    def _variant_path(self, artifact_id, variant):
+        return self._blob_path(artifact_id) + f".variants/{variant}"
+
+    def _blob_path(self, artifact_id):
+        return os.path.join(self.directory, artifact_id[:2], artifact_id)
+
+    def _meta_path(self, artifact_id):
+        return self._blob_path(artifact_id) + ".json"
+
+    def _atomic_write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
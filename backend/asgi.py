@@ -0,0 +1,230 @@
+"""ASGI entry point (gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app).
+
+/stage, /analyze, /generate-image and /stage-and-generate are served
+natively on the event loop, so a provider call that takes a minute holds a
+coroutine rather than a thread and one worker can keep hundreds of them in
+flight. The pipelines behind them are main.py's, run with pipeline.arun():
+CPU-bound steps (upload normalization, decoding and storing the output) and
+the file-backed stores (caches, idempotency records, the perceptual hash
+index) run in the default thread pool. Only reading the request, streaming
+and cancelling branches are done here. Every other route is the Flask app
+from main.py, run on a bounded thread pool through a WSGI adapter, so both
+modes answer the same API.
+"""
+import asyncio
+import os
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.formparsers import MultiPartParser
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+import main
+import metrics
+import pipeline
+from ingest import SPOOL_BYTES, UploadError, check_request_length, ingest_image
+from main import (
+    BRANCH_TIMEOUTS,
+    GENERATION_TIMEOUT_MESSAGE,
+    SSE_HEADERS,
+    SSE_HEARTBEAT_SECONDS,
+    STAGING_MODEL,
+    branch_failure,
+    branch_success,
+    branch_timeout,
+    combined_branches,
+    combined_result,
+    error_body,
+    generation_response,
+    get_gemini_key,
+    parse_generation_params,
+    prepare_stage,
+    request_scheduling,
+    room_audit,
+    sse_event,
+    stage_description,
+    stage_result,
+    stored_upload,
+    wants_stage_stream,
+)
+from providers import anthropic_stream_async, classify_anthropic, governor
+
+# Same spooling threshold as the Flask routes (main.UploadRequest)
+MultiPartParser.max_file_size = SPOOL_BYTES
+
+NATIVE_ENDPOINTS = {
+    "/stage": "stage",
+    "/analyze": "analyze_room",
+    "/generate-image": "generate_image",
+    "/stage-and-generate": "stage_and_generate",
+}
+
+
+def error_json(e, context, timeout_message="Request timed out"):
+    body, status_code, headers = error_body(e, context, timeout_message)
+    return JSONResponse(body, status_code, headers)
+
+
+async def read_image(request):
+    """(form, IngestedImage) from an `upload_id` or `image` field; see main.request_image"""
+    content_length = request.headers.get("content-length")
+    check_request_length(int(content_length) if content_length and content_length.isdigit() else None)
+    with metrics.stage("upload_read"):
+        form = await request.form()
+
+    if form.get("upload_id"):
+        return form, await asyncio.to_thread(stored_upload, form["upload_id"])
+    image_file = form.get("image")
+    if not hasattr(image_file, "read"):
+        raise UploadError("No image provided")
+    if image_file.filename == '':
+        raise UploadError("No image selected")
+    return form, await asyncio.to_thread(ingest_image, image_file.file)
+
+
+async def stream_stage_async(stage_request, result_fields):
+    try:
+        with metrics.stage("claude_stream"):
+            async with governor.aguard(STAGING_MODEL, classify_anthropic):
+                async with anthropic_stream_async(**stage_request) as stream:
+                    async for text in stream.text_stream:
+                        yield sse_event("delta", {"text": text})
+                    message = await stream.get_final_message()
+
+        yield sse_event("done", stage_result(message, result_fields))
+
+    except Exception as e:
+        body, status_code, _ = error_body(e, "Stage stream")
+        yield sse_event("error", {**body, "status_code": status_code})
+
+
+async def stage(request):
+    try:
+        form, image = await read_image(request)
+        room_type = form.get('room_type', 'LIVING')
+        style = form.get('style', 'MODERN')
+
+        if wants_stage_stream(form, request.headers):
+            return StreamingResponse(stream_stage_async(*prepare_stage(image, room_type, style)),
+                                     media_type="text/event-stream", headers=SSE_HEADERS)
+
+        return JSONResponse(await pipeline.arun(stage_description(image, room_type, style)))
+
+    except Exception as e:
+        return error_json(e, "Stage")
+
+
+async def run_branch(name, coro):
+    """(name, (body, status)) for one branch of /stage-and-generate"""
+    try:
+        return name, branch_success(await asyncio.wait_for(coro, BRANCH_TIMEOUTS[name]))
+    except asyncio.TimeoutError:
+        return name, branch_timeout(name)
+    except Exception as e:
+        return name, branch_failure(name, e)
+
+
+def client_scheduling(request):
+    """main.request_scheduling() for a Starlette request"""
+    return request_scheduling(request.headers, request.client.host if request.client else None)
+
+
+async def run_branches(branches, heartbeat=None):
+    """Async twin of main.run_branches: yields (name, (body, status)) as each
+    branch finishes, and (None, None) every `heartbeat` seconds while waiting.
+    Unlike there a timed-out branch is cancelled; a generation it was leading
+    is taken over by any request still waiting on it.
+    """
+    pending = {asyncio.create_task(run_branch(name, pipeline.arun(steps()))) for name, steps in branches.items()}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=heartbeat, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+            if not done:
+                yield None, None
+    finally:
+        # The client went away mid-stream
+        for task in pending:
+            task.cancel()
+
+
+async def stage_and_generate(request):
+    try:
+        form, image = await read_image(request)
+        # Reads the house's measured palette from disk
+        params = await asyncio.to_thread(parse_generation_params, form, image)
+        branches = combined_branches(image, form, params, get_gemini_key(), client_scheduling(request))
+    except Exception as e:
+        return error_json(e, "Stage-and-generate")
+
+    if wants_stage_stream(form, request.headers):
+        async def stream():
+            outcomes = {}
+            async for name, outcome in run_branches(branches, heartbeat=SSE_HEARTBEAT_SECONDS):
+                if name is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                outcomes[name] = outcome
+                yield sse_event(name, outcome[0])
+            yield sse_event("done", {"status": combined_result(outcomes)[0]["status"]})
+
+        return StreamingResponse(stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+    body, status_code = combined_result({name: outcome async for name, outcome in run_branches(branches)})
+    return JSONResponse(body, status_code)
+
+
+async def generate_image(request):
+    try:
+        gemini_key = get_gemini_key()
+        if not gemini_key:
+            return JSONResponse({"error": "GEMINI_API_KEY not configured"}, 503)
+
+        form, image = await read_image(request)
+        body, status_code, headers = await pipeline.arun(generation_response(
+            image, form, gemini_key, request.headers.get("Idempotency-Key"), client_scheduling(request),
+        ))
+        with metrics.stage("serialize"):
+            return JSONResponse(body, status_code, headers)
+
+    except Exception as e:
+        return error_json(e, "Generate image", GENERATION_TIMEOUT_MESSAGE)
+
+
+async def analyze_room(request):
+    try:
+        gemini_key = get_gemini_key()
+        if not gemini_key:
+            return JSONResponse({"error": "GEMINI_API_KEY not configured"}, 503)
+
+        _, image = await read_image(request)
+        body, status_code = await pipeline.arun(room_audit(image, gemini_key))
+        return JSONResponse(body, status_code)
+
+    except Exception as e:
+        return error_json(e, "Analyze", "Analysis timed out")
+
+
+native = Starlette(routes=[
+    Route("/stage", stage, methods=["POST"]),
+    Route("/generate-image", generate_image, methods=["POST"]),
+    Route("/analyze", analyze_room, methods=["POST"]),
+    Route("/stage-and-generate", stage_and_generate, methods=["POST"]),
+])
+native = metrics.ASGIMetrics(
+    CORSMiddleware(native, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"]),
+    NATIVE_ENDPOINTS,
+)
+
+# Flask views block their thread for the whole request; bound how many run at once
+flask_app = WSGIMiddleware(main.app, workers=int(os.getenv("ASGI_WSGI_THREADS", 32)))
+
+
+async def app(scope, receive, send):
+    if scope["type"] != "http" or scope["path"] in NATIVE_ENDPOINTS:
+        await native(scope, receive, send)
+    else:
+        await flask_app(scope, receive, send)
@@ -0,0 +1,155 @@
+"""Benchmark scene analysis detail levels: latency and token counts per level.
+
+Usage (from backend/):
+    GEMINI_API_KEY=... python -m bench.analysis_levels --photos room1.jpg,room2.jpg --runs 5 \\
+        --output bench/results/analysis-levels.json
+    python -m bench.analysis_levels --stub --runs 20 --text-latency fixed:400 --text-ms-per-token 6
+
+Sends the scene analysis request for each level straight to generateContent
+(no cache, no governor) and reports p50/p95 latency, prompt and output token
+counts from usageMetadata, response bytes and whether the answer validated.
+Levels are interleaved run by run so provider drift hits them equally.
+
+--stub runs against an in-process bench.stub_server, which answers with a
+schema-shaped document and charges --text-ms-per-token per output token.
+That checks the harness and the relative size of each schema; it says
+nothing about Flash itself.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import httpx
+
+from bench import stub_server
+from bench.loadtest import environment, make_images, percentile
+from ingest import ingest_image
+from providers import Base64Bytes, StreamedJSON
+from scene_analysis import LEVELS, SCENE_ANALYSIS_MODEL, AnalysisInvalid, parse, payload_builder, to_dict
+
+
+def analyze(client, base_url, gemini_key, image, level):
+    """One uncached analysis; returns a sample dict"""
+    part = {"inlineData": {"mimeType": image.mime_type, "data": Base64Bytes(image.data)}}
+    body = StreamedJSON(payload_builder(level)(part))
+    started = time.perf_counter()
+    response = client.post(
+        f"{base_url}/v1beta/models/{SCENE_ANALYSIS_MODEL}:generateContent",
+        content=iter(body),
+        headers={**body.headers(), "x-goog-api-key": gemini_key},
+    )
+    sample = {"status": response.status_code, "latency_ms": (time.perf_counter() - started) * 1000,
+              "response_bytes": len(response.content)}
+    if response.status_code != 200:
+        return sample
+
+    result = response.json()
+    usage = result.get("usageMetadata", {})
+    sample["prompt_tokens"] = usage.get("promptTokenCount")
+    sample["output_tokens"] = usage.get("candidatesTokenCount")
+    try:
+        text = result["candidates"][0]["content"]["parts"][0]["text"]
+        sample["fields"] = _count_fields(to_dict(parse(json.loads(text), level)))
+        sample["valid"] = True
+    except (KeyError, IndexError, ValueError, AnalysisInvalid):
+        sample["valid"] = False
+    return sample
+
+
+def _count_fields(value):
+    """Leaf values in a parsed analysis"""
+    if isinstance(value, dict):
+        return sum(_count_fields(v) for k, v in value.items() if k != "level")
+    if isinstance(value, list):
+        return sum(_count_fields(v) for v in value)
+    return 1
+
+
+def summarize(level, samples):
+    ok = [s for s in samples if s["status"] == 200]
+
+    def stat(name, pct):
+        values = [s[name] for s in ok if s.get(name) is not None]
+        value = percentile(values, pct)
+        return None if value is None else round(value, 1)
+
+    return {
+        "level": level,
+        "runs": len(samples),
+        "errors": len(samples) - len(ok),
+        "invalid": sum(1 for s in ok if not s.get("valid")),
+        "latency_ms": {"p50": stat("latency_ms", 50), "p95": stat("latency_ms", 95)},
+        "prompt_tokens": stat("prompt_tokens", 50),
+        "output_tokens": {"p50": stat("output_tokens", 50), "p95": stat("output_tokens", 95)},
+        "response_bytes": stat("response_bytes", 50),
+        "fields": stat("fields", 50),
+    }
+
+
+def print_summary(summary):
+    lat, out = summary["latency_ms"], summary["output_tokens"]
+    print(f"{summary['level']:<9} runs {summary['runs']:<4} p50 {lat['p50'] or 0:8.1f}  p95 {lat['p95'] or 0:8.1f} ms  "
+          f"prompt {summary['prompt_tokens'] or 0:6.0f} tok  output p50 {out['p50'] or 0:6.0f} / p95 {out['p95'] or 0:6.0f} tok  "
+          f"fields {summary['fields'] or 0:4.0f}  err {summary['errors']} invalid {summary['invalid']}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--photos", help="comma-separated room photos (default: synthetic images)")
+    parser.add_argument("--levels", default=",".join(LEVELS))
+    parser.add_argument("--runs", type=int, default=5, help="requests per level per photo")
+    parser.add_argument("--stub", action="store_true", help="run against an in-process provider stub")
+    parser.add_argument("--output", help="write results JSON here")
+    stub_actions = stub_server.add_arguments(parser.add_argument_group("stub provider (--stub)"))
+    args = parser.parse_args()
+
+    levels = [level.strip() for level in args.levels.split(",") if level.strip()]
+    if args.photos:
+        photos = []
+        for path in args.photos.split(","):
+            with open(path, "rb") as f:
+                photos.append(f.read())
+    else:
+        photos = make_images(2)
+    images = [ingest_image(photo) for photo in photos]
+
+    if args.stub:
+        server = stub_server.start_in_thread(**stub_server.server_options(args))
+        base_url, gemini_key = f"http://127.0.0.1:{server.server_port}", "stub"
+    else:
+        base_url = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com").rstrip("/")
+        gemini_key = os.getenv("GEMINI_API_KEY")
+        if not gemini_key:
+            sys.exit("GEMINI_API_KEY is required (or pass --stub)")
+
+    samples = {level: [] for level in levels}
+    with httpx.Client(timeout=httpx.Timeout(120.0, connect=10.0)) as client:
+        for _ in range(args.runs):
+            for image in images:
+                for level in levels:
+                    samples[level].append(analyze(client, base_url, gemini_key, image, level))
+
+    results = {
+        "environment": environment(),
+        "settings": {
+            "model": SCENE_ANALYSIS_MODEL,
+            "runs": args.runs,
+            "photos": len(images),
+            "stub": {action.dest: getattr(args, action.dest) for action in stub_actions} if args.stub else None,
+        },
+        "levels": [summarize(level, samples[level]) for level in levels],
+    }
+    for summary in results["levels"]:
+        print_summary(summary)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
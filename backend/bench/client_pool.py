@@ -0,0 +1,66 @@
+"""Compare per-call httpx.post against the pooled provider client.
+
+Usage (from backend/):
+    python -m bench.client_pool --requests 200
+
+Starts a local stub unless --base-url is given. Against a plain-HTTP stub the
+difference is only TCP setup; against the real TLS endpoint it also includes
+the handshake, so treat the local number as a lower bound.
+"""
+import argparse
+import os
+import statistics
+import time
+
+import httpx
+
+from bench import loadtest, stub_server
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def _run(label, send, count):
+    samples = []
+    for _ in range(count):
+        started = time.perf_counter()
+        response = send()
+        response.raise_for_status()
+        samples.append((time.perf_counter() - started) * 1000)
+    print(f"{label:<14} mean {statistics.mean(samples):7.2f} ms   "
+          f"p50 {_percentile(samples, 50):7.2f} ms   p95 {_percentile(samples, 95):7.2f} ms")
+    return statistics.mean(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--base-url", default=None)
+    args = parser.parse_args()
+
+    server = None
+    base_url = args.base_url
+    if not base_url:
+        server = stub_server.start_in_thread()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+
+    # providers reads GEMINI_API_BASE and the governor limits at import time
+    os.environ["GEMINI_API_BASE"] = base_url
+    os.environ.setdefault("PROVIDER_RATE_LIMITS", loadtest.UNLIMITED)
+    import providers
+
+    payload = {"contents": [{"parts": [{"text": "ping"}]}]}
+    url = providers.gemini_url("gemini-3-flash-preview")
+
+    per_call = _run("httpx.post", lambda: httpx.post(url, json=payload, headers={"x-goog-api-key": "bench"}), args.requests)
+    pooled = _run("pooled client", lambda: providers.gemini_generate("gemini-3-flash-preview", payload, "bench", "analysis"), args.requests)
+    print(f"saved per call: {per_call - pooled:.2f} ms ({(1 - pooled / per_call) * 100:.0f}%)")
+
+    if server:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
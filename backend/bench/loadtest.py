@@ -0,0 +1,368 @@
+"""Load test /stage, /analyze and /generate-image against the provider stub.
+
+Usage (from backend/):
+    python -m bench.loadtest --configs 1x8,2x8,4x4 --concurrency 1,8,32 --duration 20 \\
+        --image-latency lognormal:800:0.3 --output bench/results/baseline.json
+    python -m bench.loadtest --compare bench/results/baseline.json
+
+For every gunicorn configuration (WORKERSxTHREADS) this starts the stub and
+a gunicorn server as subprocesses. It then drives each endpoint at each
+concurrency level for --duration seconds with closed-loop clients. It
+reports throughput, p50/p95/p99 latency, error counts, RSS per worker and
+CPU time per request (Linux /proc). Each run uses a fresh STATE_DIR and
+distinct images, so caches and coalescing do not hide provider work unless
+--repeat-images asks for that.
+
+--output writes the results as JSON. --compare flags runs whose throughput
+dropped, or whose p95 rose, by more than --tolerance percent, and exits
+non-zero if any did.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from PIL import Image
+
+from bench import stub_server
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENDPOINTS = ("stage", "analyze", "generate-image")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+# The governor would otherwise throttle the benchmark to production quotas
+UNLIMITED = json.dumps({model: {"rpm": 1_000_000, "burst": 10_000} for model in (
+    "gemini-3-pro-image-preview", "gemini-3-flash-preview", "claude-sonnet-4-20250514")})
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_images(count, size=(1600, 1067)):
+    """Distinct JPEG uploads so analysis caching and coalescing don't kick in"""
+    images = []
+    for i in range(count):
+        rng = random.Random(i)
+        img = Image.new("RGB", size, tuple(rng.randrange(256) for _ in range(3)))
+        img.paste(Image.frombytes("RGB", (256, 256), rng.randbytes(256 * 256 * 3)), (rng.randrange(size[0] - 256), 0))
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=88)
+        images.append(buf.getvalue())
+    return images
+
+
+# ============== PROCESS ACCOUNTING (Linux /proc) ==============
+
+def child_pids(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def cpu_seconds(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return 0.0
+
+
+def rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+# ============== SERVERS ==============
+
+def wait_for(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
+
+
+def start_stub(args, stub_actions):
+    port = free_port()
+    cmd = [sys.executable, "-m", "bench.stub_server", "--port", str(port)]
+    for action in stub_actions:
+        value = getattr(args, action.dest)
+        if value is not None and value != action.default:
+            cmd += [action.option_strings[0], str(value)]
+    proc = subprocess.Popen(cmd, cwd=BACKEND_DIR, stdout=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    wait_for(f"{base_url}/stats")
+    return proc, base_url
+
+
+def start_app(workers, threads, stub_url, state_dir):
+    port = free_port()
+    env = {
+        **os.environ,
+        "GEMINI_API_BASE": stub_url,
+        "ANTHROPIC_BASE_URL": stub_url,
+        "GEMINI_API_KEY": "bench",
+        "ANTHROPIC_API_KEY": "bench",
+        "STATE_DIR": state_dir,
+        "PROVIDER_RATE_LIMITS": UNLIMITED,
+        "PROVIDER_HTTP2": "false",  # the stub only speaks HTTP/1.1
+        "PORT": str(port),
+    }
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    cmd = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+           "--workers", str(workers), "--threads", str(threads), "--bind", f"127.0.0.1:{port}", "main:app"]
+    proc = subprocess.Popen(cmd, cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    wait_for(f"{base_url}/health")
+    # Workers boot independently; give the slowest one a moment to import main
+    deadline = time.monotonic() + 10
+    while len(child_pids(proc.pid)) < workers and time.monotonic() < deadline:
+        time.sleep(0.1)
+    return proc, base_url
+
+
+def stop(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+# ============== LOAD ==============
+
+def request_for(endpoint, image):
+    files = {"image": ("room.jpg", image, "image/jpeg")}
+    if endpoint == "generate-image":
+        return files, {"room_type": "LIVING", "style": random.choice(("MODERN", "LUXE", "SCANDINAVIAN"))}
+    if endpoint == "stage":
+        return files, {"room_type": "LIVING", "style": "MODERN"}
+    return files, {}
+
+
+def drive(base_url, endpoint, concurrency, duration, images, warmup):
+    """Closed-loop load: `concurrency` clients each send back-to-back requests"""
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+    counter = iter(range(10 ** 9))
+    measure_from = time.monotonic() + warmup
+    stop_at = measure_from + duration
+
+    def client():
+        with httpx.Client(base_url=base_url, timeout=300) as http:
+            while time.monotonic() < stop_at:
+                files, data = request_for(endpoint, images[next(counter) % len(images)])
+                started = time.monotonic()
+                try:
+                    status = http.post(f"/{endpoint}", files=files, data=data).status_code
+                except httpx.HTTPError:
+                    status = "transport_error"
+                if started < measure_from:
+                    continue
+                with lock:
+                    statuses[status] += 1
+                    if status == 200:
+                        latencies.append((time.monotonic() - started) * 1000)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(client)
+    return latencies, statuses
+
+
+def run_level(app_proc, base_url, endpoint, concurrency, args, images):
+    pids = [app_proc.pid] + child_pids(app_proc.pid)
+    cpu_before = sum(cpu_seconds(pid) for pid in pids)
+    started = time.monotonic()
+    latencies, statuses = drive(base_url, endpoint, concurrency, args.duration, images, args.warmup)
+    elapsed = time.monotonic() - started - args.warmup
+    pids = [app_proc.pid] + child_pids(app_proc.pid)
+    cpu_used = sum(cpu_seconds(pid) for pid in pids) - cpu_before
+
+    completed = sum(statuses.values())
+    workers = child_pids(app_proc.pid)
+    return {
+        "endpoint": endpoint,
+        "concurrency": concurrency,
+        "requests": completed,
+        "ok": len(latencies),
+        "statuses": {str(k): v for k, v in sorted(statuses.items(), key=str)},
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+        "latency_ms": {
+            "p50": _round(percentile(latencies, 50)),
+            "p95": _round(percentile(latencies, 95)),
+            "p99": _round(percentile(latencies, 99)),
+            "mean": _round(sum(latencies) / len(latencies)) if latencies else None,
+        },
+        # Includes warmup requests' CPU; negligible once duration >> warmup
+        "cpu_ms_per_request": _round(cpu_used * 1000 / completed) if completed else None,
+        "rss_mb_per_worker": [_round(rss_mb(pid)) for pid in workers],
+    }
+
+
+def _round(value):
+    return None if value is None else round(value, 1)
+
+
+# ============== REPORTING ==============
+
+def run_key(run):
+    return (run["workers"], run["threads"], run["endpoint"], run["concurrency"])
+
+
+def print_run(run):
+    lat = run["latency_ms"]
+    errors = sum(v for k, v in run["statuses"].items() if k != "200")
+    rss = run["rss_mb_per_worker"]
+    print(f"{run['workers']}x{run['threads']:<3} {run['endpoint']:<15} c={run['concurrency']:<4} "
+          f"{run['throughput_rps']:8.2f} rps  p50 {lat['p50'] or 0:8.1f}  p95 {lat['p95'] or 0:8.1f}  "
+          f"p99 {lat['p99'] or 0:8.1f} ms  err {errors:<4} cpu/req {run['cpu_ms_per_request'] or 0:6.1f} ms  "
+          f"rss {max(filter(None, rss), default=0):6.1f} MB", flush=True)
+
+
+def compare(results, baseline, tolerance):
+    """Print per-run deltas against a baseline; returns the regressed run keys"""
+    previous = {run_key(run): run for run in baseline["runs"]}
+    regressions = []
+    for run in results["runs"]:
+        before = previous.get(run_key(run))
+        if before is None:
+            continue
+        tput = _delta(before["throughput_rps"], run["throughput_rps"])
+        p95 = _delta(before["latency_ms"]["p95"], run["latency_ms"]["p95"])
+        regressed = (tput is not None and tput < -tolerance) or (p95 is not None and p95 > tolerance)
+        if regressed:
+            regressions.append(run_key(run))
+        print(f"{run['workers']}x{run['threads']:<3} {run['endpoint']:<15} c={run['concurrency']:<4} "
+              f"throughput {_fmt(tput)}  p95 {_fmt(p95)}{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def _delta(before, after):
+    if not before or after is None:
+        return None
+    return (after - before) / before * 100
+
+
+def _fmt(delta):
+    return "   n/a" if delta is None else f"{delta:+6.1f}%"
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--configs", default="2x8", help="gunicorn WORKERSxTHREADS list, e.g. 1x8,2x8,4x4")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    parser.add_argument("--concurrency", default="1,8,32", help="client concurrency levels")
+    parser.add_argument("--duration", type=float, default=15.0, help="measured seconds per level")
+    parser.add_argument("--warmup", type=float, default=2.0, help="unmeasured seconds before each level")
+    parser.add_argument("--images", type=int, default=64, help="distinct upload images to cycle through")
+    parser.add_argument("--repeat-images", action="store_true", help="reuse one image so caches and coalescing apply")
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--compare", help="baseline JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=10.0, help="regression threshold in percent")
+    stub_actions = stub_server.add_arguments(parser.add_argument_group("stub provider"))
+    args = parser.parse_args()
+
+    endpoints = [e.strip() for e in args.endpoints.split(",") if e.strip()]
+    levels = [int(c) for c in args.concurrency.split(",")]
+    configs = [tuple(int(v) for v in c.lower().split("x")) for c in args.configs.split(",")]
+    images = make_images(1 if args.repeat_images else args.images)
+
+    results = {
+        "environment": environment(),
+        "settings": {
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "images": len(images),
+            "stub": {action.dest: getattr(args, action.dest) for action in stub_actions},
+        },
+        "runs": [],
+    }
+
+    stub_proc, stub_url = start_stub(args, stub_actions)
+    try:
+        for workers, threads in configs:
+            for endpoint in endpoints:
+                for concurrency in levels:
+                    # Fresh state per level: caches and idempotency records start cold
+                    state_dir = tempfile.mkdtemp(prefix="estate-bench-")
+                    app_proc, base_url = start_app(workers, threads, stub_url, state_dir)
+                    try:
+                        run = {"workers": workers, "threads": threads,
+                               **run_level(app_proc, base_url, endpoint, concurrency, args, images)}
+                    finally:
+                        stop(app_proc)
+                        shutil.rmtree(state_dir, ignore_errors=True)
+                    results["runs"].append(run)
+                    print_run(run)
+        results["stub_stats"] = httpx.get(f"{stub_url}/stats").json()
+    finally:
+        stop(stub_proc)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"wrote {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"\ncompared with {args.compare} ({baseline['environment'].get('commit')})")
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
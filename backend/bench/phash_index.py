@@ -0,0 +1,102 @@
+"""Benchmark near-duplicate lookups in the perceptual hash index.
+
+Usage (from backend/):
+    python -m bench.phash_index --entries 100000,1000000,2000000 --queries 2000 \\
+        --output bench/results/phash-index.json
+
+Fills a fresh PhashIndex (in a temporary directory) with random hashes, plus
+one planted neighbour per query at a random distance up to --radius, then
+reports p50/p99 lookup latency and recall against a brute-force scan. The
+first lookup after filling loads the file and builds the word tables; that
+load time is reported separately.
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from bench.loadtest import environment, percentile
+from phash import PhashIndex, RECORD_DTYPE
+
+
+def fill(path, hashes):
+    records = np.zeros(len(hashes), dtype=RECORD_DTYPE)
+    records["hash"] = hashes
+    records["aspect"] = 4 / 3
+    records["digest"] = np.random.default_rng(0).integers(0, 256, (len(hashes), 32), dtype=np.uint8)
+    records["added"] = int(time.time())
+    with open(path, "wb") as f:
+        f.write(records.tobytes())
+
+
+def flip(value, bits, rng):
+    for bit in rng.sample(range(64), bits):
+        value ^= 1 << bit
+    return value
+
+
+def run(entries, queries, radius, seed):
+    rng = random.Random(seed)
+    hashes = np.random.default_rng(seed).integers(0, 2 ** 63, entries, dtype=np.uint64)
+    hashes[:queries] |= np.uint64(1 << 63)  # use the top bit too
+    targets = [int(h) for h in hashes[:queries]]
+    probes = [flip(h, rng.randint(0, radius), rng) for h in targets]
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "index.bin")
+        fill(path, hashes)
+        index = PhashIndex(path, max_entries=entries * 2, ttl_seconds=3600)
+
+        started = time.perf_counter()
+        index.lookup(0, radius)
+        load_seconds = time.perf_counter() - started
+
+        latencies, found = [], 0
+        for target, probe in zip(targets, probes):
+            started = time.perf_counter()
+            matches = index.lookup(probe, radius)
+            latencies.append((time.perf_counter() - started) * 1000)
+            found += any(m.distance == (target ^ probe).bit_count() for m in matches)
+
+        expected = int(np.count_nonzero(np.bitwise_count(hashes ^ np.uint64(probes[0])) <= radius))
+        return {
+            "entries": entries,
+            "queries": queries,
+            "radius": radius,
+            "load_seconds": round(load_seconds, 3),
+            "lookup_ms": {"p50": round(percentile(latencies, 50), 4), "p99": round(percentile(latencies, 99), 4)},
+            "recall": round(found / queries, 4),
+            "brute_force_matches_first_query": expected,
+            "index_matches_first_query": len(index.lookup(probes[0], radius)),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", default="100000,1000000", help="comma-separated index sizes")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--radius", type=int, default=6)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results JSON here")
+    args = parser.parse_args()
+
+    results = {"environment": environment(), "runs": []}
+    for entries in (int(n) for n in args.entries.split(",")):
+        result = run(entries, args.queries, args.radius, args.seed)
+        results["runs"].append(result)
+        print(f"{entries:>9} entries  load {result['load_seconds']:6.3f} s  lookup p50 {result['lookup_ms']['p50']:.4f} "
+              f"p99 {result['lookup_ms']['p99']:.4f} ms  recall {result['recall']:.4f}", flush=True)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+"""Local stand-in for the Gemini generateContent, Gemini Files and Anthropic messages APIs.
+
+Usage:
+    python -m bench.stub_server --port 9100 --latency-ms 5
+    python -m bench.stub_server --image-latency lognormal:12000:0.3 \\
+        --text-latency lognormal:1500:0.4 --claude-latency normal:6000:1500 \\
+        --image-size 1376x768 --image-content noise --error-rate 0.01 --rate-limit-rate 0.05
+
+Point the backend at it with GEMINI_API_BASE=http://127.0.0.1:9100 and
+ANTHROPIC_BASE_URL=http://127.0.0.1:9100.
+
+Latency specs are `fixed:MS`, `uniform:LO:HI`, `normal:MEAN:STDDEV` or
+`lognormal:MEDIAN:SIGMA`. `--error-rate` answers that fraction of calls
+with a 500/503 and `--rate-limit-rate` with a 429 carrying Retry-After.
+
+Files uploaded through the resumable Files API protocol expire after
+`--file-ttl-seconds`; a generateContent call referencing an unknown or
+expired `fileData` URI gets the 403 Gemini answers with. A request with a
+responseSchema is answered with a document of that shape, and
+`--text-ms-per-token` adds latency per output token (usageMetadata counts
+roughly four characters per token). GET /stats returns per-route status
+counts and request bytes received.
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from urllib.parse import parse_qs, urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+GENERATE_PATH = re.compile(r"^/v1beta/models/(?P<model>[^/:]+):generateContent")
+MESSAGES_PATH = "/v1/messages"
+UPLOAD_PATH = "/upload/v1beta/files"
+
+STAGING_TEXT = "## Room Analysis\nBright, empty room.\n\n## Buyer Appeal\nStaged to sell."
+
+
+class Latency:
+    """Samples a delay in seconds from a spec like `lognormal:1500:0.4`."""
+
+    def __init__(self, spec):
+        kind, *params = str(spec).split(":")
+        if kind.replace(".", "", 1).isdigit():
+            kind, params = "fixed", [kind]
+        if kind not in ("fixed", "uniform", "normal", "lognormal"):
+            raise ValueError(f"Unknown latency distribution '{kind}'")
+        self.spec = spec
+        self.kind = kind
+        self.params = [float(p) for p in params]
+
+    def sample(self):
+        if self.kind == "fixed":
+            ms = self.params[0]
+        elif self.kind == "uniform":
+            ms = random.uniform(*self.params)
+        elif self.kind == "normal":
+            ms = random.gauss(*self.params)
+        else:
+            median, sigma = self.params
+            ms = median * random.lognormvariate(0, sigma)
+        return max(0.0, ms) / 1000.0
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep connections alive between requests
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; avoid Nagle + delayed-ACK stalls
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send_json(200, self.server.stats())
+        else:
+            self._send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+
+        if self.path.split("?")[0] == MESSAGES_PATH:
+            self._anthropic_messages(json.loads(body or b"{}"))
+            return
+        if self.path.split("?")[0] == UPLOAD_PATH:
+            self.server.count("files bytes_in", n=len(body))
+            self._upload_file(body)
+            return
+
+        match = GENERATE_PATH.match(self.path)
+        if not match:
+            self._send_json(404, {"error": {"message": "Not found"}})
+            return
+
+        model = match.group("model")
+        route = "image" if "image" in model else "text"
+        self.server.count(f"{route} bytes_in", n=len(body))
+        time.sleep(self.server.latency[route].sample())
+        if self._inject_fault(route, gemini=True):
+            return
+        request_body = json.loads(body or b"{}")
+        missing = self._missing_file(request_body)
+        if missing:
+            self._send_json(403, {"error": {
+                "code": 403,
+                "message": f"You do not have permission to access the File {missing} or it may not exist.",
+                "status": "PERMISSION_DENIED",
+            }}, route)
+            return
+        if route == "image":
+            part = {"inlineData": {"mimeType": self.server.image_mime, "data": self.server.image_b64}}
+        else:
+            schema = request_body.get("generationConfig", {}).get("responseSchema")
+            document = _sample(schema) if schema else {"model": model, "padding": self.server.text_padding}
+            part = {"text": json.dumps(document)}
+        usage = _usage(request_body, part)
+        if route == "text":
+            # Models write token by token, so longer answers take longer
+            time.sleep(usage["candidatesTokenCount"] * self.server.text_ms_per_token / 1000.0)
+        self._send_json(200, {"candidates": [{"content": {"parts": [part]}}], "usageMetadata": usage}, route)
+
+    def _upload_file(self, body):
+        command = self.headers.get("X-Goog-Upload-Command", "")
+        if command == "start":
+            upload_id = uuid.uuid4().hex
+            self.server.pending_uploads[upload_id] = self.headers.get("X-Goog-Upload-Header-Content-Type")
+            upload_url = f"http://{self.headers['Host']}{UPLOAD_PATH}?upload_id={upload_id}"
+            self._send_json(200, {}, "files", {"X-Goog-Upload-URL": upload_url, "X-Goog-Upload-Status": "active"})
+            return
+        upload_id = parse_qs(urlparse(self.path).query).get("upload_id", [""])[0]
+        mime_type = self.server.pending_uploads.pop(upload_id, None)
+        if "finalize" not in command or mime_type is None:
+            self._send_json(400, {"error": {"code": 400, "message": "Invalid upload"}}, "files")
+            return
+        name = f"files/{uuid.uuid4().hex[:12]}"
+        expires = time.time() + self.server.file_ttl
+        uri = f"http://{self.headers['Host']}/v1beta/{name}"
+        self.server.files[uri] = expires
+        self._send_json(200, {"file": {
+            "name": name,
+            "uri": uri,
+            "mimeType": mime_type,
+            "sizeBytes": str(len(body)),
+            "state": "ACTIVE",
+            "expirationTime": time.strftime("%Y-%m-%dT%H:%M:%S.000000Z", time.gmtime(expires)),
+        }}, "files")
+
+    def _missing_file(self, request_body):
+        for content in request_body.get("contents", []):
+            for part in content.get("parts", []):
+                uri = part.get("fileData", {}).get("fileUri")
+                if uri and self.server.files.get(uri, 0) <= time.time():
+                    return uri.rsplit("/", 1)[-1]
+        return None
+
+    def _inject_fault(self, route, gemini):
+        roll = random.random()
+        if roll < self.server.rate_limit_rate:
+            status, message = 429, "Resource has been exhausted"
+        elif roll < self.server.rate_limit_rate + self.server.error_rate:
+            status, message = random.choice((500, 503)), "Internal error"
+        else:
+            return False
+        if gemini:
+            body = {"error": {"code": status, "message": message}}
+        else:
+            kind = "rate_limit_error" if status == 429 else "api_error"
+            body = {"type": "error", "error": {"type": kind, "message": message}}
+        headers = {"Retry-After": str(self.server.retry_after)} if status == 429 else {}
+        self._send_json(status, body, route, headers)
+        return True
+
+    def _anthropic_messages(self, request_body):
+        time.sleep(self.server.latency["claude"].sample())
+        if self._inject_fault("claude", gemini=False):
+            return
+        usage = {"input_tokens": 1200, "output_tokens": 40,
+                 "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}
+        message = {
+            "id": "msg_stub", "type": "message", "role": "assistant",
+            "model": request_body.get("model", "claude"), "stop_reason": "end_turn", "stop_sequence": None,
+            "content": [{"type": "text", "text": STAGING_TEXT}], "usage": usage,
+        }
+        if not request_body.get("stream"):
+            self._send_json(200, message, "claude")
+            return
+
+        self.server.count("claude", 200)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        events = [("message_start", {"type": "message_start", "message": {**message, "content": [], "stop_reason": None}}),
+                  ("content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})]
+        for word in STAGING_TEXT.split(" "):
+            events.append(("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                                   "delta": {"type": "text_delta", "text": word + " "}}))
+        events += [("content_block_stop", {"type": "content_block_stop", "index": 0}),
+                   ("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                      "usage": {"output_tokens": usage["output_tokens"]}}),
+                   ("message_stop", {"type": "message_stop"})]
+        for name, data in events:
+            chunk = f"event: {name}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(chunk):x}\r\n".encode("ascii") + chunk + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _send_json(self, status, body, route=None, headers=None):
+        if route:
+            self.server.count(route, status)
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def _sample(schema):
+    """A document shaped like a Gemini responseSchema, as a model would fill it in"""
+    kind = schema.get("type", "STRING").upper()
+    if "enum" in schema:
+        return schema["enum"][0]
+    if kind == "OBJECT":
+        return {name: _sample(prop) for name, prop in schema.get("properties", {}).items()}
+    if kind == "ARRAY":
+        return [_sample(schema.get("items", {})) for _ in range(2)]
+    if kind in ("NUMBER", "INTEGER"):
+        return 12
+    if kind == "BOOLEAN":
+        return False
+    return "sample description text"
+
+
+def _usage(request_body, output_part):
+    """Rough usageMetadata: ~4 characters per text token, 258 tokens per image"""
+    prompt = 0
+    for content in request_body.get("contents", []):
+        for part in content.get("parts", []):
+            prompt += len(part["text"]) // 4 if "text" in part else 258
+    output = len(output_part["text"]) // 4 if "text" in output_part else 1290
+    return {"promptTokenCount": prompt, "candidatesTokenCount": output, "totalTokenCount": prompt + output}
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # An async backend opens hundreds of connections at once; the default
+    # backlog of 5 turns that burst into resets
+    request_queue_size = 1024
+
+    def __init__(self, address):
+        super().__init__(address, StubHandler)
+        self._counts = Counter()
+        self._counts_lock = threading.Lock()
+        self.files = {}
+        self.pending_uploads = {}
+
+    def count(self, route, status=None, n=1):
+        key = route if status is None else f"{route} {status}"
+        with self._counts_lock:
+            self._counts[key] += n
+
+    def stats(self):
+        with self._counts_lock:
+            return dict(self._counts)
+
+
+def _placeholder_image(width=1024, height=768, content="flat", fmt="PNG"):
+    """Base64 output image; `noise` makes it roughly as large as a real render."""
+    from PIL import Image
+
+    if content == "noise":
+        img = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+    else:
+        img = Image.new("RGB", (width, height), (214, 205, 190))
+    buf = io.BytesIO()
+    img.save(buf, fmt)
+    return base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+def make_server(host="127.0.0.1", port=0, latency_ms=0.0, image_latency=None, text_latency=None,
+                claude_latency=None, image_size=(1024, 768), image_content="flat", image_format="png",
+                text_padding_bytes=0, error_rate=0.0, rate_limit_rate=0.0, retry_after=1, file_ttl_seconds=48 * 3600,
+                text_ms_per_token=0.0):
+    server = StubServer((host, port))
+    default = Latency(f"fixed:{latency_ms}")
+    server.latency = {
+        "image": Latency(image_latency) if image_latency else default,
+        "text": Latency(text_latency) if text_latency else default,
+        "claude": Latency(claude_latency) if claude_latency else default,
+    }
+    pil_format = "JPEG" if image_format.lower() in ("jpg", "jpeg") else "PNG"
+    server.image_mime = f"image/{pil_format.lower()}"
+    server.image_b64 = _placeholder_image(*image_size, content=image_content, fmt=pil_format)
+    server.text_padding = "x" * text_padding_bytes
+    server.error_rate = error_rate
+    server.rate_limit_rate = rate_limit_rate
+    server.retry_after = retry_after
+    server.file_ttl = file_ttl_seconds
+    server.text_ms_per_token = text_ms_per_token
+    return server
+
+
+def start_in_thread(**kwargs):
+    server = make_server(**kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def add_arguments(parser):
+    """Stub options, shared with bench.loadtest; returns the added actions."""
+    return [
+        parser.add_argument("--latency-ms", type=float, default=0.0, help="fixed latency for every route"),
+        parser.add_argument("--image-latency", help="latency spec for Gemini image models"),
+        parser.add_argument("--text-latency", help="latency spec for other Gemini models"),
+        parser.add_argument("--claude-latency", help="latency spec for Anthropic messages"),
+        parser.add_argument("--image-size", default="1024x768", help="generated image WIDTHxHEIGHT"),
+        parser.add_argument("--image-content", choices=("flat", "noise"), default="flat"),
+        parser.add_argument("--image-format", choices=("png", "jpeg"), default="png"),
+        parser.add_argument("--text-padding-bytes", type=int, default=0, help="pad JSON analyses by this many bytes"),
+        parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with 500/503"),
+        parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of calls answered with 429"),
+        parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds on injected 429s"),
+        parser.add_argument("--file-ttl-seconds", type=float, default=48 * 3600, help="lifetime of uploaded files"),
+        parser.add_argument("--text-ms-per-token", type=float, default=0.0,
+                            help="extra latency per output token for Gemini text models"),
+    ]
+
+
+def server_options(args):
+    width, height = (int(v) for v in args.image_size.lower().split("x"))
+    return {
+        "latency_ms": args.latency_ms,
+        "image_latency": args.image_latency,
+        "text_latency": args.text_latency,
+        "claude_latency": args.claude_latency,
+        "image_size": (width, height),
+        "image_content": args.image_content,
+        "image_format": args.image_format,
+        "text_padding_bytes": args.text_padding_bytes,
+        "error_rate": args.error_rate,
+        "rate_limit_rate": args.rate_limit_rate,
+        "retry_after": args.retry_after,
+        "file_ttl_seconds": args.file_ttl_seconds,
+        "text_ms_per_token": args.text_ms_per_token,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, **server_options(args))
+    print(f"Stub provider listening on http://{args.host}:{server.server_port}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
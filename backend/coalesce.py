@@ -0,0 +1,286 @@
+"""Request coalescing and idempotent replay for expensive generations.
+
+SingleFlight makes concurrent identical requests share one upstream call.
+Threads in a worker wait on the leader directly; workers on the same host
+serialize on an flock and a waiter picks up the result the leader published
+while it was blocked, instead of running its own generation. ado() is the
+asyncio version: tasks wait on a future and poll the flock rather than
+block on it, with the file work in threads. flock conflicts between separate opens of the same file, so
+async and threaded callers in one process still coalesce with each other.
+
+IdempotencyStore remembers successful responses under a client-supplied
+Idempotency-Key for a configurable window so retries replay the result.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows dev boxes: coalesce within the process only
+    fcntl = None
+
+
+def fingerprint(*parts):
+    """Stable digest of JSON-serializable request parts."""
+    blob = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    # Published results only need to outlive the waiters that read them
+    RESULT_TTL_SECONDS = 600
+    TRIM_INTERVAL_SECONDS = 60
+    LOCK_POLL_SECONDS = 0.1
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._last_trim = 0.0
+        self._calls = {}
+        self._async_calls = {}
+        self._lock = threading.Lock()
+        self._counters = {"leaders": 0, "coalesced_local": 0, "coalesced_remote": 0}
+
+    def do(self, key, fn):
+        """Run fn() once per key at a time; returns (result, shared)."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self._counters["coalesced_local"] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result, shared = self._run_across_workers(key, fn)
+            return call.result, shared
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def ado(self, key, fn):
+        """do() for a coroutine function fn; returns (result, shared)."""
+        with self._lock:
+            future = self._async_calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._async_calls[key] = asyncio.get_running_loop().create_future()
+            else:
+                self._counters["coalesced_local"] += 1
+
+        if not leader:
+            # Shielded so one waiter disconnecting doesn't cancel the others
+            return await asyncio.shield(future), True
+
+        try:
+            result, shared = await self._arun_across_workers(key, fn)
+            future.set_result(result)
+            return result, shared
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # retrieved here so asyncio doesn't warn when nobody waited
+            raise
+        finally:
+            with self._lock:
+                del self._async_calls[key]
+
+    def stats(self):
+        with self._lock:
+            return {**self._counters, "in_flight": len(self._calls) + len(self._async_calls)}
+
+    def _run_across_workers(self, key, fn):
+        if fcntl is None:
+            return self._lead(fn), False
+
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, f"{key}.lock"), "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another worker is generating this exact request: wait for it
+                # and reuse what it published, if it succeeded.
+                waited_since = time.time()
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                published = self._take_published(key, waited_since, lock_file)
+                if published is not None:
+                    return published, True
+            try:
+                result = self._lead(fn)
+                self._publish(key, result)
+                return result, False
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    async def _arun_across_workers(self, key, fn):
+        if fcntl is None:
+            return await self._alead(fn), False
+
+        # Opening, locking and the published result are all file operations,
+        # so they run in a thread rather than on the event loop
+        lock_file = await asyncio.to_thread(self._open_lock, key)
+        try:
+            waited_since = None
+            while not await asyncio.to_thread(self._try_lock, lock_file):
+                # Blocking on the flock would hold a thread for as long as the
+                # other worker generates; poll instead
+                waited_since = waited_since or time.time()
+                await asyncio.sleep(self.LOCK_POLL_SECONDS)
+            if waited_since is not None:
+                published = await asyncio.to_thread(self._take_published, key, waited_since, lock_file)
+                if published is not None:
+                    return published, True
+            try:
+                result = await self._alead(fn)
+                await asyncio.to_thread(self._publish, key, result)
+                return result, False
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        finally:
+            lock_file.close()
+
+    def _open_lock(self, key):
+        os.makedirs(self.directory, exist_ok=True)
+        return open(os.path.join(self.directory, f"{key}.lock"), "w")
+
+    @staticmethod
+    def _try_lock(lock_file):
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def _take_published(self, key, waited_since, lock_file):
+        """A result published while we waited; releases the lock when found."""
+        published = self._read_published(key, waited_since)
+        if published is not None:
+            with self._lock:
+                self._counters["coalesced_remote"] += 1
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return published
+
+    def _lead(self, fn):
+        with self._lock:
+            self._counters["leaders"] += 1
+        return fn()
+
+    async def _alead(self, fn):
+        with self._lock:
+            self._counters["leaders"] += 1
+        return await fn()
+
+    def _result_path(self, key):
+        return os.path.join(self.directory, f"{key}.result.json")
+
+    def _publish(self, key, result):
+        now = time.time()
+        if now - self._last_trim > self.TRIM_INTERVAL_SECONDS:
+            self._last_trim = now
+            self._trim(now)
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(result, f)
+            os.replace(tmp_path, self._result_path(key))
+        except (OSError, TypeError, ValueError):
+            pass
+
+    def _trim(self, now):
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) + self.RESULT_TTL_SECONDS < now:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _read_published(self, key, since):
+        path = self._result_path(key)
+        try:
+            # Only results finished while we were waiting count; older ones
+            # belong to an earlier, separate request.
+            if os.path.getmtime(path) < since:
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+
+class IdempotencyConflict(Exception):
+    """The key was already used for a request with different parameters."""
+
+
+class IdempotencyStore:
+    def __init__(self, directory, ttl_seconds=24 * 3600):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._counters = {"stored": 0, "replayed": 0, "conflicts": 0}
+
+    def get(self, scope, idempotency_key, request_fingerprint):
+        """Stored {"status_code", "body"} for this key, or None."""
+        path = self._path(scope, idempotency_key)
+        try:
+            if os.path.getmtime(path) + self.ttl_seconds <= time.time():
+                os.remove(path)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+        if record["fingerprint"] != request_fingerprint:
+            self._count("conflicts")
+            raise IdempotencyConflict()
+        self._count("replayed")
+        return record
+
+    def set(self, scope, idempotency_key, request_fingerprint, status_code, body):
+        record = {"fingerprint": request_fingerprint, "status_code": status_code, "body": body}
+        path = self._path(scope, idempotency_key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(record, f)
+            os.replace(tmp_path, path)
+            self._count("stored")
+        except OSError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def _path(self, scope, idempotency_key):
+        # Hash the client-chosen key so it can't steer the file path
+        return os.path.join(self.directory, fingerprint(scope, idempotency_key) + ".json")
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
@@ -0,0 +1,167 @@
+"""Per-request deadlines and hedged calls for the generation pipeline.
+
+deadline_scope() binds a Deadline to the current context. Provider calls
+made under it cap their HTTP timeouts at the time left (clamp_timeout), and
+the governor neither queues nor backs off past it. Scopes nest: an inner
+scope never outlives the one around it. Work handed to another thread only
+sees the deadline if it runs in a copy of the caller's context.
+
+LatencyTracker keeps a rolling window of one call's recent latencies so
+the pipeline can budget with observed percentiles. hedged() and ahedged()
+send a second copy of a slow call once the first has run past a threshold
+(usually its p95) and take whichever answers first. Hedging at p95 costs
+about 5% more calls and cuts the tail those calls would otherwise set.
+"""
+import asyncio
+import contextvars
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from contextlib import contextmanager
+
+import httpx
+
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """The request's time budget ran out before a provider call could start"""
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+
+def remaining():
+    """Seconds left on the current deadline, or None outside any scope"""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline.remaining()
+
+
+def check():
+    if remaining() == 0.0:
+        raise DeadlineExceeded("Request deadline exceeded")
+
+
+@contextmanager
+def deadline_scope(seconds):
+    """Run the block under a deadline `seconds` from now (or the enclosing one, if sooner)"""
+    deadline = Deadline(seconds)
+    outer = _deadline.get()
+    if outer is not None and outer.expires_at < deadline.expires_at:
+        deadline = outer
+    token = _deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _deadline.reset(token)
+
+
+def clamp_timeout(timeout):
+    """An httpx.Timeout with each phase capped at the time left on the deadline"""
+    left = remaining()
+    if left is None:
+        return timeout
+    left = max(left, 0.001)  # zero would mean "no timeout" to some transports
+    return httpx.Timeout(
+        connect=min(timeout.connect, left),
+        read=min(timeout.read, left),
+        write=min(timeout.write, left),
+        pool=min(timeout.pool, left),
+    )
+
+
+class LatencyTracker:
+    """Rolling window of recent latencies (seconds) for one kind of call, per worker"""
+
+    def __init__(self, window=200, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q, default=None):
+        """The q-quantile of the window, or `default` until min_samples are in"""
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < self.min_samples:
+            return default
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def stats(self):
+        with self._lock:
+            count = len(self._samples)
+        p50, p95 = self.quantile(0.5), self.quantile(0.95)
+        return {
+            "samples": count,
+            "p50_seconds": round(p50, 3) if p50 is not None else None,
+            "p95_seconds": round(p95, 3) if p95 is not None else None,
+        }
+
+
+def hedged(call, hedge_after, timeout, executor):
+    """call()'s result, sending a second copy if the first is still running
+    after `hedge_after` seconds; the first non-None answer wins.
+
+    call() must return None rather than raise on failure. Returns
+    (result, hedged, timed_out); result is None when neither copy produced
+    one within `timeout`. A losing copy can't be cancelled and finishes in
+    the background, bounded by whatever deadline it runs under.
+    """
+    started = time.monotonic()
+    primary = executor.submit(contextvars.copy_context().run, call)
+    done, _ = wait([primary], timeout=min(hedge_after, timeout))
+    if done:
+        return primary.result(), False, False
+    if hedge_after >= timeout:
+        return None, False, True
+
+    pending = {primary, executor.submit(contextvars.copy_context().run, call)}
+    while pending:
+        done, pending = wait(pending, timeout=max(0.0, started + timeout - time.monotonic()),
+                             return_when=FIRST_COMPLETED)
+        if not done:
+            return None, True, True
+        for future in done:
+            result = future.result()
+            if result is not None:
+                return result, True, False
+    return None, True, False
+
+
+async def ahedged(make_call, hedge_after, timeout):
+    """hedged() for coroutines; make_call() returns a fresh coroutine per copy.
+    Copies still running when it returns are cancelled.
+    """
+    started = time.monotonic()
+    primary = asyncio.ensure_future(make_call())
+    pending = {primary}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=min(hedge_after, timeout))
+        if done:
+            return primary.result(), False, False
+        if hedge_after >= timeout:
+            return None, False, True
+
+        pending.add(asyncio.ensure_future(make_call()))
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=max(0.0, started + timeout - time.monotonic()),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                return None, True, True
+            for task in done:
+                result = task.result()
+                if result is not None:
+                    return result, True, False
+        return None, True, False
+    finally:
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,179 @@
+"""Output codecs: header probing and compressed delivery variants of generated images.
+
+probe() reads an image's real format and dimensions from its first bytes
+(PNG IHDR, JPEG SOF, WebP VP8/VP8L/VP8X chunks) without decoding pixels, so
+a Pro Image response is labelled with what Gemini actually sent rather than
+with the MIME type it declared.
+
+Pro Image returns multi-megabyte lossless PNGs, which is wasteful for
+display. negotiate() picks a delivery format from the client's Accept
+header (AVIF, then WebP, then progressive JPEG), acceptable() lists every
+one it allows, and transcode() encodes one under a byte target, stepping
+quality down until it fits. Each delivery variant is encoded once, in the
+background, and stored next to the original, which is kept untouched for
+exports.
+"""
+import io
+import struct
+import warnings
+
+from PIL import Image, features
+
+# format name -> (Pillow format, MIME type)
+DELIVERY_FORMATS = {
+    "avif": ("AVIF", "image/avif"),
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+}
+
+MIME_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp", "GIF": "image/gif", "AVIF": "image/avif"}
+
+MIN_QUALITY = 50
+QUALITY_STEP = 8
+
+
+def supported_formats():
+    """Delivery formats this Pillow build can encode, in order of preference"""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # Pillow without AVIF warns about an unknown feature
+        return [name for name in DELIVERY_FORMATS if name == "jpeg" or features.check(name)]
+
+
+class ImageInfo:
+    def __init__(self, fmt, width, height):
+        self.format = fmt
+        self.mime_type = MIME_TYPES.get(fmt, "application/octet-stream")
+        self.width = width
+        self.height = height
+
+
+def _probe_jpeg(data):
+    offset = 2
+    while offset + 4 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:  # fill byte
+            offset += 1
+            continue
+        if 0xD0 <= marker <= 0xD9 or marker == 0x01:  # standalone markers
+            offset += 2
+            continue
+        (length,) = struct.unpack(">H", data[offset + 2:offset + 4])
+        # SOF0-SOF15, except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            if offset + 9 > len(data):
+                return None
+            height, width = struct.unpack(">HH", data[offset + 5:offset + 9])
+            return ImageInfo("JPEG", width, height)
+        offset += 2 + length
+    return None
+
+
+def _probe_webp(data):
+    chunk = data[12:16]
+    if chunk == b"VP8 " and len(data) >= 30:
+        width, height = struct.unpack("<HH", data[26:30])
+        return ImageInfo("WEBP", width & 0x3FFF, height & 0x3FFF)
+    if chunk == b"VP8L" and len(data) >= 25:
+        (bits,) = struct.unpack("<I", data[21:25])
+        return ImageInfo("WEBP", (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1)
+    if chunk == b"VP8X" and len(data) >= 30:
+        width = int.from_bytes(data[24:27], "little") + 1
+        height = int.from_bytes(data[27:30], "little") + 1
+        return ImageInfo("WEBP", width, height)
+    return None
+
+
+def probe(data):
+    """ImageInfo (format, MIME type, width, height) from an image's header bytes, or None"""
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and data[12:16] == b"IHDR":
+        width, height = struct.unpack(">II", data[16:24])
+        return ImageInfo("PNG", width, height)
+    if data[:3] == b"\xff\xd8\xff":
+        return _probe_jpeg(data)
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return _probe_webp(data)
+    # Anything else: Pillow also stops at the header until pixels are asked for
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            return ImageInfo(img.format, img.width, img.height)
+    except Exception:
+        return None
+
+
+def _accept_qualities(accept):
+    """{media range: q} from an Accept header"""
+    qualities = {}
+    for item in (accept or "").split(","):
+        parts = [p.strip() for p in item.split(";")]
+        if not parts[0]:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        qualities[parts[0].lower()] = q
+    return qualities
+
+
+def acceptable(accept, formats):
+    """The delivery formats an Accept header allows, among `formats` (in
+    preference order), best first. AVIF and WebP must be listed by name;
+    JPEG is also taken from image/*. A bare */* allows none of them, so API
+    clients keep getting the original, as they always did.
+    """
+    qualities = _accept_qualities(accept)
+    allowed = []
+    for rank, name in enumerate(formats):
+        mime = DELIVERY_FORMATS[name][1]
+        q = qualities.get(mime)
+        if q is None and name == "jpeg":
+            q = qualities.get("image/*")
+        if q:
+            allowed.append((-q, rank, name))
+    return [name for _, _, name in sorted(allowed)]
+
+
+def negotiate(accept, formats):
+    """The best delivery format for an Accept header, or None to send the original"""
+    allowed = acceptable(accept, formats)
+    return allowed[0] if allowed else None
+
+
+def transcode(data, fmt, target_bytes, quality):
+    """(bytes, MIME type) of `data` re-encoded as a delivery format, at the
+    highest quality from `quality` down that fits `target_bytes`. Returns
+    the original if the encoding isn't smaller.
+    """
+    pil_format, mime_type = DELIVERY_FORMATS[fmt]
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    if pil_format == "JPEG" or "A" not in img.getbands():
+        if img.mode != "RGB":
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.getchannel("A"))
+    elif img.mode != "RGBA":
+        img = img.convert("RGBA")
+
+    while True:
+        buf = io.BytesIO()
+        if pil_format == "JPEG":
+            img.save(buf, "JPEG", quality=quality, optimize=True, progressive=True)
+        elif pil_format == "WEBP":
+            img.save(buf, "WEBP", quality=quality, method=4)
+        else:
+            img.save(buf, "AVIF", quality=quality, speed=8)
+        if buf.tell() <= target_bytes or quality <= MIN_QUALITY:
+            break
+        quality = max(MIN_QUALITY, quality - QUALITY_STEP)
+
+    encoded = buf.getvalue()
+    if len(encoded) >= len(data):
+        original = probe(data)
+        return data, original.mime_type if original else mime_type
+    return encoded, mime_type
@@ -0,0 +1,281 @@
+"""House design DNA measured from the rooms actually staged for a house.
+
+After each house-continuity generation, the staged image and the original
+photo are shrunk to the same small grid and compared pixel by pixel; what
+the generation left matching the photo (walls, floor, windows) is masked
+out, so only what it added (furniture, textiles, decor) is clustered. The
+colors are clustered with vectorized k-means in CIELAB, where distance
+tracks how different two colors look, and the clusters are merged into the
+house's running palette with every room weighted equally. The whole step
+takes a few tens of milliseconds, most of it decoding the generated image.
+
+The palette is described as the designDNA fields the continuity prompt
+uses (primaryColors, accentColors, woodTone), so later rooms are asked to
+match what earlier ones really rendered instead of per-style defaults.
+"""
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+try:
+    import fcntl
+except ImportError:  # Windows dev boxes: palette updates are then only safe within a worker
+    fcntl = None
+
+HOUSE_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+# Long edge of the grid the two images are compared and clustered on
+GRID_EDGE = 128
+CLUSTERS = 6
+KMEANS_ITERATIONS = 12
+# RGB distance past which a pixel counts as added by the generation
+CHANGE_THRESHOLD = 40.0
+# Below this share of changed pixels there is nothing staged to measure
+MIN_CHANGED_FRACTION = 0.02
+# Clusters closer than this (CIE76 delta E) are merged into one swatch
+MERGE_DELTA_E = 12.0
+MAX_SWATCHES = 12
+
+# Interior-design names for describing swatches in a prompt
+NAMED_COLORS = {
+    "white": (245, 245, 242), "warm white": (243, 236, 224), "ivory": (238, 232, 214),
+    "cream": (240, 228, 200), "beige": (214, 196, 168), "greige": (190, 180, 166),
+    "taupe": (150, 132, 116), "light gray": (200, 200, 200), "gray": (140, 140, 140),
+    "charcoal": (60, 62, 66), "black": (25, 25, 25), "navy": (32, 42, 78),
+    "dusty blue": (120, 146, 170), "slate blue": (90, 110, 140), "teal": (40, 120, 120),
+    "sage green": (156, 175, 136), "olive green": (110, 110, 60), "emerald green": (30, 110, 75),
+    "forest green": (40, 75, 50), "moss green": (120, 130, 80), "mustard yellow": (205, 165, 60),
+    "gold": (200, 160, 70), "champagne": (215, 195, 150), "terracotta": (190, 100, 70),
+    "rust": (165, 80, 45), "burnt orange": (200, 100, 40), "blush": (225, 185, 180),
+    "dusty rose": (190, 135, 135), "burgundy": (110, 30, 45), "plum": (100, 60, 90),
+    "camel": (190, 150, 100), "cognac": (150, 85, 45), "chocolate brown": (80, 50, 35),
+    "walnut": (110, 75, 50), "oak": (190, 150, 105), "pale oak": (215, 190, 150),
+    "espresso": (55, 40, 32),
+}
+
+
+# ============== COLOR ==============
+
+_SRGB_TO_XYZ = np.array([
+    [0.4124, 0.3576, 0.1805],
+    [0.2126, 0.7152, 0.0722],
+    [0.0193, 0.1192, 0.9505],
+])
+_WHITE = np.array([0.95047, 1.0, 1.08883])
+
+
+def rgb_to_lab(rgb):
+    """CIELAB (D65) for an (..., 3) array of 0-255 sRGB values"""
+    c = np.asarray(rgb, dtype=np.float64) / 255
+    linear = np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92)
+    xyz = linear @ _SRGB_TO_XYZ.T / _WHITE
+    f = np.where(xyz > 216 / 24389, np.cbrt(xyz), (24389 / 27 * xyz + 16) / 116)
+    return np.stack([116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+
+def lab_to_rgb(lab):
+    lab = np.asarray(lab, dtype=np.float64)
+    fy = (lab[..., 0] + 16) / 116
+    f = np.stack([fy + lab[..., 1] / 500, fy, fy - lab[..., 2] / 200], axis=-1)
+    xyz = np.where(f ** 3 > 216 / 24389, f ** 3, (116 * f - 16) / (24389 / 27)) * _WHITE
+    linear = np.clip(xyz @ np.linalg.inv(_SRGB_TO_XYZ).T, 0, 1)
+    c = np.where(linear > 0.0031308, 1.055 * linear ** (1 / 2.4) - 0.055, 12.92 * linear)
+    return np.round(c * 255).astype(int)
+
+
+_NAMES = list(NAMED_COLORS)
+_NAMED_LAB = rgb_to_lab(np.array([NAMED_COLORS[name] for name in _NAMES]))
+
+
+def color_name(lab):
+    return _NAMES[int(np.argmin(((_NAMED_LAB - lab) ** 2).sum(axis=1)))]
+
+
+def hex_color(lab):
+    return "#{:02X}{:02X}{:02X}".format(*lab_to_rgb(lab))
+
+
+# ============== EXTRACTION ==============
+
+def _grid(data, size=None):
+    """RGB array of an encoded image shrunk to `size` (or to GRID_EDGE on its long edge)"""
+    img = Image.open(io.BytesIO(data))
+    target = size or (max(1, round(GRID_EDGE * min(1.0, img.width / img.height))),
+                      max(1, round(GRID_EDGE * min(1.0, img.height / img.width))))
+    img.draft("RGB", target)
+    img = img.convert("RGB").resize(target, Image.BOX, reducing_gap=2.0)
+    # A little blur so small misalignments between the two don't read as changes
+    return np.asarray(img.filter(ImageFilter.BoxBlur(1)), dtype=np.float32)
+
+
+def kmeans(points, k=CLUSTERS, iterations=KMEANS_ITERATIONS, seed=0):
+    """(centers, counts) of points clustered with k-means++ seeding"""
+    rng = np.random.default_rng(seed)
+    centers = points[rng.integers(len(points))][None]
+    for _ in range(1, min(k, len(points))):
+        nearest = ((points[:, None, :] - centers[None]) ** 2).sum(axis=2).min(axis=1)
+        if not nearest.sum():
+            break
+        centers = np.vstack([centers, points[rng.choice(len(points), p=nearest / nearest.sum())]])
+
+    for _ in range(iterations):
+        labels = ((points[:, None, :] - centers[None]) ** 2).sum(axis=2).argmin(axis=1)
+        counts = np.bincount(labels, minlength=len(centers))
+        sums = np.stack([np.bincount(labels, weights=points[:, d], minlength=len(centers))
+                         for d in range(points.shape[1])], axis=1)
+        moved = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centers)
+        if np.allclose(moved, centers, atol=0.5):
+            centers = moved
+            break
+        centers = moved
+    labels = ((points[:, None, :] - centers[None]) ** 2).sum(axis=2).argmin(axis=1)
+    counts = np.bincount(labels, minlength=len(centers))
+    keep = counts > 0
+    return centers[keep], counts[keep]
+
+
+def extract_swatches(generated, original):
+    """Swatches ({"lab", "weight"}, weights summing to 1) of what a generation
+    added to the original photo, or [] if it changed almost nothing. Both
+    arguments are encoded image bytes.
+    """
+    staged = _grid(generated)
+    photo = _grid(original, size=(staged.shape[1], staged.shape[0]))
+    changed = np.sqrt(((staged - photo) ** 2).sum(axis=2)) > CHANGE_THRESHOLD
+    if changed.mean() < MIN_CHANGED_FRACTION:
+        return []
+    centers, counts = kmeans(rgb_to_lab(staged[changed]))
+    weights = counts / counts.sum()
+    return [{"lab": [round(float(v), 2) for v in center], "weight": round(float(weight), 4)}
+            for center, weight in sorted(zip(centers, weights), key=lambda cw: -cw[1])]
+
+
+def merge_swatches(palette, swatches, max_swatches=MAX_SWATCHES, merge_delta_e=MERGE_DELTA_E):
+    """A running palette with one more room's swatches folded in"""
+    merged = [dict(s) for s in palette] + [dict(s) for s in swatches]
+    while len(merged) > 1:
+        lab = np.array([s["lab"] for s in merged])
+        distances = np.sqrt(((lab[:, None, :] - lab[None]) ** 2).sum(axis=2))
+        np.fill_diagonal(distances, np.inf)
+        i, j = np.unravel_index(np.argmin(distances), distances.shape)
+        if distances[i, j] > merge_delta_e and len(merged) <= max_swatches:
+            break
+        a, b = merged[i], merged[j]
+        weight = a["weight"] + b["weight"]
+        lab = (np.array(a["lab"]) * a["weight"] + np.array(b["lab"]) * b["weight"]) / weight
+        merged = [s for k, s in enumerate(merged) if k not in (i, j)]
+        merged.append({"lab": [round(float(v), 2) for v in lab], "weight": round(weight, 4)})
+    return sorted(merged, key=lambda s: -s["weight"])
+
+
+def _describe(swatch):
+    return f"{color_name(swatch['lab'])} ({hex_color(swatch['lab'])})"
+
+
+def _chroma(swatch):
+    return float(np.hypot(swatch["lab"][1], swatch["lab"][2]))
+
+
+def _is_wood(swatch):
+    lightness, a, b = swatch["lab"]
+    hue = np.degrees(np.arctan2(b, a))
+    return 25 <= lightness <= 75 and 40 <= hue <= 80 and 12 <= _chroma(swatch) <= 45
+
+
+def describe(palette):
+    """designDNA fields for a palette; woodTone only when a wood-like swatch is present"""
+    primary = palette[:3]
+    rest = palette[3:]
+    accents = [s for s in rest if _chroma(s) >= 20][:3] or rest[:2]
+    dna = {
+        "primaryColors": ", ".join(_describe(s) for s in primary),
+        "accentColors": ", ".join(_describe(s) for s in accents),
+    }
+    wood = next((s for s in palette if _is_wood(s)), None)
+    if wood is not None:
+        shade = "Light" if wood["lab"][0] > 60 else "Medium" if wood["lab"][0] > 42 else "Dark"
+        dna["woodTone"] = f"{shade} wood close to {_describe(wood)}"
+    return {k: v for k, v in dna.items() if v}
+
+
+# ============== HOUSE PALETTES ==============
+
+class HousePalettes:
+    """Running palette per house, on disk so every worker on the host shares it"""
+
+    # Artifacts remembered per house, so a replayed or coalesced result isn't merged twice
+    RECENT_ARTIFACTS = 200
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._counters = {"rooms_merged": 0, "duplicates": 0, "nothing_staged": 0}
+
+    def get(self, house_id):
+        """{"rooms", "swatches", ...} for a house, or None if nothing was merged yet"""
+        if not HOUSE_ID.match(house_id or ""):
+            return None
+        try:
+            with open(self._path(house_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+    def add_room(self, house_id, artifact_id, swatches):
+        """Merge one staged room's swatches into the house palette; returns the palette"""
+        if not HOUSE_ID.match(house_id or ""):
+            return None
+        if not swatches:
+            self._count("nothing_staged")
+            return self.get(house_id)
+
+        os.makedirs(self.directory, exist_ok=True)
+        with self._house_lock(house_id):
+            palette = self.get(house_id) or {"rooms": 0, "swatches": [], "artifacts": []}
+            if artifact_id in palette["artifacts"]:
+                self._count("duplicates")
+                return palette
+            palette["swatches"] = merge_swatches(palette["swatches"], swatches)
+            palette["rooms"] += 1
+            palette["artifacts"] = (palette["artifacts"] + [artifact_id])[-self.RECENT_ARTIFACTS:]
+            palette["updated_at"] = time.time()
+
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(palette, f)
+            os.replace(tmp_path, self._path(house_id))
+        self._count("rooms_merged")
+        return palette
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _path(self, house_id):
+        return os.path.join(self.directory, f"{house_id}.json")
+
+    @contextmanager
+    def _house_lock(self, house_id):
+        if fcntl is None:
+            with self._write_lock:
+                yield
+            return
+        with open(os.path.join(self.directory, f"{house_id}.lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
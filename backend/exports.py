@@ -0,0 +1,192 @@
+"""Export derivatives of stored artifacts (4K, MLS sizes, JPEG/PNG/WebP).
+
+Each derivative is rendered once, stored back into the artifact store and
+remembered under (artifact, format, size, quality). Concurrent requests for
+the same derivative are coalesced: threads in a worker share an in-process
+lock and workers on the host share an flock, so only one of them renders
+and the rest pick up its result.
+
+Downscales do as little full-size work as they can: a JPEG source is
+decoded at a reduced DCT scale (1/2 to 1/8) that still covers the target,
+a large remaining factor is box-reduced by an integer step first, and the
+Lanczos pass runs in horizontal strips. PNG sources, which is what Pro
+Image returns, are still decoded whole; Pillow can't decode them a band at
+a time.
+"""
+import io
+import os
+import threading
+from contextlib import contextmanager
+
+from PIL import Image
+
+try:
+    import fcntl
+except ImportError:  # Windows dev boxes: fall back to in-process coalescing only
+    fcntl = None
+
+# format name -> (Pillow format, MIME type, file extension)
+EXPORT_FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg", "jpg"),
+    "png": ("PNG", "image/png", "png"),
+    "webp": ("WEBP", "image/webp", "webp"),
+}
+
+# size name -> long edge in pixels (None keeps the generated size)
+EXPORT_SIZES = {
+    "original": None,
+    "4k": 3840,
+    "mls": 2048,
+    "mls_small": 1024,
+}
+
+DEFAULT_QUALITY = 92
+STRIP_HEIGHT = 256
+
+
+class ExportError(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def parse_export_options(fmt, size, quality):
+    fmt = (fmt or "png").lower()
+    if fmt == "jpg":
+        fmt = "jpeg"
+    if fmt not in EXPORT_FORMATS:
+        raise ExportError(f"Unsupported format '{fmt}' (use {', '.join(EXPORT_FORMATS)})")
+    size = (size or "original").lower()
+    if size not in EXPORT_SIZES:
+        raise ExportError(f"Unsupported size '{size}' (use {', '.join(EXPORT_SIZES)})")
+    try:
+        quality = int(quality) if quality else DEFAULT_QUALITY
+    except ValueError:
+        raise ExportError("quality must be an integer")
+    if not 50 <= quality <= 100:
+        raise ExportError("quality must be between 50 and 100")
+    if fmt == "png":
+        quality = None  # lossless; keep it out of the cache key
+    return fmt, size, quality
+
+
+def variant_name(fmt, size, quality):
+    return f"{fmt}-{size}" + (f"-q{quality}" if quality else "")
+
+
+def export_size(size, long_edge):
+    """Target (width, height) for a source of `size` scaled to `long_edge`"""
+    width, height = size
+    ratio = width / height
+    if ratio >= 1:
+        return long_edge, max(1, round(long_edge / ratio))
+    return max(1, round(long_edge * ratio)), long_edge
+
+
+def resize_in_strips(img, target_size, strip_height=STRIP_HEIGHT):
+    """Lanczos resize, rendered a band of output rows at a time.
+
+    Past twice the target, the source is first box-reduced by an integer
+    factor (like Pillow's reducing_gap), so Lanczos never spans huge kernels.
+    """
+    factor = min(img.width // target_size[0], img.height // target_size[1]) // 2
+    if factor >= 2:
+        img = img.reduce(factor)
+    src_w, src_h = img.size
+    dst_w, dst_h = target_size
+    scale_y = src_h / dst_h
+    out = Image.new(img.mode, target_size)
+    for top in range(0, dst_h, strip_height):
+        bottom = min(dst_h, top + strip_height)
+        box = (0, top * scale_y, src_w, bottom * scale_y)
+        out.paste(img.resize((dst_w, bottom - top), Image.LANCZOS, box=box), (0, top))
+    return out
+
+
+def render_export(data, fmt, size, quality):
+    pil_format, _, _ = EXPORT_FORMATS[fmt]
+    img = Image.open(io.BytesIO(data))
+
+    long_edge = EXPORT_SIZES[size]
+    target = export_size(img.size, long_edge) if long_edge else img.size
+    if target != img.size:
+        # A no-op for anything but JPEG; may leave the size anywhere between
+        # the source's and the target's
+        img.draft(img.mode, target)
+    img.load()
+    if target != img.size:
+        img = resize_in_strips(img, target)
+
+    if pil_format == "JPEG" and img.mode != "RGB":
+        # Same as the old canvas export: transparent areas become white
+        rgba = img.convert("RGBA")
+        img = Image.new("RGB", rgba.size, (255, 255, 255))
+        img.paste(rgba, mask=rgba.getchannel("A"))
+
+    buf = io.BytesIO()
+    if pil_format == "JPEG":
+        img.save(buf, "JPEG", quality=quality, optimize=True, progressive=True, subsampling=0 if quality >= 90 else 2)
+    elif pil_format == "WEBP":
+        img.save(buf, "WEBP", quality=quality, method=4)
+    else:
+        img.save(buf, "PNG", optimize=False, compress_level=6)
+    return buf.getvalue()
+
+
+class ExportService:
+    def __init__(self, store):
+        self.store = store
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+
+    def get_or_create(self, artifact_id, fmt, size, quality):
+        """Return the derivative's artifact id, rendering it at most once."""
+        return self.derive(artifact_id, variant_name(fmt, size, quality),
+                           lambda data: (render_export(data, fmt, size, quality), EXPORT_FORMATS[fmt][1]))
+
+    def derive(self, artifact_id, variant, render):
+        """Artifact id of the named variant, stored from render(source bytes) ->
+        (bytes, MIME type) the first time anyone asks for it.
+        """
+        existing = self.store.get_variant(artifact_id, variant)
+        if existing:
+            return existing
+
+        with self._coalesce(f"{artifact_id}-{variant}"):
+            # Whoever held the lock before us may have rendered it already
+            existing = self.store.get_variant(artifact_id, variant)
+            if existing:
+                return existing
+
+            data = self.store.read(artifact_id)
+            if data is None:
+                raise ExportError("Artifact not found", 404)
+            rendered, mime_type = render(data)
+            derivative_id = self.store.put(rendered, mime_type, source=artifact_id, variant=variant)
+            self.store.set_variant(artifact_id, variant, derivative_id)
+            return derivative_id
+
+    @contextmanager
+    def _coalesce(self, key):
+        with self._locks_guard:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                if fcntl is None:
+                    yield
+                    return
+                lock_dir = os.path.join(self.store.directory, "locks")
+                os.makedirs(lock_dir, exist_ok=True)
+                with open(os.path.join(lock_dir, f"{key}.lock"), "w") as f:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    try:
+                        yield
+                    finally:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+        finally:
+            with self._locks_guard:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
@@ -0,0 +1,178 @@
+"""Optional Gemini Files API references for room photos.
+
+With GEMINI_FILE_UPLOADS on, a photo is uploaded to the Files API once and
+then referenced by `fileData` URI: scene analysis, generation and every
+restyle of the same room share that one upload instead of each inlining
+the image. URIs are remembered per image digest in a host-wide JSON cache
+until shortly before the provider's expirationTime. A miss uploads again,
+as does a request the provider rejects because the file is gone. A failed
+upload falls back to inline bytes for that request.
+"""
+import asyncio
+import calendar
+import threading
+import time
+
+import metrics
+from analysis_cache import image_digest
+from providers import (
+    Base64Bytes,
+    gemini_generate,
+    gemini_generate_async,
+    gemini_upload_file,
+    gemini_upload_file_async,
+)
+
+# The Files API keeps uploads for 48 hours
+DEFAULT_FILE_TTL_SECONDS = 48 * 3600
+# Statuses Gemini answers with when a referenced file has expired or was deleted
+MISSING_FILE_STATUSES = (403, 404)
+
+
+def inline_part(image):
+    return {"inlineData": {"mimeType": image.mime_type, "data": Base64Bytes(image.data)}}
+
+
+def _parse_expiry(value):
+    """Epoch seconds from an RFC 3339 timestamp such as 2025-01-01T00:00:00.123456789Z"""
+    try:
+        return calendar.timegm(time.strptime(value[:19], "%Y-%m-%dT%H:%M:%S"))
+    except (TypeError, ValueError):
+        return None
+
+
+class GeminiFiles:
+    def __init__(self, cache, enabled=False, expiry_margin=600):
+        """`cache` is an AnalysisCache holding digest -> file entries; its TTL
+        should not exceed the provider's file lifetime. Entries closer than
+        `expiry_margin` seconds to expiring are treated as misses, so a file
+        doesn't vanish during a long generation.
+        """
+        self.cache = cache
+        self.enabled = enabled
+        self.expiry_margin = expiry_margin
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self._counters = {"uploads": 0, "reused": 0, "upload_failures": 0, "reuploads": 0}
+        self._counters_lock = threading.Lock()
+
+    def part(self, image, gemini_key):
+        """The `parts` entry carrying the photo: a file reference, or inline bytes"""
+        if not self.enabled:
+            return inline_part(image)
+        digest = image_digest(image.data)
+        entry = self._lookup(digest)
+        if entry is None:
+            # One upload per photo per worker, however many requests want it
+            with self._lock_for(digest):
+                entry = self._lookup(digest)
+                if entry is None:
+                    with metrics.stage("file_upload"):
+                        response = self._upload(lambda: gemini_upload_file(
+                            image.data, image.mime_type, gemini_key, display_name=digest))
+                    entry = self._remember(digest, response)
+        return self._file_part(image, entry)
+
+    async def apart(self, image, gemini_key):
+        if not self.enabled:
+            return inline_part(image)
+        digest = image_digest(image.data)
+        # The cache is on disk; keep its reads and writes off the event loop
+        entry = await asyncio.to_thread(self._lookup, digest)
+        if entry is None:
+            with metrics.stage("file_upload"):
+                response = await self._aupload(lambda: gemini_upload_file_async(
+                    image.data, image.mime_type, gemini_key, display_name=digest))
+            entry = await asyncio.to_thread(self._remember, digest, response)
+        return self._file_part(image, entry)
+
+    def generate(self, model, image, build_payload, gemini_key, endpoint):
+        """gemini_generate for build_payload(image part); a file the provider no
+        longer has is uploaded again and the request resent once.
+        """
+        part = self.part(image, gemini_key)
+        response = gemini_generate(model, build_payload(part), gemini_key, endpoint)
+        if self._file_missing(part, response):
+            self._forget(image)
+            response = gemini_generate(model, build_payload(self.part(image, gemini_key)), gemini_key, endpoint)
+        return response
+
+    async def agenerate(self, model, image, build_payload, gemini_key, endpoint):
+        part = await self.apart(image, gemini_key)
+        response = await gemini_generate_async(model, build_payload(part), gemini_key, endpoint)
+        if self._file_missing(part, response):
+            await asyncio.to_thread(self._forget, image)
+            part = await self.apart(image, gemini_key)
+            response = await gemini_generate_async(model, build_payload(part), gemini_key, endpoint)
+        return response
+
+    def stats(self):
+        with self._counters_lock:
+            stats = dict(self._counters)
+        stats["enabled"] = self.enabled
+        return stats
+
+    def _lookup(self, digest):
+        entry = self.cache.get(digest)
+        if entry is None:
+            return None
+        if entry["expires_at"] - self.expiry_margin <= time.time():
+            return None
+        self._count("reused")
+        return entry
+
+    def _upload(self, send):
+        try:
+            return send()
+        except Exception as e:
+            return e
+
+    async def _aupload(self, send):
+        try:
+            return await send()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            return e
+
+    def _remember(self, digest, response):
+        """Cache the uploaded file's entry; None (inline fallback) if the upload failed"""
+        if isinstance(response, Exception) or response.status_code != 200:
+            self._count("upload_failures")
+            return None
+        file = response.json().get("file", {})
+        if not file.get("uri"):
+            self._count("upload_failures")
+            return None
+        entry = {
+            "uri": file["uri"],
+            "name": file.get("name"),
+            "expires_at": _parse_expiry(file.get("expirationTime")) or time.time() + DEFAULT_FILE_TTL_SECONDS,
+        }
+        self.cache.set(digest, entry)
+        self._count("uploads")
+        return entry
+
+    def _forget(self, image):
+        # Overwrite rather than delete: the cache has no delete, and an
+        # already-expired entry reads as a miss everywhere on the host
+        self.cache.set(image_digest(image.data), {"uri": None, "expires_at": 0})
+        self._count("reuploads")
+
+    def _file_missing(self, part, response):
+        return "fileData" in part and response.status_code in MISSING_FILE_STATUSES
+
+    def _file_part(self, image, entry):
+        if entry is None:
+            return inline_part(image)
+        return {"fileData": {"mimeType": image.mime_type, "fileUri": entry["uri"]}}
+
+    def _lock_for(self, digest):
+        with self._locks_guard:
+            if len(self._locks) > 1024:
+                self._locks.clear()
+            return self._locks.setdefault(digest, threading.Lock())
+
+    def _count(self, name):
+        with self._counters_lock:
+            self._counters[name] += 1
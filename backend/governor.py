@@ -0,0 +1,430 @@
+"""Outbound governor for provider calls.
+
+Each provider model gets a lane with a token bucket (requests per minute
+plus a burst allowance) and a circuit breaker. Callers queue for a token
+for at most `max_wait` seconds, retryable failures are retried with full
+jitter backoff (or the provider's Retry-After, which also pauses the whole
+lane), and once a model keeps failing its breaker opens and further calls
+fail fast until a probe succeeds.
+
+Every entry point has an async twin (aadmit, acall, aguard) for the ASGI
+handlers; both share the same lanes, so a worker's limits hold regardless of
+which side makes the call.
+
+Under a request deadline (deadlines.py) a call neither queues for a token
+nor backs off for a retry past the time left, and an attempt is not started
+once it has run out.
+
+Calls for which `deferred()` returns true (bulk work, see scheduler.py)
+yield to everyone else: instead of queueing for a token they wait until one
+is free beyond `headroom`, so other calls never queue behind them. They may
+wait up to `deferred_max_wait` instead of `max_wait`.
+
+Limits are per worker process; divide the provider quota by the number of
+workers when configuring them.
+"""
+import asyncio
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import deadlines
+
+# Requests per minute and burst per model, overridable via PROVIDER_RATE_LIMITS
+DEFAULT_LIMITS = {
+    "gemini-3-pro-image-preview": {"rpm": 20, "burst": 5},
+    "gemini-3-flash-preview": {"rpm": 120, "burst": 20},
+    "claude-sonnet-4-20250514": {"rpm": 50, "burst": 10},
+}
+FALLBACK_LIMIT = {"rpm": 60, "burst": 10}
+
+
+class ProviderUnavailable(Exception):
+    def __init__(self, message, status_code=503, retry_after=None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class Outcome:
+    """How one attempt went: retry it? after how long? does it count against the breaker?"""
+
+    def __init__(self, retryable=False, retry_after=None, failure=False):
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.failure = failure
+
+
+class TokenBucket:
+    def __init__(self, rpm, burst):
+        self.rate = rpm / 60.0
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.waiting = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait):
+        """Claim the next token; returns how long the caller must wait for it.
+
+        Tokens may go negative: each reservation queues behind the ones
+        before it, so callers are served in order without a wakeup scheme.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            ready_at = max(self.paused_until, now + max(0.0, 1 - self.tokens) / self.rate)
+            if ready_at - now > max_wait:
+                # Can't be served in time; say so now instead of at the deadline
+                raise ProviderUnavailable("Provider is busy, try again shortly", 429,
+                                          retry_after=max(1, round(ready_at - now)))
+            self.tokens -= 1
+            return ready_at - now
+
+    def reserve_deferred(self, headroom):
+        """Take a token if one is free beyond `headroom` tokens and nothing is
+        queued; otherwise returns the seconds until that may be the case.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            needed = 1 + min(headroom, self.capacity - 1)
+            wait = max(self.paused_until - now, (needed - self.tokens) / self.rate)
+            if wait <= 0:
+                self.tokens -= 1
+                return 0.0
+            return wait
+
+    def _deferred_wait(self, started, wait, max_wait):
+        if time.monotonic() - started + wait > max_wait:
+            raise ProviderUnavailable("Provider is busy, try again shortly", 429, retry_after=max(1, round(wait)))
+        return wait
+
+    def acquire_deferred(self, max_wait, headroom):
+        """acquire() for deferred calls; each wakeup re-checks, so other
+        callers taking the tokens meanwhile push this one back
+        """
+        started = time.monotonic()
+        self._track_waiting(1)
+        try:
+            while (wait := self.reserve_deferred(headroom)) > 0:
+                time.sleep(self._deferred_wait(started, wait, max_wait))
+        finally:
+            self._track_waiting(-1)
+        return time.monotonic() - started
+
+    async def aacquire_deferred(self, max_wait, headroom):
+        started = time.monotonic()
+        self._track_waiting(1)
+        try:
+            while (wait := self.reserve_deferred(headroom)) > 0:
+                await asyncio.sleep(self._deferred_wait(started, wait, max_wait))
+        finally:
+            self._track_waiting(-1)
+        return time.monotonic() - started
+
+    def acquire(self, max_wait):
+        """Take a token, sleeping up to max_wait seconds; returns the time waited."""
+        delay = self.reserve(max_wait)
+        if delay > 0:
+            self._track_waiting(1)
+            try:
+                time.sleep(delay)
+            finally:
+                self._track_waiting(-1)
+        return delay
+
+    async def aacquire(self, max_wait):
+        delay = self.reserve(max_wait)
+        if delay > 0:
+            self._track_waiting(1)
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self._track_waiting(-1)
+        return delay
+
+    def pause(self, seconds):
+        """Hold every caller back, e.g. after a 429 with Retry-After."""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def _track_waiting(self, delta):
+        with self._lock:
+            self.waiting += delta
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_seconds=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probe_in_flight:
+                # Let exactly one request find out whether the provider recovered
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def retry_after(self):
+        with self._lock:
+            return max(1, round(self.reset_seconds - (time.monotonic() - self.opened_at)))
+
+    def release_probe(self):
+        """The admitted probe never reached the provider; let another one try."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record(self, failure):
+        with self._lock:
+            self._probe_in_flight = False
+            if not failure:
+                self.state = "closed"
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+class Lane:
+    def __init__(self, name, rpm, burst, failure_threshold, reset_seconds):
+        self.name = name
+        self.bucket = TokenBucket(rpm, burst)
+        self.breaker = CircuitBreaker(failure_threshold, reset_seconds)
+        self._lock = threading.Lock()
+        self.counters = {
+            "calls": 0,
+            "retries": 0,
+            "rejected_busy": 0,
+            "rejected_open": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+        }
+
+    def admit(self, max_wait, headroom=None):
+        """Take a token; with `headroom`, as a deferred call"""
+        self._check_breaker()
+        try:
+            if headroom is None:
+                waited = self.bucket.acquire(max_wait)
+            else:
+                waited = self.bucket.acquire_deferred(max_wait, headroom)
+        except ProviderUnavailable:
+            self.breaker.release_probe()
+            self.count("rejected_busy")
+            raise
+        self._record_wait(waited)
+
+    async def aadmit(self, max_wait, headroom=None):
+        self._check_breaker()
+        try:
+            if headroom is None:
+                waited = await self.bucket.aacquire(max_wait)
+            else:
+                waited = await self.bucket.aacquire_deferred(max_wait, headroom)
+        except ProviderUnavailable:
+            self.breaker.release_probe()
+            self.count("rejected_busy")
+            raise
+        except asyncio.CancelledError:
+            self.breaker.release_probe()
+            raise
+        self._record_wait(waited)
+
+    def _check_breaker(self):
+        if not self.breaker.allow():
+            self.count("rejected_open")
+            raise ProviderUnavailable(f"{self.name} is temporarily unavailable", 503,
+                                      retry_after=self.breaker.retry_after())
+
+    def _record_wait(self, waited):
+        with self._lock:
+            self.counters["calls"] += 1
+            self.counters["wait_seconds_total"] += waited
+            self.counters["wait_seconds_max"] = max(self.counters["wait_seconds_max"], waited)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats["wait_seconds_total"] = round(stats["wait_seconds_total"], 3)
+        stats["wait_seconds_max"] = round(stats["wait_seconds_max"], 3)
+        stats["queue_depth"] = self.bucket.waiting
+        stats["circuit"] = self.breaker.state
+        return stats
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+
+class Governor:
+    def __init__(self, limits=None, max_wait=10.0, max_retries=2, base_backoff=0.5,
+                 max_backoff=8.0, failure_threshold=5, reset_seconds=30.0,
+                 deferred=None, deferred_max_wait=60.0, headroom=1):
+        self.limits = {**DEFAULT_LIMITS, **(limits or {})}
+        self.max_wait = max_wait
+        self.deferred = deferred
+        self.deferred_max_wait = deferred_max_wait
+        self.headroom = headroom
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lanes = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """Forget every lane and its state, e.g. in a forked child whose
+        inherited locks may have been held by a parent thread
+        """
+        self._lock = threading.Lock()
+        self._lanes = {}
+
+    def lane(self, name):
+        with self._lock:
+            lane = self._lanes.get(name)
+            if lane is None:
+                limit = self.limits.get(name, FALLBACK_LIMIT)
+                lane = self._lanes[name] = Lane(name, limit["rpm"], limit["burst"],
+                                                self.failure_threshold, self.reset_seconds)
+            return lane
+
+    def call(self, name, send, classify):
+        """Run send() under the lane's limits, retrying per classify(result, error).
+
+        The last response is returned (or the last exception re-raised) once
+        retries run out, so callers keep their usual error handling.
+        """
+        lane = self.lane(name)
+        attempt = 0
+        while True:
+            deadlines.check()
+            lane.admit(*self._admission())
+            result, error = None, None
+            try:
+                result = send()
+            except Exception as e:
+                error = e
+            delay = self._retry_delay(lane, attempt, classify(result, error))
+            if delay is None:
+                if error is not None:
+                    raise error
+                return result
+            attempt += 1
+            time.sleep(delay)
+
+    async def acall(self, name, send, classify):
+        """call() for coroutine functions"""
+        lane = self.lane(name)
+        attempt = 0
+        while True:
+            deadlines.check()
+            await lane.aadmit(*self._admission())
+            result, error = None, None
+            try:
+                result = await send()
+            except asyncio.CancelledError:
+                lane.breaker.release_probe()
+                raise
+            except Exception as e:
+                error = e
+            delay = self._retry_delay(lane, attempt, classify(result, error))
+            if delay is None:
+                if error is not None:
+                    raise error
+                return result
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def _admission(self):
+        """(max_wait, headroom) arguments for Lane.admit() in the current context"""
+        max_wait, headroom = self.max_wait, None
+        if self.deferred is not None and self.deferred():
+            max_wait, headroom = self.deferred_max_wait, self.headroom
+        left = deadlines.remaining()
+        return (max_wait if left is None else min(max_wait, left)), headroom
+
+    def _retry_delay(self, lane, attempt, outcome):
+        """Record the attempt; seconds to wait before retrying, or None to give up."""
+        lane.breaker.record(outcome.failure)
+        if not outcome.retryable or attempt >= self.max_retries:
+            return None
+
+        if outcome.retry_after is not None:
+            lane.bucket.pause(outcome.retry_after)
+            delay = outcome.retry_after + random.uniform(0, self.base_backoff)
+        else:
+            delay = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+        if delay > self.max_backoff:
+            # Provider asked for a longer pause than we're willing to hold the request
+            return None
+        left = deadlines.remaining()
+        if left is not None and delay >= left:
+            return None
+        lane.count("retries")
+        return delay
+
+    @contextmanager
+    def guard(self, name, classify):
+        """Admission and breaker bookkeeping for calls that can't be retried, like streams."""
+        lane = self.lane(name)
+        deadlines.check()
+        lane.admit(*self._admission())
+        try:
+            yield
+        except GeneratorExit:
+            # Client went away mid-stream; says nothing about the provider
+            lane.breaker.release_probe()
+            raise
+        except Exception as e:
+            lane.breaker.record(classify(None, e).failure)
+            raise
+        lane.breaker.record(False)
+
+    @asynccontextmanager
+    async def aguard(self, name, classify):
+        lane = self.lane(name)
+        deadlines.check()
+        await lane.aadmit(*self._admission())
+        try:
+            yield
+        except (GeneratorExit, asyncio.CancelledError):
+            lane.breaker.release_probe()
+            raise
+        except Exception as e:
+            lane.breaker.record(classify(None, e).failure)
+            raise
+        lane.breaker.record(False)
+
+    def stats(self):
+        with self._lock:
+            lanes = list(self._lanes.values())
+        return {lane.name: lane.stats() for lane in lanes}
+
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header (delta-seconds form only)."""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
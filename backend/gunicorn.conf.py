@@ -0,0 +1,35 @@
+# Gunicorn settings for the backend (gunicorn -c gunicorn.conf.py main:app).
+# For the async serving mode (see asgi.py) run
+#   gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app
+import os
+import shutil
+import tempfile
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", 2))
+
+# Threaded workers so job polls and SSE streams don't each pin a process;
+# -k (or GUNICORN_WORKER_CLASS) overrides it for the ASGI app
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+
+# Synchronous /generate-image can still take analysis + generation time
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 200))
+graceful_timeout = 30
+keepalive = 5
+
+# Prometheus multiprocess mode: each worker writes its samples here and
+# /metrics sums them. Must be set before workers import prometheus_client.
+state_dir = os.getenv("STATE_DIR", os.path.join(tempfile.gettempdir(), "estate-stage-pro"))
+prometheus_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(state_dir, "prometheus"))
+
+
+def on_starting(server):
+    # Samples from a previous run would otherwise be summed into this one
+    shutil.rmtree(prometheus_dir, ignore_errors=True)
+    os.makedirs(prometheus_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,155 @@
+"""Upload normalization shared by every endpoint that takes a room photo.
+
+The format is sniffed from the file's magic bytes (never the filename), the
+photo is decoded at reduced scale where the codec allows it, rotated per its
+EXIF orientation, downscaled to the largest edge the models benefit from and
+re-encoded as a metadata-free JPEG within a byte budget. Its perceptual hash
+is taken on the way, for the near-duplicate index.
+
+Uploads are size-checked before they are decoded, and may be passed as the
+spooled file the multipart parser wrote rather than as bytes, so the raw
+photo never has to be held in memory.
+"""
+import io
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from metrics import timed
+from phash import phash
+
+MAX_EDGE = int(os.getenv("UPLOAD_MAX_EDGE", 2048))
+TARGET_BYTES = int(os.getenv("UPLOAD_TARGET_KB", 1024)) * 1024
+JPEG_QUALITY = int(os.getenv("UPLOAD_JPEG_QUALITY", 90))
+MIN_JPEG_QUALITY = 60
+MAX_UPLOAD_BYTES = int(os.getenv("UPLOAD_MAX_MB", 25)) * 1024 * 1024
+# Multipart file parts past this size are spooled to a temporary file
+SPOOL_BYTES = int(os.getenv("UPLOAD_SPOOL_KB", 512)) * 1024
+# Room for the other form fields and the multipart framing around the photo
+FORM_OVERHEAD_BYTES = 64 * 1024
+
+# EXIF orientations that swap width and height
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+_ORIENTATION_TAG = 0x0112
+
+
+class UploadError(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+@dataclass
+class IngestedImage:
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+    original_width: int
+    original_height: int
+    original_format: str
+    original_bytes: int
+    # Perceptual hash (phash.py); None for uploads stored before it was computed
+    phash: Optional[int] = None
+
+    def dimensions(self):
+        return {
+            "width": self.width,
+            "height": self.height,
+            "original_width": self.original_width,
+            "original_height": self.original_height,
+        }
+
+
+def _too_large():
+    return UploadError(f"Image exceeds the {MAX_UPLOAD_BYTES // (1024 * 1024)} MB upload limit", 413)
+
+
+def check_request_length(content_length):
+    """Reject a single-photo request by its Content-Length, before the body is read"""
+    if content_length and content_length > MAX_UPLOAD_BYTES + FORM_OVERHEAD_BYTES:
+        raise _too_large()
+
+
+def _open_source(source):
+    """(seekable file, size in bytes) for raw bytes or an uploaded file"""
+    if isinstance(source, (bytes, bytearray)):
+        return io.BytesIO(source), len(source)
+    source.seek(0, os.SEEK_END)
+    size = source.tell()
+    source.seek(0)
+    return source, size
+
+
+def _target_size(width, height, max_edge):
+    scale = min(1.0, max_edge / max(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _encode_jpeg(img, target_bytes):
+    quality = JPEG_QUALITY
+    while True:
+        buf = io.BytesIO()
+        # No exif= argument, so nothing from the original metadata survives
+        img.save(buf, "JPEG", quality=quality, optimize=True, progressive=True)
+        if buf.tell() <= target_bytes or quality <= MIN_JPEG_QUALITY:
+            return buf.getvalue()
+        quality -= 10
+
+
+@timed("normalize")
+def ingest_image(source, max_edge=None, target_bytes=None):
+    """Normalize upload bytes or a binary file into an IngestedImage; raises UploadError."""
+    max_edge = max_edge or MAX_EDGE
+    target_bytes = target_bytes or TARGET_BYTES
+    fp, size = _open_source(source)
+    if not size:
+        raise UploadError("Empty image upload")
+    if size > MAX_UPLOAD_BYTES:
+        raise _too_large()
+
+    try:
+        img = Image.open(fp)
+        original_format = img.format
+        width, height = img.size
+        orientation = img.getexif().get(_ORIENTATION_TAG, 1)
+        if orientation in _TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+
+        if original_format == "JPEG":
+            # Let libjpeg decode at 1/2, 1/4 or 1/8 scale when that still
+            # covers the target size; much cheaper than a full decode + resize.
+            draft_size = _target_size(img.size[0], img.size[1], max_edge)
+            img.draft("RGB", draft_size)
+
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.getchannel("A"))
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+
+        data = _encode_jpeg(img, target_bytes)
+        fingerprint = phash(img)
+    except Image.DecompressionBombError:
+        raise UploadError("Image is too large to process", 413)
+    except (UnidentifiedImageError, OSError, ValueError, SyntaxError):
+        raise UploadError("Unsupported or corrupt image")
+
+    return IngestedImage(
+        data=data,
+        mime_type="image/jpeg",
+        width=img.size[0],
+        height=img.size[1],
+        original_width=width,
+        original_height=height,
+        original_format=original_format,
+        original_bytes=size,
+        phash=fingerprint,
+    )
@@ -0,0 +1,208 @@
+"""Background job execution for long-running generations.
+
+Job records are JSON files in a directory shared by every gunicorn worker, so
+a poll or event stream can land on any worker regardless of which one is
+running the job. Work runs on a bounded per-process thread pool; submissions
+beyond the queue limit are refused instead of piling up.
+
+The worker that owns a queued or running job touches its file every few
+seconds. A job that stops getting touched before it finishes has lost its
+worker (a crash or restart) and is marked failed when it is next read, so
+polls and event streams don't wait on it forever.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_STAGES = ("queued", "analyzing", "generating", "done", "failed")
+FINISHED_STAGES = ("done", "failed")
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class JobStore:
+    # How often waiters re-read a job another worker may be updating
+    POLL_INTERVAL_SECONDS = 0.25
+    TRIM_INTERVAL_SECONDS = 60
+    LOST_MESSAGE = "The worker running this job stopped (submit it again)"
+
+    def __init__(self, directory, ttl_seconds=3600, stale_seconds=60):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        # An unfinished job untouched for this long has lost its worker
+        self.stale_seconds = stale_seconds
+        self._changed = threading.Condition()
+        self._last_trim = 0.0
+
+    def create(self, kind="generation"):
+        now = time.time()
+        job = {
+            "id": uuid.uuid4().hex,
+            "kind": kind,
+            "stage": "queued",
+            "version": 1,
+            "created_at": now,
+            "updated_at": now,
+            "result": None,
+            "error": None,
+            "status_code": None,
+        }
+        self._write(job)
+        if now - self._last_trim > self.TRIM_INTERVAL_SECONDS:
+            self._last_trim = now
+            self.trim()
+        return job
+
+    def get(self, job_id):
+        job, touched_at = self._read(job_id)
+        if job is not None and job["stage"] not in FINISHED_STAGES and time.time() - touched_at > self.stale_seconds:
+            job = self._fail_lost(job)
+        return job
+
+    def update(self, job_id, **fields):
+        # Each job is only ever written by the worker running it, so a plain
+        # read-modify-write is safe.
+        job, _ = self._read(job_id)
+        if job is None:
+            return None
+        job.update(fields)
+        job["version"] += 1
+        job["updated_at"] = time.time()
+        self._write(job)
+        with self._changed:
+            self._changed.notify_all()
+        return job
+
+    def wait_for_change(self, job_id, version, timeout):
+        """Block until the job's version moves past `version` or timeout expires."""
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            if job is None or job["version"] > version:
+                return job
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return job
+            with self._changed:
+                self._changed.wait(min(remaining, self.POLL_INTERVAL_SECONDS))
+
+    def touch(self, job_ids):
+        """Mark jobs as still owned by a live worker"""
+        for job_id in job_ids:
+            try:
+                os.utime(self._path(job_id))
+            except OSError:
+                pass
+
+    def trim(self):
+        if not os.path.isdir(self.directory):
+            return
+        cutoff = time.time() - self.ttl_seconds
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith(".json") and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _read(self, job_id):
+        """(job, time its file was last written or touched), or (None, None)"""
+        if not job_id.isalnum():
+            return None, None
+        try:
+            with open(self._path(job_id), "r", encoding="utf-8") as f:
+                return json.load(f), os.fstat(f.fileno()).st_mtime
+        except (FileNotFoundError, ValueError, OSError):
+            return None, None
+
+    def _fail_lost(self, job):
+        job.update(stage="failed", error=self.LOST_MESSAGE, status_code=503)
+        job["version"] += 1
+        job["updated_at"] = time.time()
+        # Any reader may get here first; they all write the same outcome
+        self._write(job)
+        return job
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def _write(self, job):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(job, f)
+        os.replace(tmp_path, self._path(job["id"]))
+
+
+class JobRunner:
+    """Bounded executor: `max_workers` jobs run, up to `max_queued` more wait."""
+
+    def __init__(self, store, max_workers=4, max_queued=32):
+        self.store = store
+        self.max_workers = max_workers
+        self._slots = threading.BoundedSemaphore(max_workers + max_queued)
+        self._executor = None
+        self._lock = threading.Lock()
+        # Queued and running jobs, touched by the heartbeat thread
+        self._owned = set()
+
+    def submit(self, fn, kind="generation"):
+        """Queue fn(set_stage) and return the job record.
+
+        fn receives a callback for reporting stage transitions and returns the
+        result body; raising marks the job failed with the exception's message.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise JobQueueFull()
+        job = self.store.create(kind)
+        with self._lock:
+            self._owned.add(job["id"])
+        try:
+            self._get_executor().submit(self._run, job["id"], fn)
+        except Exception:
+            self._disown(job["id"])
+            self._slots.release()
+            raise
+        return job
+
+    def _get_executor(self):
+        # Created lazily so a preloading master never owns the worker threads
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True).start()
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="job")
+        return self._executor
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.store.stale_seconds / 4)
+            with self._lock:
+                owned = list(self._owned)
+            self.store.touch(owned)
+
+    def _disown(self, job_id):
+        with self._lock:
+            self._owned.discard(job_id)
+
+    def _run(self, job_id, fn):
+        try:
+            result = fn(lambda stage: self.store.update(job_id, stage=stage))
+            self.store.update(job_id, stage="done", result=result, status_code=200)
+        except Exception as e:
+            self.store.update(
+                job_id,
+                stage="failed",
+                error=getattr(e, "message", None) or str(e) or type(e).__name__,
+                status_code=getattr(e, "status_code", 500),
+            )
+        finally:
+            self._disown(job_id)
+            self._slots.release()
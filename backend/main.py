@@ -1,29 +1,107 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Request, Response, request, jsonify, send_file, stream_with_context, url_for
 from flask_cors import CORS
 import anthropic
 import base64
+import contextvars
+import hashlib
+import io
+import json
 import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 import httpx
 from dotenv import load_dotenv
 
+from adjustments import (
+    AdjustmentError,
+    PreviewSources,
+    parse_settings as parse_stylistic_settings,
+    render_adjusted,
+    render_preview,
+    VARIANT_PREFIX as ADJUSTMENT_VARIANT_PREFIX,
+    variant_name as adjustment_variant,
+)
+from analysis_cache import AnalysisCache, cache_key, image_digest
+from artifacts import ArtifactStore
+import deadlines
+from coalesce import IdempotencyConflict, IdempotencyStore, SingleFlight, fingerprint
+from exports import EXPORT_FORMATS, ExportError, ExportService, parse_export_options
+from deadlines import DeadlineExceeded, LatencyTracker, ahedged, hedged
+from delivery import acceptable, probe, supported_formats, transcode
+from design_dna import HousePalettes, describe as describe_palette, extract_swatches
+from gemini_files import DEFAULT_FILE_TTL_SECONDS, GeminiFiles
+from governor import ProviderUnavailable
+from ingest import SPOOL_BYTES, UploadError, check_request_length, ingest_image
+from jobs import FINISHED_STAGES, JobQueueFull, JobRunner, JobStore
+from phash import PhashIndex, aspect_matches, phash_bytes
+from uploads import UnknownUpload, UploadStore
+import metrics
+import pipeline
+from profiling import SamplingProfiler, instrument as instrument_profiling
+from scene_analysis import (
+    LEVELS as ANALYSIS_LEVELS,
+    SCENE_ANALYSIS_MODEL,
+    SCENE_ANALYSIS_PROMPT_VERSION,
+    Estimate,
+    agrees as scene_analyses_agree,
+    parse as parse_scene_analysis,
+    parse_level as parse_analysis_level,
+    payload_builder as scene_analysis_payload,
+    to_dict as scene_analysis_dict,
+)
+from providers import anthropic_create, anthropic_create_async, anthropic_stream, classify_anthropic, governor
+import scheduler
+from scheduler import AdmissionScheduler, SchedulerBusy
+
 load_dotenv()
 
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # Large photos go to a temporary file instead of worker memory
+        return tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES, mode="rb+")
+
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 CORS(app)
 
-# Lazy init clients
-_anthropic_client = None
+# Endpoints taking one photo; oversized bodies are refused before they are read
+SINGLE_UPLOAD_ENDPOINTS = {"create_upload", "stage", "generate_image", "analyze_room", "submit_job", "stage_and_generate"}
+
+
+def reject_oversized_upload():
+    if request.endpoint in SINGLE_UPLOAD_ENDPOINTS:
+        try:
+            check_request_length(request.content_length)
+        except UploadError as e:
+            return jsonify({"error": e.message}), e.status_code
 
-def get_anthropic_client():
-    global _anthropic_client
-    if _anthropic_client is None:
-        _anthropic_client = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
-    return _anthropic_client
+
+# Rejections are timed and counted too, but refused before the body is parsed
+metrics.instrument(app, reject=reject_oversized_upload)
 
 def get_gemini_key():
     return os.getenv("GEMINI_API_KEY")
 
 
+# Host-local state shared by all workers (caches, jobs, artifacts, ...)
+STATE_DIR = os.getenv("STATE_DIR", os.path.join(tempfile.gettempdir(), "estate-stage-pro"))
+
+
+# Scene analyses are cached by image hash + model + prompt version, so restyles
+# of an already-analyzed photo skip the Flash round-trip entirely.
+analysis_cache = AnalysisCache(
+    os.getenv("ANALYSIS_CACHE_DIR", os.path.join(STATE_DIR, "analysis")),
+    max_entries=int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", 256)),
+    ttl_seconds=int(os.getenv("ANALYSIS_CACHE_TTL_SECONDS", 7 * 24 * 3600)),
+    max_disk_bytes=int(os.getenv("ANALYSIS_CACHE_MAX_DISK_MB", 256)) * 1024 * 1024,
+    enabled=os.getenv("ANALYSIS_CACHE_ENABLED", "true").lower() == "true",
+)
+
+
 # ============== CONFIGS ==============
 
 STAGING_SYSTEM_PROMPT = """You are an expert interior designer and real estate virtual staging specialist. Analyze rooms and provide detailed, actionable staging recommendations that maximize buyer appeal."""
@@ -63,40 +141,47 @@ def health():
     })
 
 
-# ============== STAGING DESCRIPTION (Claude) ==============
+# ============== ERRORS ==============
 
-@app.route("/stage", methods=["POST"])
-def stage():
-    """Generate staging recommendations using Claude"""
-    try:
-        if 'image' not in request.files:
-            return jsonify({"error": "No image provided"}), 400
+def error_body(e, context, timeout_message="Request timed out"):
+    """(body, status, headers) for an exception escaping a request handler.
 
-        image_file = request.files['image']
-        if image_file.filename == '':
-            return jsonify({"error": "No image selected"}), 400
+    Shared by the Flask views and the async handlers in asgi.py so both
+    serving modes answer failures identically.
+    """
+    if isinstance(e, UnknownUpload):
+        return {"error": e.message, "code": e.code}, e.status_code, {}
+    if isinstance(e, (UploadError, PipelineError)):
+        return {"error": e.message}, e.status_code, {}
+    if isinstance(e, (ProviderUnavailable, SchedulerBusy)):
+        # Rate-limited or circuit-open provider call, or no admission slot in time
+        headers = {"Retry-After": str(e.retry_after)} if e.retry_after else {}
+        return {"error": e.message, "retry_after": e.retry_after}, e.status_code, headers
+    if isinstance(e, IdempotencyConflict):
+        return {"error": "Idempotency-Key was already used with different parameters"}, 422, {}
+    if isinstance(e, anthropic.AuthenticationError):
+        return {"error": "Invalid ANTHROPIC_API_KEY"}, 401, {}
+    if isinstance(e, anthropic.RateLimitError):
+        return {"error": "Rate limit exceeded"}, 429, {}
+    if isinstance(e, (httpx.TimeoutException, DeadlineExceeded)):
+        return {"error": timeout_message}, 504, {}
+    app.logger.error(f"{context} error: {str(e)}")
+    return {"error": str(e)}, 500, {}
 
-        image = image_file.read()
-        room_type = request.form.get('room_type', 'LIVING')
-        style = request.form.get('style', 'MODERN')
 
-        filename = image_file.filename.lower()
-        if filename.endswith('.png'):
-            media_type = "image/png"
-        elif filename.endswith('.webp'):
-            media_type = "image/webp"
-        else:
-            media_type = "image/jpeg"
+def error_response(e, context, timeout_message="Request timed out"):
+    body, status_code, headers = error_body(e, context, timeout_message)
+    return jsonify(body), status_code, headers
 
-        base64_image = base64.b64encode(image).decode("utf-8")
-        room_context = ROOM_CONTEXT.get(room_type, ROOM_CONTEXT["LIVING"])
-        style_context = STYLE_CONTEXT.get(style, STYLE_CONTEXT["MODERN"])
 
-        prompt = f"""Analyze this {room_context} and create a virtual staging plan.
+# ============== STAGING DESCRIPTION (Claude) ==============
 
-**Style:** {style_context}
+STAGING_MODEL = "claude-sonnet-4-20250514"
 
-Provide:
+# Fixed across every /stage call, so it lives in the cached system prefix
+# rather than the per-request user turn. Anthropic only caches prefixes above
+# the model's minimum length; below it cache_control is simply ignored.
+STAGING_INSTRUCTIONS = """When asked for a virtual staging plan, provide:
 ## Room Analysis
 - Current state, dimensions estimate, architectural features, light sources
 
@@ -115,146 +200,221 @@ Art, textiles, plants, decorative objects
 ## Buyer Appeal
 2-3 sentence summary of how this staging increases perceived value."""
 
-        response = get_anthropic_client().messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=2048,
-            system=STAGING_SYSTEM_PROMPT,
-            messages=[{
-                "role": "user",
-                "content": [
-                    {"type": "image", "source": {"type": "base64", "media_type": media_type, "data": base64_image}},
-                    {"type": "text", "text": prompt}
-                ]
-            }]
-        )
 
-        return jsonify({
-            "description": response.content[0].text,
-            "room_type": room_type,
-            "style": style,
-            "status": "success"
-        })
-
-    except anthropic.AuthenticationError:
-        return jsonify({"error": "Invalid ANTHROPIC_API_KEY"}), 401
-    except anthropic.RateLimitError:
-        return jsonify({"error": "Rate limit exceeded"}), 429
-    except Exception as e:
-        app.logger.error(f"Stage error: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
 
 
-# ============== SCENE ANALYSIS HELPER ==============
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-def analyze_scene(base64_image, mime_type, gemini_key):
-    """Analyze room geometry, doorways, windows, depth, and spatial layout using Gemini Flash"""
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-3-flash-preview:generateContent?key={gemini_key}"
 
-    analysis_prompt = """Analyze this room image for virtual staging. Use doors (80" tall, 32-36" wide) and outlets (12-18" from floor) as size references.
+def wants_stage_stream(form, headers):
+    return (form.get('stream', 'false').lower() == 'true'
+            or "text/event-stream" in headers.get("Accept", ""))
 
-Return JSON:
-{
-  "detected_room_type": "living room|bedroom|kitchen|dining room|office|other",
-  "room_state": "empty|partially_furnished|furnished",
-  "confidence": 0.85,
-
-  "room_dimensions": {
-    "width": {"estimate_feet": 14, "estimate_range": "12-16 feet"},
-    "length": {"estimate_feet": 18, "estimate_range": "16-20 feet"},
-    "ceiling_height": {"estimate_feet": 9, "estimate_range": "8-10 feet"},
-    "total_floor_area_sqft": 252
-  },
-
-  "perspective_analysis": {
-    "camera_height": "standing 5-6ft",
-    "camera_angle": "straight on|corner view|angled",
-    "lens_type": "normal|wide angle",
-    "vanishing_point_location": "center|left|right"
-  },
-
-  "depth_mapping": {
-    "total_depth_estimate": "18 feet",
-    "foreground_zone": {"depth_range": "0-5 feet", "suitable_for": ["plants", "small tables"]},
-    "midground_zone": {"depth_range": "5-12 feet", "suitable_for": ["sofa", "coffee table", "main seating"]},
-    "background_zone": {"depth_range": "12-18 feet", "suitable_for": ["console", "bookshelf", "wall art"]}
-  },
-
-  "doorways": [
-    {"location": "left wall", "type": "interior", "width_inches": 32, "depth_from_camera_feet": 8}
-  ],
-
-  "windows": [
-    {"location": "back wall", "type": "large picture window", "width_inches": 60, "depth_from_camera_feet": 18, "natural_light_contribution": "primary"}
-  ],
-
-  "architectural_features": {
-    "ceiling": "flat",
-    "ceiling_height_inches": 108,
-    "flooring": "hardwood",
-    "flooring_color": "medium",
-    "walls": "painted",
-    "wall_color": "white",
-    "fireplace": {"present": false}
-  },
-
-  "spatial_layout": {
-    "shape": "rectangular",
-    "width_feet": 14,
-    "length_feet": 18,
-    "focal_point": "window",
-    "focal_point_location": "back wall",
-    "natural_traffic_flow": "left to right"
-  },
-
-  "lighting_analysis": {
-    "primary_light_source": "natural from windows",
-    "light_direction": "from back",
-    "shadow_direction": "toward camera",
-    "color_temperature": "neutral daylight"
-  },
-
-  "furniture_sizing_guide": {
-    "sofa": {"recommended_width_inches": "84-96", "placement": "facing windows, 8ft from camera"},
-    "coffee_table": {"recommended_size": "48x24 inches", "placement": "in front of sofa"},
-    "area_rug": {"recommended_size": "8x10 feet", "placement": "under seating area"}
-  },
-
-  "staging_recommendations": {
-    "anchor_piece": {
-      "item": "sofa",
-      "suggested_width_inches": 90,
-      "suggested_location": "center, 8 feet from camera",
-      "orientation": "facing focal point"
-    },
-    "scale_guidance": "medium-large furniture for this room size",
-    "depth_placement_guide": [
-      {"item": "rug", "depth_from_camera_feet": 6},
-      {"item": "sofa", "depth_from_camera_feet": 8},
-      {"item": "coffee table", "depth_from_camera_feet": 6},
-      {"item": "console", "depth_from_camera_feet": 16}
-    ],
-    "areas_to_avoid": ["in front of doorways", "blocking windows"]
-  }
-}
 
-Fill in actual values based on what you see. Be specific about dimensions and depths."""
+def build_stage_request(image, room_type, style):
+    """Keyword arguments for the prompt-caching messages API"""
+    base64_image = base64.b64encode(image.data).decode("utf-8")
+    room_context = ROOM_CONTEXT.get(room_type, ROOM_CONTEXT["LIVING"])
+    style_context = STYLE_CONTEXT.get(style, STYLE_CONTEXT["MODERN"])
 
-    payload = {
-        "contents": [{
-            "parts": [
-                {"inlineData": {"mimeType": mime_type, "data": base64_image}},
-                {"text": analysis_prompt}
+    prompt = f"""Analyze this {room_context} and create a virtual staging plan.
+
+**Style:** {style_context}"""
+
+    return {
+        "model": STAGING_MODEL,
+        "max_tokens": 2048,
+        "system": [
+            {"type": "text", "text": STAGING_SYSTEM_PROMPT},
+            {"type": "text", "text": STAGING_INSTRUCTIONS, "cache_control": {"type": "ephemeral"}},
+        ],
+        "messages": [{
+            "role": "user",
+            "content": [
+                {"type": "image", "source": {"type": "base64", "media_type": image.mime_type, "data": base64_image}},
+                {"type": "text", "text": prompt}
             ]
-        }],
-        "generationConfig": {
-            "responseMimeType": "application/json",
-            "temperature": 0.1  # Low temperature for consistent analysis
-        }
+        }]
     }
 
+
+def stage_result(message, result_fields):
+    return {
+        "description": "".join(block.text for block in message.content if block.type == "text"),
+        **result_fields,
+        "usage": stage_usage(message.usage),
+        "status": "success"
+    }
+
+
+def stage_usage(usage):
+    return {
+        "input_tokens": usage.input_tokens,
+        "output_tokens": usage.output_tokens,
+        "cache_creation_input_tokens": getattr(usage, "cache_creation_input_tokens", None) or 0,
+        "cache_read_input_tokens": getattr(usage, "cache_read_input_tokens", None) or 0,
+    }
+
+
+def prepare_stage(image, room_type, style):
+    """(messages API arguments, fields echoed in the result) for one staging plan"""
+    with metrics.stage("prompt_build"):
+        stage_request = build_stage_request(image, room_type, style)
+    return stage_request, {"room_type": room_type, "style": style, "input_dimensions": image.dimensions()}
+
+
+def stage_description(image, room_type, style):
+    """/stage without streaming: steps producing Claude's staging plan as a response body"""
+    stage_request, result_fields = prepare_stage(image, room_type, style)
+    with metrics.stage("claude"):
+        response = yield pipeline.call(anthropic_create, anthropic_create_async, **stage_request)
+    return stage_result(response, result_fields)
+
+
+def stream_stage(stage_request, result_fields):
+    """SSE body: `delta` events with Claude's text as it arrives, then `done` or `error`"""
+    try:
+        with metrics.stage("claude_stream"), governor.guard(STAGING_MODEL, classify_anthropic):
+            with anthropic_stream(**stage_request) as stream:
+                for text in stream.text_stream:
+                    yield sse_event("delta", {"text": text})
+                message = stream.get_final_message()
+
+        yield sse_event("done", stage_result(message, result_fields))
+
+    except Exception as e:
+        body, status_code, _ = error_body(e, "Stage stream")
+        yield sse_event("error", {**body, "status_code": status_code})
+
+
+@app.route("/stage", methods=["POST"])
+def stage():
+    """Generate staging recommendations using Claude.
+
+    Send `stream=true` (or Accept: text/event-stream) to receive the
+    description as Server-Sent Events while it is being written.
+    """
+    try:
+        image = request_image(request.form, request.files)
+        room_type = request.form.get('room_type', 'LIVING')
+        style = request.form.get('style', 'MODERN')
+
+        if wants_stage_stream(request.form, request.headers):
+            return Response(stream_stage(*prepare_stage(image, room_type, style)), mimetype="text/event-stream",
+                            headers=SSE_HEADERS)
+
+        return jsonify(pipeline.run(stage_description(image, room_type, style)))
+
+    except Exception as e:
+        return error_response(e, "Stage")
+
+
+# ============== SCENE ANALYSIS HELPER ==============
+
+# Detail level behind enable_analysis=true; see scene_analysis.py for what each asks for
+DEFAULT_ANALYSIS_LEVEL = os.getenv("SCENE_ANALYSIS_LEVEL", "standard")
+if DEFAULT_ANALYSIS_LEVEL not in ANALYSIS_LEVELS:
+    raise ValueError(f"SCENE_ANALYSIS_LEVEL must be one of {', '.join(ANALYSIS_LEVELS)}")
+SCENE_ANALYSIS_PAYLOADS = {level: scene_analysis_payload(level) for level in ANALYSIS_LEVELS}
+
+
+def scene_analysis_key(image_hash, level):
+    return cache_key(image_hash, SCENE_ANALYSIS_MODEL, f"{SCENE_ANALYSIS_PROMPT_VERSION}-{level}") if image_hash else None
+
+
+def cached_scene_analysis(image_hash, level):
+    """A cached analysis at `level` or any more detailed one"""
+    if not image_hash:
+        return None
+    # One lookup as far as the hit rate is concerned, whichever level answers
+    keys = {scene_analysis_key(image_hash, candidate): candidate
+            for candidate in ANALYSIS_LEVELS[ANALYSIS_LEVELS.index(level):]}
+    key, cached = analysis_cache.get_first(keys)
+    if cached is None:
+        return None
+    app.logger.info("Scene analysis cache hit")
+    return parse_scene_analysis(cached, keys[key])
+
+
+# Analyzed photos are indexed by perceptual hash, so a re-upload of the same
+# room (re-encoded, resized, lightly edited) reuses its analysis
+phash_index = PhashIndex(
+    os.path.join(STATE_DIR, "phash", "index.bin"),
+    max_entries=int(os.getenv("PHASH_INDEX_MAX_ENTRIES", 500_000)),
+    ttl_seconds=analysis_cache.ttl_seconds,
+    enabled=os.getenv("PHASH_INDEX_ENABLED", "true").lower() == "true" and analysis_cache.enabled,
+)
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", 6))
+# Largest relative aspect ratio difference between a photo and the one it borrows from
+PHASH_MAX_ASPECT_DIFF = float(os.getenv("PHASH_MAX_ASPECT_DIFF", 0.02))
+# Share of borrowed analyses checked against a fresh one, to measure false matches
+PHASH_AUDIT_RATE = float(os.getenv("PHASH_AUDIT_RATE", 0.02))
+
+
+def image_phash(image):
+    return image.phash if image.phash is not None else phash_bytes(image.data)
+
+
+def index_photo(image, image_hash):
+    try:
+        phash_index.add(image_phash(image), image_hash, image.width / image.height)
+    except Exception as e:
+        app.logger.warning(f"Perceptual hash indexing failed: {str(e)}")
+
+
+def count_near_duplicate(outcome):
+    phash_index.record(outcome)
+    metrics.NEAR_DUPLICATES.labels(outcome).inc()
+
+
+def near_duplicate_analysis(image, image_hash, level, gemini_key):
+    """The cached analysis of an indexed near-duplicate of the photo, or None"""
+    if not phash_index.enabled:
+        return None
+    aspect_ratio = image.width / image.height
+    outcome = "misses"
+    for match in phash_index.lookup(image_phash(image), PHASH_MAX_DISTANCE):
+        if match.digest == image_hash:
+            continue  # This very photo, whose analysis has expired
+        if not aspect_matches(aspect_ratio, match.aspect_ratio, PHASH_MAX_ASPECT_DIFF):
+            outcome = "aspect_mismatches" if outcome == "misses" else outcome
+            continue
+        analysis = cached_scene_analysis(match.digest, level)
+        if analysis is None:
+            outcome = "not_analyzed" if outcome == "misses" else outcome
+            continue
+
+        count_near_duplicate("reused")
+        app.logger.info(f"Reusing the scene analysis of a near-duplicate photo ({match.distance} bits apart)")
+        if random.random() < PHASH_AUDIT_RATE:
+            analysis_executor.submit(audit_near_duplicate, image, image_hash, level, gemini_key, analysis, match)
+        return analysis
+
+    count_near_duplicate(outcome)
+    return None
+
+
+def audit_near_duplicate(image, image_hash, level, gemini_key, reused, match):
+    """Analyze a photo that borrowed a near-duplicate's analysis afresh and compare the two"""
+    fresh = fetch_scene_analysis(image, gemini_key, level)
+    if fresh is None:
+        return
+    agreed = scene_analyses_agree(reused, fresh)
+    phash_index.record_audit(agreed, image_hash, match)
+    metrics.NEAR_DUPLICATE_AUDITS.labels("agreed" if agreed else "disagreed").inc()
+    if not agreed:
+        app.logger.warning(f"Near-duplicate false match: {image_hash} borrowed from {match.digest} "
+                           f"({match.distance} bits apart)")
+
+
+def read_scene_analysis(response, key, level):
+    """The SceneAnalysis in a Flash response (cached under key), or None if unusable"""
     try:
-        app.logger.info("Starting scene analysis...")
-        response = httpx.post(url, json=payload, timeout=60.0)  # Increased timeout
         app.logger.info(f"Scene analysis response status: {response.status_code}")
 
         if response.status_code == 200:
@@ -264,9 +424,10 @@ Fill in actual values based on what you see. Be specific about dimensions and de
                 parts = candidates[0].get("content", {}).get("parts", [])
                 for part in parts:
                     if "text" in part:
-                        import json
-                        analysis = json.loads(part["text"])
-                        app.logger.info(f"Scene analysis completed. Keys: {list(analysis.keys())}")
+                        analysis = parse_scene_analysis(json.loads(part["text"]), level)
+                        app.logger.info(f"Scene analysis completed at level {level}")
+                        if key:
+                            analysis_cache.set(key, scene_analysis_dict(analysis))
                         return analysis
             else:
                 app.logger.warning("Scene analysis: No candidates in response")
@@ -278,239 +439,724 @@ Fill in actual values based on what you see. Be specific about dimensions and de
     except Exception as e:
         app.logger.warning(f"Scene analysis failed: {str(e)}")
 
-    return None  # Return None if analysis fails, generation will proceed without it
+    return None
+
+
+# Every generation finishes (or fails) within this budget. Analysis gets
+# whatever generation isn't expected to need, is hedged past its p95, and is
+# skipped outright when the budget can't cover it.
+PIPELINE_DEADLINE_SECONDS = float(os.getenv("PIPELINE_DEADLINE_SECONDS", 150))
+# Stand-ins for the observed percentiles until a worker has seen enough calls
+GENERATION_RESERVE_SECONDS = float(os.getenv("GENERATION_RESERVE_SECONDS", 90))
+ANALYSIS_HEDGE_SECONDS = float(os.getenv("ANALYSIS_HEDGE_SECONDS", 20))
+ANALYSIS_MIN_SECONDS = 2.0
+
+# Per level: a fast analysis writes a fraction of a full one's tokens
+analysis_latency = {level: LatencyTracker() for level in ANALYSIS_LEVELS}
+generation_latency = LatencyTracker()
+analysis_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("ANALYSIS_THREADS", 32)),
+    thread_name_prefix="analysis",
+)
+
+
+def plan_analysis(level):
+    """(level to run, seconds it may take, seconds after which to hedge it) for
+    the most detailed level up to `level` that fits the time left beside
+    generation, or None if none does.
+    """
+    window = deadlines.remaining() - generation_latency.quantile(0.95, GENERATION_RESERVE_SECONDS)
+    for candidate in reversed(ANALYSIS_LEVELS[:ANALYSIS_LEVELS.index(level) + 1]):
+        latency = analysis_latency[candidate]
+        if window >= max(ANALYSIS_MIN_SECONDS, latency.quantile(0.5, 0.0)):
+            return candidate, window, latency.quantile(0.95, ANALYSIS_HEDGE_SECONDS)
+    return None
+
+
+def degrade(degradations, kind):
+    app.logger.warning(f"Pipeline degraded: {kind}")
+    metrics.degraded(kind)
+    degradations.append(kind)
+
+
+def scene_analysis_outcome(analysis, hedged, timed_out, degradations):
+    if hedged:
+        metrics.HEDGED_CALLS.labels("analysis").inc()
+    if timed_out:
+        degrade(degradations, "analysis_timed_out")
+    elif analysis is None:
+        degrade(degradations, "analysis_failed")
+    return analysis
+
+
+def scene_analysis_fetch(image, gemini_key, level):
+    """Steps for one uncached Flash analysis, which comes back None if it failed"""
+    started = time.monotonic()
+    try:
+        response = yield pipeline.call(gemini_files.generate, gemini_files.agenerate, SCENE_ANALYSIS_MODEL, image,
+                                       SCENE_ANALYSIS_PAYLOADS[level], gemini_key, "analysis")
+    except Exception as e:
+        app.logger.warning(f"Scene analysis failed: {str(e)}")
+        return None  # Generation proceeds without it
+    return (yield pipeline.blocking(finish_scene_analysis, response, image, level, time.monotonic() - started))
+
+
+def fetch_scene_analysis(image, gemini_key, level):
+    """One uncached Flash analysis, or None if it failed"""
+    return pipeline.run(scene_analysis_fetch(image, gemini_key, level))
+
+
+def finish_scene_analysis(response, image, level, elapsed):
+    """The analysis in a Flash response, cached and indexed, or None if unusable"""
+    image_hash = image_digest(image.data)
+    analysis = read_scene_analysis(response, scene_analysis_key(image_hash, level), level)
+    if analysis is not None:
+        analysis_latency[level].observe(elapsed)
+        index_photo(image, image_hash)
+    return analysis
+
+
+def planned_analysis(level, degradations):
+    """plan_analysis, recording a skipped or downgraded analysis"""
+    plan = plan_analysis(level)
+    if plan is None:
+        degrade(degradations, "analysis_skipped")
+    elif plan[0] != level:
+        degrade(degradations, "analysis_downgraded")
+    return plan
+
+
+def scene_analysis_plan(image, gemini_key, level, degradations):
+    """(analysis, None) when a cached or near-duplicate analysis can be reused,
+    else (None, planned_analysis()) for a fresh one; that plan is None when
+    the deadline leaves no room for it
+    """
+    image_hash = image_digest(image.data)
+    cached = cached_scene_analysis(image_hash, level)
+    if cached is None:
+        cached = near_duplicate_analysis(image, image_hash, level, gemini_key)
+    if cached is not None:
+        return cached, None
+    return None, planned_analysis(level, degradations)
+
+
+def analyze_scene(image, gemini_key, level, degradations):
+    """Analyze room geometry, doorways, windows, depth, and spatial layout using Gemini Flash
+
+    Steps producing a SceneAnalysis at `level` (or a cheaper one, if the
+    pipeline deadline calls for it) or None; anything that costs the
+    analysis detail is appended to `degradations`.
+    """
+    # The cache and the perceptual hash index are files
+    cached, plan = yield pipeline.blocking(scene_analysis_plan, image, gemini_key, level, degradations)
+    if plan is None:
+        return cached
+    run_level, window, hedge_after = plan
+
+    app.logger.info(f"Starting scene analysis ({run_level})...")
+    with deadlines.deadline_scope(window):
+        result = yield pipeline.Step(
+            lambda: hedged(lambda: fetch_scene_analysis(image, gemini_key, run_level), hedge_after, window,
+                           analysis_executor),
+            lambda: ahedged(lambda: pipeline.arun(scene_analysis_fetch(image, gemini_key, run_level)),
+                            hedge_after, window),
+        )
+    return scene_analysis_outcome(*result, degradations)
+
+
+# Opt-in: upload each photo to the Gemini Files API once and reference it by
+# URI in analysis, generation and restyles instead of inlining it every time
+gemini_files = GeminiFiles(
+    AnalysisCache(
+        os.path.join(STATE_DIR, "gemini-files"),
+        max_entries=1024,
+        ttl_seconds=DEFAULT_FILE_TTL_SECONDS,
+        max_disk_bytes=16 * 1024 * 1024,
+    ),
+    enabled=os.getenv("GEMINI_FILE_UPLOADS", "false").lower() == "true",
+)
+
+
+# ============== ARTIFACTS ==============
+
+# Generated images are stored once and served as binary, so responses only
+# carry a URL. ARTIFACT_BASE_URL can point at a CDN in front of /artifacts.
+artifact_store = ArtifactStore(
+    os.getenv("ARTIFACT_DIR", os.path.join(STATE_DIR, "artifacts")),
+    ttl_seconds=int(os.getenv("ARTIFACT_TTL_SECONDS", 7 * 24 * 3600)),
+    max_disk_bytes=int(os.getenv("ARTIFACT_STORE_MAX_DISK_MB", 10240)) * 1024 * 1024,
+)
+ARTIFACT_BASE_URL = os.getenv("ARTIFACT_BASE_URL", "").rstrip("/")
+ARTIFACT_MAX_AGE = 365 * 24 * 3600
+
+
+def artifact_url(artifact_id):
+    return f"{ARTIFACT_BASE_URL}/artifacts/{artifact_id}"
+
+
+def send_artifact(artifact_id, download_name=None):
+    path = artifact_store.path(artifact_id)
+    if path is None:
+        return jsonify({"error": "Artifact not found"}), 404
+
+    meta = artifact_store.metadata(artifact_id) or {}
+    response = send_file(
+        path,
+        mimetype=meta.get("mime_type", "application/octet-stream"),
+        as_attachment=bool(download_name),
+        download_name=download_name,
+        conditional=True,
+        etag=artifact_id,
+        max_age=ARTIFACT_MAX_AGE,
+    )
+    # Content-addressed, so the bytes behind a URL can never change
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+# Generated images are delivered in the best format the client accepts,
+# encoded once under a byte target; the original stays as stored for exports
+DELIVERY_FORMATS = [fmt for fmt in os.getenv("DELIVERY_FORMATS", "avif,webp,jpeg").split(",")
+                    if fmt in supported_formats()]
+DELIVERY_TARGET_BYTES = int(os.getenv("DELIVERY_TARGET_KB", 400)) * 1024
+DELIVERY_QUALITY = int(os.getenv("DELIVERY_QUALITY", 80))
+# Encoded right after generation; every other format waits until a client
+# negotiates it, so nobody pays for an AVIF encode no browser asks for
+DELIVERY_PREENCODE = [fmt for fmt in os.getenv("DELIVERY_PREENCODE", "").split(",") if fmt in DELIVERY_FORMATS]
+delivery_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("DELIVERY_THREADS", 2)),
+    thread_name_prefix="delivery",
+)
+
+
+# (artifact id, format) pairs queued on delivery_executor in this worker
+pending_deliveries = set()
+pending_deliveries_lock = threading.Lock()
+# Max age of a stand-in served while the negotiated variant is being encoded
+DELIVERY_PENDING_MAX_AGE = 60
+
+
+def delivery_variant_name(fmt):
+    return f"delivery-{fmt}-q{DELIVERY_QUALITY}-{DELIVERY_TARGET_BYTES // 1024}k"
+
+
+def delivery_variant(artifact_id, fmt):
+    """Artifact id of the generated image encoded for delivery as `fmt`"""
+    def render(data):
+        with metrics.stage("transcode"):
+            return transcode(data, fmt, DELIVERY_TARGET_BYTES, DELIVERY_QUALITY)
+    return export_service.derive(artifact_id, delivery_variant_name(fmt), render)
+
+
+def prepare_deliveries(artifact_id, formats):
+    """Encode an image's delivery variants as `formats` in the background"""
+    def prepare(fmt):
+        try:
+            delivery_variant(artifact_id, fmt)
+        except Exception as e:
+            app.logger.warning(f"Delivery transcode to {fmt} failed: {str(e)}")
+        finally:
+            with pending_deliveries_lock:
+                pending_deliveries.discard((artifact_id, fmt))
+
+    for fmt in formats:
+        with pending_deliveries_lock:
+            if (artifact_id, fmt) in pending_deliveries:
+                continue
+            pending_deliveries.add((artifact_id, fmt))
+        delivery_executor.submit(prepare, fmt)
+
+
+@app.route("/artifacts/<artifact_id>", methods=["GET"])
+def get_artifact(artifact_id):
+    """Serve a stored image with ETag, conditional GET and Range support
+
+    Generated images go out as AVIF, WebP or progressive JPEG when the
+    Accept header allows; ?original=true, or an Accept of just */*, gets
+    the stored original. Encoding never happens here: if the best format
+    isn't ready yet, the next best ready one (or the original) is sent with
+    a short max age while the background encode finishes.
+    """
+    meta = artifact_store.metadata(artifact_id)
+    if meta is None or "source" in meta or artifact_store.path(artifact_id) is None:
+        # Unknown, or already a derivative
+        return send_artifact(artifact_id)
+
+    formats = []
+    if request.args.get('original', '').lower() != 'true':
+        formats = acceptable(request.headers.get("Accept"), DELIVERY_FORMATS)
+    served_id, served_fmt = artifact_id, None
+    for fmt in formats:
+        ready = artifact_store.get_variant(artifact_id, delivery_variant_name(fmt))
+        if ready:
+            served_id, served_fmt = ready, fmt
+            break
+    metrics.DELIVERIES.labels(served_fmt or "original").inc()
+
+    response = send_artifact(served_id)
+    response.vary.add("Accept")
+    if formats and served_fmt != formats[0]:
+        # The first request for a format encodes it for the ones after
+        prepare_deliveries(artifact_id, [formats[0]])
+        response.cache_control.immutable = False
+        response.cache_control.max_age = DELIVERY_PENDING_MAX_AGE
+    return response
+
+
+# ============== EXPORTS ==============
+
+export_service = ExportService(artifact_store)
+
+
+@app.route("/artifacts/<artifact_id>/export", methods=["GET"])
+def export_artifact(artifact_id):
+    """Download a derivative: ?format=jpeg|png|webp&size=original|4k|mls|mls_small&quality=92
+
+    Derivatives are rendered once and cached; pass `filename` to get it as an
+    attachment.
+    """
+    try:
+        fmt, size, quality = parse_export_options(
+            request.args.get('format'), request.args.get('size'), request.args.get('quality')
+        )
+        if artifact_store.path(artifact_id) is None:
+            return jsonify({"error": "Artifact not found"}), 404
 
+        with metrics.stage("render_export"):
+            derivative_id = export_service.get_or_create(artifact_id, fmt, size, quality)
 
-# ============== IMAGE GENERATION (Gemini 3 Pro Image / Nano Banana Pro) ==============
+        download_name = request.args.get('filename')
+        if download_name:
+            extension = EXPORT_FORMATS[fmt][2]
+            base_name = os.path.splitext(os.path.basename(download_name))[0] or "staged"
+            download_name = f"{base_name}.{extension}"
+        return send_artifact(derivative_id, download_name=download_name)
 
-@app.route("/generate-image", methods=["POST"])
-def generate_image():
-    """Generate staged room image using Gemini 3 Pro Image (Nano Banana Pro)"""
+    except ExportError as e:
+        return jsonify({"error": e.message}), e.status_code
+    except Exception as e:
+        app.logger.error(f"Export error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+
+# ============== STYLISTIC ADJUSTMENTS ==============
+
+# Decoded, downscaled copies of recently adjusted artifacts, so preview slider
+# tweaks skip the decode
+adjustment_previews = PreviewSources(
+    edge=int(os.getenv("ADJUST_PREVIEW_EDGE", 1024)),
+    max_entries=int(os.getenv("ADJUST_PREVIEW_CACHE_ENTRIES", 8)),
+)
+# Full-resolution adjusted renders kept per artifact, most recently used first
+ADJUST_MAX_VARIANTS = max(1, int(os.getenv("ADJUST_MAX_VARIANTS", 4)))
+
+
+@app.route("/artifacts/<artifact_id>/adjust", methods=["GET"])
+def adjust_artifact(artifact_id):
+    """Apply StylisticSettings without regenerating:
+    ?brightness=&warmth=&sharpness=&texture= (-100..100) &grain= (0..100)
+
+    preview=true renders a reduced-resolution JPEG in milliseconds; without
+    it the full-resolution result is rendered once per settings and cached
+    like an export, for the ADJUST_MAX_VARIANTS most recent settings.
+    Minimalism needs a new generation and is refused.
+    """
     try:
-        gemini_key = get_gemini_key()
-        if not gemini_key:
-            return jsonify({"error": "GEMINI_API_KEY not configured"}), 503
+        settings = parse_stylistic_settings(request.args)
+        if artifact_store.path(artifact_id) is None:
+            return jsonify({"error": "Artifact not found"}), 404
+
+        if request.args.get('preview', '').lower() == 'true':
+            with metrics.stage("render_preview"):
+                source = adjustment_previews.get(artifact_id, artifact_store.read)
+                if source is None:
+                    return jsonify({"error": "Artifact not found"}), 404
+                preview = render_preview(source, settings)
+            response = send_file(io.BytesIO(preview), mimetype="image/jpeg", max_age=ARTIFACT_MAX_AGE)
+            # Same artifact and settings, same pixels
+            response.cache_control.public = True
+            return response
+
+        with metrics.stage("render_adjusted"):
+            derivative_id = export_service.derive(artifact_id, adjustment_variant(settings),
+                                                  lambda data: render_adjusted(data, settings))
+        # Every slider position is a new full-resolution image; keep the latest few
+        artifact_store.trim_variants(artifact_id, ADJUSTMENT_VARIANT_PREFIX, ADJUST_MAX_VARIANTS)
+        return send_artifact(derivative_id)
+
+    except (AdjustmentError, ExportError) as e:
+        return jsonify({"error": e.message}), e.status_code
+    except Exception as e:
+        app.logger.error(f"Adjust error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+
+# ============== UPLOADS ==============
+
+# Photos ingested once and referenced by upload_id afterwards, so restyling a
+# room sends a few bytes instead of the whole photo again
+upload_store = UploadStore(
+    os.getenv("UPLOAD_DIR", os.path.join(STATE_DIR, "uploads")),
+    ttl_seconds=int(os.getenv("UPLOAD_TTL_SECONDS", 24 * 3600)),
+    max_disk_bytes=int(os.getenv("UPLOAD_STORE_MAX_DISK_MB", 1024)) * 1024 * 1024,
+)
+
+
+def stored_upload(upload_id):
+    image = upload_store.get(upload_id)
+    if image is None:
+        raise UnknownUpload()
+    return image
+
+
+def image_file(files):
+    """The request's `image` file part; raises UploadError if there is none"""
+    if 'image' not in files:
+        raise UploadError("No image provided")
+    if files['image'].filename == '':
+        raise UploadError("No image selected")
+    return files['image']
+
+
+def request_image(form, files):
+    """The photo a request refers to: a stored `upload_id` or a fresh `image` file"""
+    upload_id = form.get('upload_id')
+    if upload_id:
+        return stored_upload(upload_id)
+    return ingest_image(image_file(files).stream)
+
+
+def spool_upload(stream):
+    """(private spooled copy, SHA-256) of an upload that must outlive the
+    request, e.g. one normalized later by a job; the caller closes the copy
+    """
+    copy = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES, mode="w+b")
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(64 * 1024), b""):
+        digest.update(chunk)
+        copy.write(chunk)
+    copy.seek(0)
+    return copy, digest.hexdigest()
+
+
+def upload_view(upload_id, image):
+    return {
+        "upload_id": upload_id,
+        "mime_type": image.mime_type,
+        "bytes": len(image.data),
+        "input_dimensions": image.dimensions(),
+        "aspect_ratio": closest_aspect_ratio(image.width, image.height),
+        "expires_in": upload_store.ttl_seconds,
+    }
+
 
+@app.route("/uploads", methods=["POST"])
+def create_upload():
+    """Normalize and store a photo once; pass the returned upload_id in
+    place of the `image` field to /stage, /analyze, /generate-image or /jobs.
+    """
+    try:
         if 'image' not in request.files:
             return jsonify({"error": "No image provided"}), 400
 
-        image_file = request.files['image']
-        image_data = image_file.read()
-        room_type = request.form.get('room_type', 'LIVING')
-        style = request.form.get('style', 'MODERN')
-        enable_analysis = request.form.get('enable_analysis', 'true').lower() == 'true'
+        image = ingest_image(request.files['image'].stream)
+        upload_id = upload_store.put(image)
+        return jsonify(upload_view(upload_id, image)), 201
 
-        base64_image = base64.b64encode(image_data).decode("utf-8")
+    except Exception as e:
+        return error_response(e, "Upload")
 
-        filename = image_file.filename.lower()
-        if filename.endswith('.png'):
-            mime_type = "image/png"
-        elif filename.endswith('.webp'):
-            mime_type = "image/webp"
-        else:
-            mime_type = "image/jpeg"
-
-        room_context = ROOM_CONTEXT.get(room_type, "living room")
-        style_context = STYLE_CONTEXT.get(style, "Modern style")
-
-        # Get aspect ratio from request (frontend calculates it)
-        aspect_ratio = request.form.get('aspect_ratio', '4:3')
-
-        # Get house continuity data if provided
-        house_continuity = None
-        house_continuity_raw = request.form.get('house_continuity')
-        if house_continuity_raw:
-            import json
-            house_continuity = json.loads(house_continuity_raw)
-
-        # Validate aspect ratio - must be one of Gemini's supported values
-        valid_ratios = ['1:1', '2:3', '3:2', '3:4', '4:3', '4:5', '5:4', '9:16', '16:9', '21:9']
-        if aspect_ratio not in valid_ratios:
-            aspect_ratio = '4:3'  # Default fallback
-
-        # ============== SCENE ANALYSIS ==============
-        scene_analysis = None
-        if enable_analysis:
-            scene_analysis = analyze_scene(base64_image, mime_type, gemini_key)
-
-        # ============== BUILD ENHANCED PROMPT ==============
-        # Use Gemini 3 Pro Image Preview (Nano Banana Pro) for high-quality staging
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-3-pro-image-preview:generateContent?key={gemini_key}"
-
-        # Build scene-aware prompt sections
-        scene_context = ""
-        if scene_analysis:
-            # Room dimensions section (NEW)
-            dims = scene_analysis.get("room_dimensions", {})
-            if dims:
-                scene_context += f"\n=== ROOM DIMENSIONS (CALIBRATED FROM REFERENCE OBJECTS) ===\n"
-                width = dims.get("width", {})
-                length = dims.get("length", {})
-                ceiling = dims.get("ceiling_height", {})
-                scene_context += f"  - Width: {width.get('estimate_feet', 14)} feet ({width.get('estimate_range', '12-16 feet')})\n"
-                scene_context += f"  - Length/Depth: {length.get('estimate_feet', 18)} feet ({length.get('estimate_range', '16-20 feet')})\n"
-                scene_context += f"  - Ceiling Height: {ceiling.get('estimate_feet', 9)} feet\n"
-                scene_context += f"  - Total Floor Area: ~{dims.get('total_floor_area_sqft', 250)} sq ft\n"
-
-            # Perspective analysis (NEW)
-            perspective = scene_analysis.get("perspective_analysis", {})
-            if perspective:
-                scene_context += f"\n=== CAMERA & PERSPECTIVE ===\n"
-                scene_context += f"  - Camera height: {perspective.get('camera_height', 'standing 5-6ft')}\n"
-                scene_context += f"  - Camera angle: {perspective.get('camera_angle', 'straight on')}\n"
-                scene_context += f"  - Lens type: {perspective.get('lens_type', 'normal')}\n"
-                scene_context += f"  - Vanishing point: {perspective.get('vanishing_point_location', 'center')}\n"
-
-            # Depth mapping (NEW - CRITICAL)
-            depth = scene_analysis.get("depth_mapping", {})
-            if depth:
-                scene_context += f"\n=== DEPTH ZONES (CRITICAL FOR FURNITURE PLACEMENT) ===\n"
-                scene_context += f"  - Total depth: {depth.get('total_depth_estimate', '15-20 feet')}\n"
-                fg = depth.get("foreground_zone", {})
-                mg = depth.get("midground_zone", {})
-                bg = depth.get("background_zone", {})
-                if fg:
-                    scene_context += f"  - FOREGROUND ({fg.get('depth_range', '0-5 feet')}): {fg.get('floor_area_percentage', 20)}% of floor\n"
-                    scene_context += f"    Suitable items: {', '.join(fg.get('suitable_for', ['small accent pieces']))}\n"
-                if mg:
-                    scene_context += f"  - MIDGROUND ({mg.get('depth_range', '5-12 feet')}): {mg.get('floor_area_percentage', 50)}% of floor\n"
-                    scene_context += f"    Suitable items: {', '.join(mg.get('suitable_for', ['main furniture']))}\n"
-                if bg:
-                    scene_context += f"  - BACKGROUND ({bg.get('depth_range', '12+ feet')}): {bg.get('floor_area_percentage', 30)}% of floor\n"
-                    scene_context += f"    Suitable items: {', '.join(bg.get('suitable_for', ['wall furniture']))}\n"
-
-            # Furniture sizing guide (NEW - CRITICAL)
-            sizing = scene_analysis.get("furniture_sizing_guide", {})
-            if sizing:
-                scene_context += f"\n=== FURNITURE SIZING (SCALED TO ROOM) ===\n"
-                for item, specs in sizing.items():
-                    if isinstance(specs, dict):
-                        size_info = []
-                        if specs.get("recommended_width_inches"):
-                            size_info.append(f"width: {specs['recommended_width_inches']}\"")
-                        if specs.get("recommended_length_inches"):
-                            size_info.append(f"length: {specs['recommended_length_inches']}\"")
-                        if specs.get("recommended_depth_inches"):
-                            size_info.append(f"depth: {specs['recommended_depth_inches']}\"")
-                        if specs.get("recommended_size"):
-                            size_info.append(specs['recommended_size'])
-                        if specs.get("recommended_height_inches"):
-                            size_info.append(f"height: {specs['recommended_height_inches']}\"")
-                        if specs.get("recommended_diameter_inches"):
-                            size_info.append(f"diameter: {specs['recommended_diameter_inches']}\"")
-                        placement = specs.get("placement", "")
-                        scene_context += f"  - {item.upper()}: {', '.join(size_info)}"
-                        if placement:
-                            scene_context += f" → {placement}"
-                        scene_context += "\n"
-
-            # Doorways section
-            if scene_analysis.get("doorways"):
-                scene_context += f"\n=== DOORWAYS (DO NOT BLOCK - MAINTAIN CLEARANCE) ===\n"
-                for d in scene_analysis["doorways"]:
-                    loc = d.get('location', 'unknown')
-                    dtype = d.get('type', 'interior')
-                    width = d.get('width_inches', 32)
-                    clearance = d.get('clearance_needed_inches', 36)
-                    depth_ft = d.get('depth_from_camera_feet', 'unknown')
-                    scene_context += f"  - {loc}: {dtype} door ({width}\" wide), clearance needed: {clearance}\", depth: {depth_ft}ft from camera\n"
-
-            # Windows section
-            if scene_analysis.get("windows"):
-                scene_context += f"\n=== WINDOWS (PRESERVE ACCESS & LIGHT) ===\n"
-                for w in scene_analysis["windows"]:
-                    loc = w.get('location', 'unknown')
-                    wtype = w.get('type', 'standard')
-                    width = w.get('width_inches', 48)
-                    height = w.get('height_inches', 60)
-                    light = w.get('natural_light_contribution', 'primary')
-                    depth_ft = w.get('depth_from_camera_feet', 'unknown')
-                    scene_context += f"  - {loc}: {wtype} ({width}\" × {height}\"), {light} light source, depth: {depth_ft}ft\n"
-
-            # Architectural features
-            arch = scene_analysis.get("architectural_features", {})
-            if arch:
-                scene_context += f"\n=== ARCHITECTURAL CONTEXT ===\n"
-                ceiling_height = arch.get('ceiling_height_inches', 96)
-                scene_context += f"  - Ceiling: {arch.get('ceiling', 'flat')}, {ceiling_height}\" ({ceiling_height/12:.1f}ft)\n"
-                scene_context += f"  - Flooring: {arch.get('flooring_color', 'medium')} {arch.get('flooring', 'hardwood')}"
-                if arch.get('floor_pattern'):
-                    scene_context += f" ({arch['floor_pattern']})"
-                scene_context += "\n"
-                scene_context += f"  - Walls: {arch.get('wall_color', 'neutral')} {arch.get('walls', 'painted')}\n"
-                if arch.get('baseboard_height_inches'):
-                    scene_context += f"  - Baseboard: {arch['baseboard_height_inches']}\" tall\n"
-                if arch.get("fireplace", {}).get("present"):
-                    fp = arch['fireplace']
-                    scene_context += f"  - Fireplace: {fp.get('location', '')} ({fp.get('width_inches', 48)}\" wide, {fp.get('depth_from_camera_feet', '')}ft deep) - MAKE THIS A FOCAL POINT\n"
-
-            # Spatial layout
-            spatial = scene_analysis.get("spatial_layout", {})
-            if spatial:
-                scene_context += f"\n=== SPATIAL LAYOUT ===\n"
-                scene_context += f"  - Room shape: {spatial.get('shape', 'rectangular')}\n"
-                scene_context += f"  - Dimensions: {spatial.get('width_feet', 14)}ft × {spatial.get('length_feet', 18)}ft\n"
-                scene_context += f"  - Focal point: {spatial.get('focal_point', 'window')} at {spatial.get('focal_point_location', 'back wall')}\n"
-                scene_context += f"  - Traffic flow: {spatial.get('natural_traffic_flow', 'through center')}\n"
-                scene_context += f"  - Walkway width needed: {spatial.get('primary_walkway_width_needed_inches', 36)}\" minimum\n"
-                zones = spatial.get("best_furniture_zones", [])
-                if zones:
-                    scene_context += f"  - Furniture zones:\n"
-                    for zone in zones:
-                        if isinstance(zone, dict):
-                            scene_context += f"    • {zone.get('zone', 'center')}: {zone.get('size_sqft', 0)} sqft - ideal for {zone.get('ideal_for', 'furniture')}\n"
-                        else:
-                            scene_context += f"    • {zone}\n"
-
-            # Lighting
-            lighting = scene_analysis.get("lighting_analysis", {})
-            if lighting:
-                scene_context += f"\n=== LIGHTING (MATCH EXACTLY FOR REALISM) ===\n"
-                scene_context += f"  - Primary source: {lighting.get('primary_light_source', 'natural')}\n"
-                scene_context += f"  - Light direction: {lighting.get('light_direction', 'from windows')}\n"
-                scene_context += f"  - Light intensity: {lighting.get('light_intensity', 'moderate')}\n"
-                scene_context += f"  - Shadow direction: {lighting.get('shadow_direction', 'consistent')}\n"
-                scene_context += f"  - Shadow softness: {lighting.get('shadow_softness', 'medium')}\n"
-                scene_context += f"  - Color temperature: {lighting.get('color_temperature', 'neutral')}\n"
-
-            # Staging recommendations with depth placement
-            staging_rec = scene_analysis.get("staging_recommendations", {})
-            if staging_rec:
-                scene_context += f"\n=== AI STAGING GUIDANCE (DEPTH-AWARE) ===\n"
-                if staging_rec.get("anchor_piece"):
-                    ap = staging_rec["anchor_piece"]
-                    scene_context += f"  - ANCHOR: {ap.get('item', 'sofa')} ({ap.get('suggested_width_inches', 90)}\" wide)\n"
-                    scene_context += f"    Location: {ap.get('suggested_location', 'center')}\n"
-                    scene_context += f"    Orientation: {ap.get('orientation', 'facing focal point')}\n"
-
-                # Depth placement guide (NEW - CRITICAL)
-                depth_guide = staging_rec.get("depth_placement_guide", [])
-                if depth_guide:
-                    scene_context += f"  - DEPTH PLACEMENT:\n"
-                    for item in depth_guide:
-                        if isinstance(item, dict):
-                            scene_context += f"    • {item.get('item', 'furniture')}: {item.get('depth_from_camera_feet', '?')}ft from camera ({item.get('reason', '')})\n"
-
-                paths = staging_rec.get("traffic_paths_to_preserve", [])
-                if paths:
-                    scene_context += f"  - KEEP CLEAR:\n"
-                    for path in paths:
-                        if isinstance(path, dict):
-                            scene_context += f"    • {path.get('from', '')} → {path.get('to', '')}: min {path.get('minimum_width_inches', 36)}\" clearance\n"
-                        else:
-                            scene_context += f"    • {path}\n"
-
-                avoid = staging_rec.get("areas_to_avoid", [])
-                if avoid:
-                    scene_context += f"  - AVOID: {', '.join(avoid)}\n"
-                scene_context += f"  - SCALE: {staging_rec.get('scale_guidance', 'appropriate for room size')}\n"
-
-        if house_continuity:
-            dna = house_continuity['designDNA']
-            rooms_staged = house_continuity['roomsStaged']
-            house_name = house_continuity['name']
-
-            prompt = f"""Transform this empty {room_context} into a beautifully staged room.
+
+# ============== IMAGE GENERATION (Gemini 3 Pro Image / Nano Banana Pro) ==============
+
+IMAGE_GENERATION_MODEL = "gemini-3-pro-image-preview"
+
+SUPPORTED_ASPECT_RATIOS = ['1:1', '2:3', '3:2', '3:4', '4:3', '4:5', '5:4', '9:16', '16:9', '21:9']
+
+
+class PipelineError(Exception):
+    """A generation failure reported back to the client with its status code"""
+
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def closest_aspect_ratio(width, height):
+    """The supported ratio nearest to width / height (the frontend's getClosestAspectRatio)"""
+    ratio = width / height
+    return min(SUPPORTED_ASPECT_RATIOS, key=lambda name: abs(_ratio_value(name) - ratio))
+
+
+def _ratio_value(name):
+    w, h = name.split(":")
+    return int(w) / int(h)
+
+
+# What build_generation_prompt reads from a house_continuity block
+HOUSE_CONTINUITY_FIELDS = ("name", "roomsStaged")
+DESIGN_DNA_FIELDS = ("primaryColors", "accentColors", "woodTone", "metalFinish", "textileStyle")
+
+
+def parse_house_continuity(raw):
+    """The house_continuity form field (JSON) as a dict, or None; raises PipelineError (400)"""
+    if not raw:
+        return None
+    try:
+        house_continuity = json.loads(raw)
+    except (TypeError, ValueError) as e:
+        raise PipelineError(f"house_continuity is not valid JSON: {str(e)}", 400)
+    if not isinstance(house_continuity, dict) or not isinstance(house_continuity.get("designDNA"), dict):
+        raise PipelineError("house_continuity must be an object with a designDNA object", 400)
+    missing = [k for k in HOUSE_CONTINUITY_FIELDS if k not in house_continuity]
+    missing += [f"designDNA.{k}" for k in DESIGN_DNA_FIELDS if k not in house_continuity["designDNA"]]
+    if missing:
+        raise PipelineError(f"house_continuity is missing {', '.join(missing)}", 400)
+    return house_continuity
+
+
+def parse_generation_params(form, image=None, house_continuity=None):
+    """Read the generation fields shared by every endpoint that stages an image.
+
+    Without an `aspect_ratio` field the ratio is derived from `image` when
+    one is given. `enable_analysis` is true/false or an analysis level
+    (fast, standard, full); true means SCENE_ANALYSIS_LEVEL. A parsed
+    `house_continuity` (one a batch shares) stands in for the form's own.
+    Its designDNA comes back as the prompt will use it, measured colors
+    included, so fingerprints match what is actually generated.
+    """
+    # Get aspect ratio from request (frontend calculates it)
+    default_ratio = closest_aspect_ratio(image.width, image.height) if image else '4:3'
+    aspect_ratio = form.get('aspect_ratio', default_ratio)
+    # Validate aspect ratio - must be one of Gemini's supported values
+    if aspect_ratio not in SUPPORTED_ASPECT_RATIOS:
+        aspect_ratio = default_ratio  # Default fallback
+
+    # Get house continuity data if provided
+    if house_continuity is None:
+        house_continuity = parse_house_continuity(form.get('house_continuity'))
+
+    return {
+        "room_type": form.get('room_type', 'LIVING'),
+        "style": form.get('style', 'MODERN'),
+        "analysis_level": parse_analysis_level(form.get('enable_analysis', 'true'), DEFAULT_ANALYSIS_LEVEL),
+        "aspect_ratio": aspect_ratio,
+        "house_continuity": rendered_continuity(house_continuity),
+    }
+
+
+def _or(value, default):
+    return default if value is None else value
+
+
+def build_scene_context(scene_analysis):
+    """Turn a SceneAnalysis into the prompt sections Pro Image sees"""
+    scene_context = ""
+    if not scene_analysis:
+        return scene_context
+
+    # Room dimensions section (NEW)
+    dims = scene_analysis.room_dimensions
+    if dims:
+        scene_context += f"\n=== ROOM DIMENSIONS (CALIBRATED FROM REFERENCE OBJECTS) ===\n"
+        width = dims.width or Estimate()
+        length = dims.length or Estimate()
+        ceiling = dims.ceiling_height or Estimate()
+        # Ranges and area only come with standard and full analyses
+        width_range = f" ({width.estimate_range})" if width.estimate_range else ""
+        length_range = f" ({length.estimate_range})" if length.estimate_range else ""
+        scene_context += f"  - Width: {_or(width.estimate_feet, 14)} feet{width_range}\n"
+        scene_context += f"  - Length/Depth: {_or(length.estimate_feet, 18)} feet{length_range}\n"
+        scene_context += f"  - Ceiling Height: {_or(ceiling.estimate_feet, 9)} feet\n"
+        if dims.total_floor_area_sqft is not None:
+            scene_context += f"  - Total Floor Area: ~{dims.total_floor_area_sqft} sq ft\n"
+
+    # Perspective analysis (NEW)
+    perspective = scene_analysis.perspective_analysis
+    if perspective:
+        scene_context += f"\n=== CAMERA & PERSPECTIVE ===\n"
+        scene_context += f"  - Camera height: {_or(perspective.camera_height, 'standing 5-6ft')}\n"
+        scene_context += f"  - Camera angle: {_or(perspective.camera_angle, 'straight on')}\n"
+        scene_context += f"  - Lens type: {_or(perspective.lens_type, 'normal')}\n"
+        scene_context += f"  - Vanishing point: {_or(perspective.vanishing_point_location, 'center')}\n"
+
+    # Depth mapping (NEW - CRITICAL)
+    depth = scene_analysis.depth_mapping
+    if depth:
+        scene_context += f"\n=== DEPTH ZONES (CRITICAL FOR FURNITURE PLACEMENT) ===\n"
+        scene_context += f"  - Total depth: {_or(depth.total_depth_estimate, '15-20 feet')}\n"
+        zones = (
+            ("FOREGROUND", depth.foreground_zone, "0-5 feet", 20, "small accent pieces"),
+            ("MIDGROUND", depth.midground_zone, "5-12 feet", 50, "main furniture"),
+            ("BACKGROUND", depth.background_zone, "12+ feet", 30, "wall furniture"),
+        )
+        for name, zone, default_range, default_share, default_items in zones:
+            if zone:
+                scene_context += f"  - {name} ({_or(zone.depth_range, default_range)}): {_or(zone.floor_area_percentage, default_share)}% of floor\n"
+                scene_context += f"    Suitable items: {', '.join(zone.suitable_for or [default_items])}\n"
+
+    # Furniture sizing guide (NEW - CRITICAL)
+    if scene_analysis.furniture_sizing_guide:
+        scene_context += f"\n=== FURNITURE SIZING (SCALED TO ROOM) ===\n"
+        for specs in scene_analysis.furniture_sizing_guide:
+            size_info = []
+            if specs.recommended_width_inches:
+                size_info.append(f"width: {specs.recommended_width_inches}\"")
+            if specs.recommended_length_inches:
+                size_info.append(f"length: {specs.recommended_length_inches}\"")
+            if specs.recommended_depth_inches:
+                size_info.append(f"depth: {specs.recommended_depth_inches}\"")
+            if specs.recommended_size:
+                size_info.append(specs.recommended_size)
+            if specs.recommended_height_inches:
+                size_info.append(f"height: {specs.recommended_height_inches}\"")
+            if specs.recommended_diameter_inches:
+                size_info.append(f"diameter: {specs.recommended_diameter_inches}\"")
+            scene_context += f"  - {_or(specs.item, 'furniture').upper()}: {', '.join(size_info)}"
+            if specs.placement:
+                scene_context += f" → {specs.placement}"
+            scene_context += "\n"
+
+    # Doorways section
+    if scene_analysis.doorways:
+        scene_context += f"\n=== DOORWAYS (DO NOT BLOCK - MAINTAIN CLEARANCE) ===\n"
+        for d in scene_analysis.doorways:
+            scene_context += (
+                f"  - {_or(d.location, 'unknown')}: {_or(d.type, 'interior')} door ({_or(d.width_inches, 32)}\" wide), "
+                f"clearance needed: {_or(d.clearance_needed_inches, 36)}\", "
+                f"depth: {_or(d.depth_from_camera_feet, 'unknown')}ft from camera\n"
+            )
+
+    # Windows section
+    if scene_analysis.windows:
+        scene_context += f"\n=== WINDOWS (PRESERVE ACCESS & LIGHT) ===\n"
+        for w in scene_analysis.windows:
+            scene_context += (
+                f"  - {_or(w.location, 'unknown')}: {_or(w.type, 'standard')} "
+                f"({_or(w.width_inches, 48)}\" × {_or(w.height_inches, 60)}\"), "
+                f"{_or(w.natural_light_contribution, 'primary')} light source, "
+                f"depth: {_or(w.depth_from_camera_feet, 'unknown')}ft\n"
+            )
+
+    # Architectural features
+    arch = scene_analysis.architectural_features
+    if arch:
+        scene_context += f"\n=== ARCHITECTURAL CONTEXT ===\n"
+        ceiling_height = _or(arch.ceiling_height_inches, 96)
+        scene_context += f"  - Ceiling: {_or(arch.ceiling, 'flat')}, {ceiling_height}\" ({ceiling_height/12:.1f}ft)\n"
+        scene_context += f"  - Flooring: {_or(arch.flooring_color, 'medium')} {_or(arch.flooring, 'hardwood')}"
+        if arch.floor_pattern:
+            scene_context += f" ({arch.floor_pattern})"
+        scene_context += "\n"
+        scene_context += f"  - Walls: {_or(arch.wall_color, 'neutral')} {_or(arch.walls, 'painted')}\n"
+        if arch.baseboard_height_inches:
+            scene_context += f"  - Baseboard: {arch.baseboard_height_inches}\" tall\n"
+        fp = arch.fireplace
+        if fp and fp.present:
+            scene_context += f"  - Fireplace: {_or(fp.location, '')} ({_or(fp.width_inches, 48)}\" wide, {_or(fp.depth_from_camera_feet, '')}ft deep) - MAKE THIS A FOCAL POINT\n"
+
+    # Spatial layout
+    spatial = scene_analysis.spatial_layout
+    if spatial:
+        scene_context += f"\n=== SPATIAL LAYOUT ===\n"
+        if spatial.shape:
+            scene_context += f"  - Room shape: {spatial.shape}\n"
+        if spatial.width_feet is not None or spatial.length_feet is not None:
+            scene_context += f"  - Dimensions: {_or(spatial.width_feet, 14)}ft × {_or(spatial.length_feet, 18)}ft\n"
+        scene_context += f"  - Focal point: {_or(spatial.focal_point, 'window')} at {_or(spatial.focal_point_location, 'back wall')}\n"
+        scene_context += f"  - Traffic flow: {_or(spatial.natural_traffic_flow, 'through center')}\n"
+        scene_context += f"  - Walkway width needed: {_or(spatial.primary_walkway_width_needed_inches, 36)}\" minimum\n"
+        if spatial.best_furniture_zones:
+            scene_context += f"  - Furniture zones:\n"
+            for zone in spatial.best_furniture_zones:
+                scene_context += f"    • {_or(zone.zone, 'center')}: {_or(zone.size_sqft, 0)} sqft - ideal for {_or(zone.ideal_for, 'furniture')}\n"
+
+    # Lighting
+    lighting = scene_analysis.lighting_analysis
+    if lighting:
+        scene_context += f"\n=== LIGHTING (MATCH EXACTLY FOR REALISM) ===\n"
+        scene_context += f"  - Primary source: {_or(lighting.primary_light_source, 'natural')}\n"
+        scene_context += f"  - Light direction: {_or(lighting.light_direction, 'from windows')}\n"
+        scene_context += f"  - Light intensity: {_or(lighting.light_intensity, 'moderate')}\n"
+        scene_context += f"  - Shadow direction: {_or(lighting.shadow_direction, 'consistent')}\n"
+        scene_context += f"  - Shadow softness: {_or(lighting.shadow_softness, 'medium')}\n"
+        scene_context += f"  - Color temperature: {_or(lighting.color_temperature, 'neutral')}\n"
+
+    # Staging recommendations with depth placement
+    staging_rec = scene_analysis.staging_recommendations
+    if staging_rec:
+        scene_context += f"\n=== AI STAGING GUIDANCE (DEPTH-AWARE) ===\n"
+        ap = staging_rec.anchor_piece
+        if ap:
+            scene_context += f"  - ANCHOR: {_or(ap.item, 'sofa')} ({_or(ap.suggested_width_inches, 90)}\" wide)\n"
+            scene_context += f"    Location: {_or(ap.suggested_location, 'center')}\n"
+            scene_context += f"    Orientation: {_or(ap.orientation, 'facing focal point')}\n"
+
+        # Depth placement guide (NEW - CRITICAL)
+        if staging_rec.depth_placement_guide:
+            scene_context += f"  - DEPTH PLACEMENT:\n"
+            for item in staging_rec.depth_placement_guide:
+                scene_context += f"    • {_or(item.item, 'furniture')}: {_or(item.depth_from_camera_feet, '?')}ft from camera ({_or(item.reason, '')})\n"
+
+        if staging_rec.traffic_paths_to_preserve:
+            scene_context += f"  - KEEP CLEAR:\n"
+            for path in staging_rec.traffic_paths_to_preserve:
+                scene_context += f"    • {_or(path.from_, '')} → {_or(path.to, '')}: min {_or(path.minimum_width_inches, 36)}\" clearance\n"
+
+        if staging_rec.areas_to_avoid:
+            scene_context += f"  - AVOID: {', '.join(staging_rec.areas_to_avoid)}\n"
+        scene_context += f"  - SCALE: {_or(staging_rec.scale_guidance, 'appropriate for room size')}\n"
+
+    return scene_context
+
+
+# House continuity: the palette each house's staged rooms actually rendered,
+# measured after every generation and fed back into the next room's prompt
+house_palettes = HousePalettes(os.path.join(STATE_DIR, "houses"))
+DESIGN_DNA_EXTRACTION = os.getenv("DESIGN_DNA_EXTRACTION", "true").lower() == "true"
+
+
+def house_design_dna(palette):
+    return {**describe_palette(palette["swatches"]), "roomsMeasured": palette["rooms"]}
+
+
+def rendered_continuity(house_continuity):
+    """house_continuity with its designDNA colors replaced by the house's measured palette, if any"""
+    if not house_continuity or not DESIGN_DNA_EXTRACTION:
+        return house_continuity
+    palette = house_palettes.get(str(house_continuity.get("id", "")))
+    if not palette or not palette["swatches"]:
+        return house_continuity
+    measured = {k: v for k, v in house_design_dna(palette).items() if k != "roomsMeasured"}
+    return {**house_continuity, "designDNA": {**house_continuity["designDNA"], **measured}}
+
+
+def update_house_dna(house_continuity, artifact_id, image_bytes, image):
+    """Merge a generated room into its house's palette; the house's measured designDNA, or None"""
+    if not house_continuity or not DESIGN_DNA_EXTRACTION or not house_continuity.get("id"):
+        return None
+    try:
+        with metrics.stage("design_dna"):
+            swatches = extract_swatches(image_bytes, image.data)
+            palette = house_palettes.add_room(str(house_continuity["id"]), artifact_id, swatches)
+    except Exception as e:
+        app.logger.warning(f"Design DNA extraction failed: {str(e)}")
+        return None
+    return house_design_dna(palette) if palette and palette["swatches"] else None
+
+
+def build_generation_prompt(room_type, style, scene_context, house_continuity=None):
+    room_context = ROOM_CONTEXT.get(room_type, "living room")
+    style_context = STYLE_CONTEXT.get(style, "Modern style")
+
+    if house_continuity:
+        dna = house_continuity['designDNA']
+        rooms_staged = house_continuity['roomsStaged']
+        house_name = house_continuity['name']
+
+        prompt = f"""Transform this empty {room_context} into a beautifully staged room.
 
 Style: {style_context}
 
@@ -537,8 +1183,8 @@ CRITICAL REQUIREMENTS:
 - Photorealistic quality, professional real estate photography look
 
 Generate the virtually staged version of this room with perfect house-wide design continuity."""
-        else:
-            prompt = f"""Transform this empty {room_context} into a beautifully staged room.
+    else:
+        prompt = f"""Transform this empty {room_context} into a beautifully staged room.
 
 Style: {style_context}
 {scene_context}
@@ -554,129 +1200,677 @@ CRITICAL REQUIREMENTS:
 
 Generate the virtually staged version of this room."""
 
-        payload = {
-            "contents": [{
-                "parts": [
-                    {"inlineData": {"mimeType": mime_type, "data": base64_image}},
-                    {"text": f"{prompt}\n\nIMPORTANT: Generate the output image with the same aspect ratio as the input image ({aspect_ratio})."}
-                ]
-            }],
-            "generationConfig": {
-                "responseModalities": ["image", "text"]
-            }
+    return prompt
+
+
+def summarize_scene_analysis(scene_analysis):
+    """The subset of the scene analysis returned to the client"""
+    dims = scene_analysis.room_dimensions
+    depth = scene_analysis.depth_mapping
+    staging_rec = scene_analysis.staging_recommendations
+
+    def estimate(value):
+        return value.estimate_feet if value else None
+
+    def zone_range(zone):
+        return zone.depth_range if zone else None
+
+    return {
+        "level": scene_analysis.level,
+        "detected_room": scene_analysis.detected_room_type,
+        "room_state": scene_analysis.room_state,
+        "confidence": scene_analysis.confidence,
+        # Room dimensions
+        "dimensions": {
+            "width_feet": estimate(dims.width) if dims else None,
+            "length_feet": estimate(dims.length) if dims else None,
+            "ceiling_feet": estimate(dims.ceiling_height) if dims else None,
+            "area_sqft": dims.total_floor_area_sqft if dims else None,
+        },
+        # Depth analysis
+        "depth": {
+            "total": depth.total_depth_estimate if depth else None,
+            "foreground": zone_range(depth.foreground_zone) if depth else None,
+            "midground": zone_range(depth.midground_zone) if depth else None,
+            "background": zone_range(depth.background_zone) if depth else None,
+        },
+        # Perspective
+        "perspective": scene_analysis_dict(scene_analysis.perspective_analysis) if scene_analysis.perspective_analysis else {},
+        # Counts
+        "doorways_count": len(scene_analysis.doorways),
+        "windows_count": len(scene_analysis.windows),
+        # Layout & lighting
+        "spatial": scene_analysis_dict(scene_analysis.spatial_layout) if scene_analysis.spatial_layout else {},
+        "lighting": scene_analysis_dict(scene_analysis.lighting_analysis) if scene_analysis.lighting_analysis else {},
+        # Furniture sizing, by item
+        "furniture_sizing": {
+            size.item: {k: v for k, v in scene_analysis_dict(size).items() if k != "item"}
+            for size in scene_analysis.furniture_sizing_guide if size.item
+        },
+        # Recommendations
+        "recommendations": scene_analysis_dict(staging_rec) if staging_rec else {}
+    }
+
+
+def run_generation(image, params, gemini_key, on_stage=None):
+    """Steps for scene analysis followed by Pro Image generation; they produce the response body.
+
+    `image` is an IngestedImage. on_stage, when given, is called with
+    "analyzing" and "generating" as the pipeline moves along. It runs under
+    the deadline coalesced_generation opens; the body's `degradations` lists
+    what was given up to stay within it. Provider failures raise PipelineError.
+    """
+    degradations = []
+    # ============== SCENE ANALYSIS ==============
+    scene_analysis = None
+    if params["analysis_level"]:
+        if on_stage:
+            on_stage("analyzing")
+        with metrics.stage("analysis"):
+            scene_analysis = yield from analyze_scene(image, gemini_key, params["analysis_level"], degradations)
+
+    build_payload = generation_payload_builder(params, scene_analysis)
+
+    if on_stage:
+        on_stage("generating")
+    # Use Gemini 3 Pro Image Preview (Nano Banana Pro) for high-quality staging
+    started = time.monotonic()
+    with metrics.stage("generation"):
+        response = yield pipeline.call(gemini_files.generate, gemini_files.agenerate, IMAGE_GENERATION_MODEL, image,
+                                       build_payload, gemini_key, "generation")
+    # Decoding and storing the output is CPU and disk work
+    return (yield pipeline.blocking(finish_generation, response, time.monotonic() - started, image, params,
+                                    scene_analysis, degradations))
+
+
+def finish_generation(response, elapsed, image, params, scene_analysis, degradations):
+    """read_generation, recording the call's latency if it succeeded"""
+    if response.status_code == 200:
+        generation_latency.observe(elapsed)
+    return read_generation(response, image, scene_analysis, degradations, params["house_continuity"])
+
+
+def generation_payload_builder(params, scene_analysis):
+    """Pro Image payload as a function of the photo's part (inline or file reference)"""
+    # ============== BUILD ENHANCED PROMPT ==============
+    with metrics.stage("prompt_build"):
+        scene_context = build_scene_context(scene_analysis)
+        prompt = build_generation_prompt(params["room_type"], params["style"], scene_context,
+                                         params["house_continuity"])
+
+    return lambda image_part: {
+        "contents": [{
+            "parts": [
+                image_part,
+                {"text": f"{prompt}\n\nIMPORTANT: Generate the output image with the same aspect ratio as the input image ({params['aspect_ratio']})."}
+            ]
+        }],
+        "generationConfig": {
+            "responseModalities": ["image", "text"]
         }
+    }
 
-        response = httpx.post(url, json=payload, timeout=120.0)
 
-        if response.status_code != 200:
-            error_data = response.json()
-            error_msg = error_data.get("error", {}).get("message", "Unknown error")
-            return jsonify({"error": f"Gemini API error: {error_msg}"}), response.status_code
+def read_generation(response, image, scene_analysis, degradations, house_continuity=None):
+    """Store the image in a Pro Image response and build the response body"""
+    if response.status_code != 200:
+        error_data = response.json()
+        error_msg = error_data.get("error", {}).get("message", "Unknown error")
+        raise PipelineError(f"Gemini API error: {error_msg}", response.status_code)
 
+    with metrics.stage("response_parse"):
         result = response.json()
-        candidates = result.get("candidates", [])
-
-        if not candidates:
-            return jsonify({"error": "No image generated"}), 500
-
-        parts = candidates[0].get("content", {}).get("parts", [])
-
-        for part in parts:
-            if "inlineData" in part:
-                image_b64 = part["inlineData"]["data"]
-
-                # Decode and check output dimensions
-                import io
-                from PIL import Image as PILImage
-                image_bytes = base64.b64decode(image_b64)
-                output_img = PILImage.open(io.BytesIO(image_bytes))
-                output_width, output_height = output_img.size
-                app.logger.info(f"Gemini output dimensions: {output_width}x{output_height}")
-
-                response_data = {
-                    "image": f"data:image/png;base64,{image_b64}",
-                    "status": "success",
-                    "output_dimensions": {"width": output_width, "height": output_height}
-                }
-                # Include enhanced scene analysis in response if available
-                if scene_analysis:
-                    dims = scene_analysis.get("room_dimensions", {})
-                    depth = scene_analysis.get("depth_mapping", {})
-                    response_data["scene_analysis"] = {
-                        "detected_room": scene_analysis.get("detected_room_type"),
-                        "room_state": scene_analysis.get("room_state"),
-                        "confidence": scene_analysis.get("confidence"),
-                        # Room dimensions
-                        "dimensions": {
-                            "width_feet": dims.get("width", {}).get("estimate_feet"),
-                            "length_feet": dims.get("length", {}).get("estimate_feet"),
-                            "ceiling_feet": dims.get("ceiling_height", {}).get("estimate_feet"),
-                            "area_sqft": dims.get("total_floor_area_sqft"),
-                        },
-                        # Depth analysis
-                        "depth": {
-                            "total": depth.get("total_depth_estimate"),
-                            "foreground": depth.get("foreground_zone", {}).get("depth_range"),
-                            "midground": depth.get("midground_zone", {}).get("depth_range"),
-                            "background": depth.get("background_zone", {}).get("depth_range"),
-                        },
-                        # Perspective
-                        "perspective": scene_analysis.get("perspective_analysis", {}),
-                        # Counts
-                        "doorways_count": len(scene_analysis.get("doorways", [])),
-                        "windows_count": len(scene_analysis.get("windows", [])),
-                        # Layout & lighting
-                        "spatial": scene_analysis.get("spatial_layout", {}),
-                        "lighting": scene_analysis.get("lighting_analysis", {}),
-                        # Furniture sizing
-                        "furniture_sizing": scene_analysis.get("furniture_sizing_guide", {}),
-                        # Recommendations
-                        "recommendations": scene_analysis.get("staging_recommendations", {})
-                    }
-                return jsonify(response_data)
-
-        return jsonify({"error": "No image in response"}), 500
-
-    except httpx.TimeoutException:
-        return jsonify({"error": "Image generation timed out (try again)"}), 504
-    except Exception as e:
-        app.logger.error(f"Generate image error: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+    candidates = result.get("candidates", [])
+
+    if not candidates:
+        raise PipelineError("No image generated")
+
+    parts = candidates[0].get("content", {}).get("parts", [])
+
+    for part in parts:
+        if "inlineData" in part:
+            with metrics.stage("decode"):
+                image_bytes = base64.b64decode(part["inlineData"]["data"])
+                # Real format and size from the header; no pixels are decoded
+                info = probe(image_bytes)
+            if info is None:
+                raise PipelineError("Unreadable image in response")
+            output_mime, output_width, output_height = info.mime_type, info.width, info.height
+            declared_mime = part["inlineData"].get("mimeType")
+            if declared_mime and declared_mime != output_mime:
+                app.logger.info(f"Gemini declared {declared_mime} for a {output_mime} image")
+            app.logger.info(f"Gemini output dimensions: {output_width}x{output_height}")
+
+            with metrics.stage("artifact_store"):
+                artifact_id = artifact_store.put(image_bytes, output_mime, width=output_width, height=output_height)
+            if DELIVERY_PREENCODE:
+                prepare_deliveries(artifact_id, DELIVERY_PREENCODE)
+
+            response_data = {
+                "image_url": artifact_url(artifact_id),
+                "artifact": {"id": artifact_id, "mime_type": output_mime, "bytes": len(image_bytes)},
+                "status": "success",
+                "output_dimensions": {"width": output_width, "height": output_height},
+                "input_dimensions": image.dimensions(),
+                "degradations": degradations
+            }
+            house_dna = update_house_dna(house_continuity, artifact_id, image_bytes, image)
+            if house_dna:
+                response_data["house_design_dna"] = house_dna
+            # Include enhanced scene analysis in response if available
+            if scene_analysis:
+                response_data["scene_analysis"] = summarize_scene_analysis(scene_analysis)
+            return response_data
+
+    raise PipelineError("No image in response")
+
+
+# ============== ADMISSION SCHEDULING ==============
+
+# A listing batch must not hold every slot while agents wait for one image
+admission = AdmissionScheduler(
+    slots=int(os.getenv("SCHEDULER_SLOTS", 8)),
+    reserved=int(os.getenv("SCHEDULER_INTERACTIVE_RESERVED", 2)),
+    tenant_max_concurrency=int(os.getenv("SCHEDULER_TENANT_MAX_CONCURRENCY", 4)),
+    tenants=json.loads(os.getenv("SCHEDULER_TENANTS") or "{}"),
+    max_wait={
+        "interactive": float(os.getenv("SCHEDULER_INTERACTIVE_MAX_WAIT_SECONDS", 30)),
+        "batch": float(os.getenv("SCHEDULER_BATCH_MAX_WAIT_SECONDS", 120)),
+    },
+    slo_seconds={
+        "interactive": float(os.getenv("SCHEDULER_INTERACTIVE_SLO_SECONDS", 2)),
+        "batch": float(os.getenv("SCHEDULER_BATCH_SLO_SECONDS", 60)),
+    },
+)
+SCHEDULER_TENANT_HEADER = os.getenv("SCHEDULER_TENANT_HEADER", "X-Tenant-ID")
 
 
-# ============== ROOM ANALYSIS (Gemini 3 Flash) ==============
+def request_scheduling(headers, remote_addr, default_class="interactive"):
+    """(tenant, class) for scheduler.bind(); X-Request-Class: batch moves a
+    request behind interactive ones, never the other way round
+    """
+    tenant = scheduler.tenant_id(headers, remote_addr, SCHEDULER_TENANT_HEADER)
+    if (headers.get("X-Request-Class") or "").strip().lower() == "batch":
+        return tenant, "batch"
+    return tenant, default_class
 
-@app.route("/analyze", methods=["POST"])
-def analyze_room():
-    """Analyze room geometry using Gemini 3 Flash Preview"""
+
+# ============== COALESCING & IDEMPOTENCY ==============
+
+# Double-clicks, proxy retries and duplicate tabs share one upstream generation
+generation_flight = SingleFlight(os.path.join(STATE_DIR, "inflight"))
+idempotency_store = IdempotencyStore(
+    os.path.join(STATE_DIR, "idempotency"),
+    ttl_seconds=int(os.getenv("IDEMPOTENCY_TTL_SECONDS", 24 * 3600)),
+)
+
+
+GENERATION_TIMEOUT_MESSAGE = "Image generation timed out (try again)"
+
+
+def generation_fingerprint(image_hash, params):
+    continuity = params["house_continuity"]
+    return fingerprint(
+        image_hash,
+        params["room_type"],
+        params["style"],
+        params["aspect_ratio"],
+        params["analysis_level"],
+        fingerprint(continuity) if continuity else None,
+    )
+
+
+def coalesced_generation(image, params, gemini_key, on_stage=None):
+    """run_generation, sharing the call with any identical request in flight.
+    The request leading the call waits for an admission slot first. The
+    wait counts against PIPELINE_DEADLINE_SECONDS, so a request that queued
+    for a while gets less time to run, never more than the deadline overall.
+    """
+    def lead():
+        with deadlines.deadline_scope(PIPELINE_DEADLINE_SECONDS), admission.slot():
+            return pipeline.run(run_generation(image, params, gemini_key, on_stage=on_stage))
+
+    key = generation_fingerprint(image_digest(image.data), params)
+    result, _ = generation_flight.do(key, lead)
+    return result
+
+
+async def coalesced_generation_async(image, params, gemini_key):
+    async def lead():
+        with deadlines.deadline_scope(PIPELINE_DEADLINE_SECONDS):
+            async with admission.aslot():
+                return await pipeline.arun(run_generation(image, params, gemini_key))
+
+    key = generation_fingerprint(image_digest(image.data), params)
+    result, _ = await generation_flight.ado(key, lead)
+    return result
+
+
+def stored_response(scope, idempotency_key, request_fingerprint):
+    """Stored {"status_code", "body"} for an Idempotency-Key, if any"""
+    if not idempotency_key:
+        return None
+    return idempotency_store.get(scope, idempotency_key, request_fingerprint)
+
+
+def idempotent_replay(scope, request_fingerprint):
+    """Stored response for the request's Idempotency-Key, if any"""
+    stored = stored_response(scope, request.headers.get("Idempotency-Key"), request_fingerprint)
+    if stored is None:
+        return None
+    return jsonify(stored["body"]), stored["status_code"], {"Idempotent-Replayed": "true"}
+
+
+def store_response(scope, idempotency_key, request_fingerprint, status_code, body):
+    if idempotency_key:
+        idempotency_store.set(scope, idempotency_key, request_fingerprint, status_code, body)
+
+
+def remember_idempotent(scope, request_fingerprint, status_code, body):
+    store_response(scope, request.headers.get("Idempotency-Key"), request_fingerprint, status_code, body)
+
+
+def generation_response(image, form, gemini_key, idempotency_key, scheduling):
+    """Steps for /generate-image after the upload is read; they produce (body, status, headers).
+    `scheduling` is request_scheduling()'s (tenant, class).
+    """
+    # Reads the house's measured palette from disk
+    params = yield pipeline.blocking(parse_generation_params, form, image)
+
+    request_fingerprint = generation_fingerprint(image_digest(image.data), params)
+    stored = yield pipeline.blocking(stored_response, "generate-image", idempotency_key, request_fingerprint)
+    if stored is not None:
+        return stored["body"], stored["status_code"], {"Idempotent-Replayed": "true"}
+
+    with scheduler.bind(*scheduling):
+        result = yield pipeline.call(coalesced_generation, coalesced_generation_async, image, params, gemini_key)
+    yield pipeline.blocking(store_response, "generate-image", idempotency_key, request_fingerprint, 200, result)
+    return result, 200, {}
+
+
+@app.route("/generate-image", methods=["POST"])
+def generate_image():
+    """Generate staged room image using Gemini 3 Pro Image (Nano Banana Pro)
+
+    An optional Idempotency-Key header replays the stored result of an
+    earlier successful request with the same key and parameters.
+    """
     try:
         gemini_key = get_gemini_key()
         if not gemini_key:
             return jsonify({"error": "GEMINI_API_KEY not configured"}), 503
 
-        if 'image' not in request.files:
-            return jsonify({"error": "No image provided"}), 400
+        image = request_image(request.form, request.files)
+        body, status_code, headers = pipeline.run(generation_response(
+            image, request.form, gemini_key, request.headers.get("Idempotency-Key"),
+            request_scheduling(request.headers, request.remote_addr),
+        ))
+        with metrics.stage("serialize"):
+            return jsonify(body), status_code, headers
+
+    except Exception as e:
+        return error_response(e, "Generate image", GENERATION_TIMEOUT_MESSAGE)
+
+
+# ============== GENERATION JOBS ==============
+
+# Job records are shared on disk so any worker can answer a poll; the pipeline
+# itself runs on a bounded pool inside the worker that accepted the job.
+job_store = JobStore(
+    os.getenv("JOBS_DIR", os.path.join(STATE_DIR, "jobs")),
+    ttl_seconds=int(os.getenv("JOB_TTL_SECONDS", 3600)),
+    stale_seconds=int(os.getenv("JOB_STALE_SECONDS", 60)),
+)
+job_runner = JobRunner(
+    job_store,
+    max_workers=int(os.getenv("JOB_WORKERS", 4)),
+    max_queued=int(os.getenv("JOB_QUEUE_SIZE", 32)),
+)
+
+# Comment lines keep idle SSE connections from being cut by proxies
+SSE_HEARTBEAT_SECONDS = 15
+
+
+def job_view(job):
+    return {
+        "job_id": job["id"],
+        "status": job["stage"],
+        "result": job["result"],
+        "error": job["error"],
+        "status_code": job["status_code"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+    }
+
 
-        image_file = request.files['image']
-        image_data = image_file.read()
-        base64_image = base64.b64encode(image_data).decode("utf-8")
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    """Queue a generation and return its job id immediately"""
+    try:
+        gemini_key = get_gemini_key()
+        if not gemini_key:
+            return jsonify({"error": "GEMINI_API_KEY not configured"}), 503
 
-        filename = image_file.filename.lower()
-        if filename.endswith('.png'):
-            mime_type = "image/png"
-        elif filename.endswith('.webp'):
-            mime_type = "image/webp"
+        image = spooled = None
+        if request.form.get('upload_id'):
+            image = stored_upload(request.form['upload_id'])
+            raw_digest = image_digest(image.data)
         else:
-            mime_type = "image/jpeg"
+            # The request's own spool is gone once it is answered
+            spooled, raw_digest = spool_upload(image_file(request.files).stream)
+        params = parse_generation_params(request.form, image)
+
+        # Retried submissions with the same Idempotency-Key get the original job back
+        request_fingerprint = generation_fingerprint(raw_digest, params)
+        replay = idempotent_replay("jobs", request_fingerprint)
+        if replay:
+            if spooled is not None:
+                spooled.close()
+            return replay
+
+        scheduling = request_scheduling(request.headers, request.remote_addr)
+
+        def run_job(set_stage):
+            try:
+                # Normalize inside the job so submission stays a few milliseconds
+                with metrics.bind_endpoint("submit_job"), scheduler.bind(*scheduling):
+                    return coalesced_generation(image or ingest_image(spooled), params, gemini_key, on_stage=set_stage)
+            except Exception as e:
+                # Record the status and message POST /generate-image would have answered
+                body, status_code, _ = error_body(e, "Job", GENERATION_TIMEOUT_MESSAGE)
+                raise PipelineError(body["error"], status_code)
+            finally:
+                if spooled is not None:
+                    spooled.close()
+
+        try:
+            job = job_runner.submit(run_job)
+        except Exception:
+            if spooled is not None:
+                spooled.close()
+            raise
+
+        status_url = url_for("get_job", job_id=job["id"])
+        body = {
+            "job_id": job["id"],
+            "status": job["stage"],
+            "status_url": status_url,
+            "events_url": url_for("job_events", job_id=job["id"]),
+        }
+        remember_idempotent("jobs", request_fingerprint, 202, body)
+        return jsonify(body), 202, {"Location": status_url}
+
+    except JobQueueFull:
+        return jsonify({"error": "Too many queued jobs, try again shortly"}), 503, {"Retry-After": "5"}
+    except Exception as e:
+        return error_response(e, "Submit job")
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job_view(job))
+
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    """Server-Sent Events stream of a job's stage transitions"""
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    def stream(current):
+        version = 0
+        while current is not None:
+            if current["version"] > version:
+                version = current["version"]
+                yield sse_event(current['stage'], job_view(current))
+                if current["stage"] in FINISHED_STAGES:
+                    return
+            else:
+                yield ": keep-alive\n\n"
+            current = job_store.wait_for_change(job_id, version, SSE_HEARTBEAT_SECONDS)
+
+    return Response(stream(job), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+
+# ============== BATCH GENERATION ==============
+
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 4))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", 8))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 100))
 
-        # Use Gemini 3 Flash Preview for fast analysis
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-3-flash-preview:generateContent?key={gemini_key}"
 
-        payload = {
-            "contents": [{
-                "parts": [
-                    {"inlineData": {"mimeType": mime_type, "data": base64_image}},
-                    {"text": """Perform a forensic spatial audit of this room. Identify and map:
+@app.route("/generate-batch", methods=["POST"])
+def generate_batch():
+    """Stage a whole listing concurrently, streaming one NDJSON line per finished image.
+
+    Multipart fields: repeated `images` files, `items` (JSON list aligned with
+    the files, each with its own room_type/style/aspect_ratio/enable_analysis
+    and an optional `id`), an optional shared `house_continuity` block and an
+    optional `concurrency` capped at BATCH_MAX_CONCURRENCY. An item with an
+    `upload_id` uses that stored upload and takes no file; the files go, in
+    order, to the other items.
+
+    Photos stay in the request's spooled files until a worker picks their
+    item up, so only the items in progress are ever held in memory.
+    """
+    gemini_key = get_gemini_key()
+    if not gemini_key:
+        return jsonify({"error": "GEMINI_API_KEY not configured"}), 503
+
+    try:
+        items = json.loads(request.form.get('items') or '[]')
+        concurrency = int(request.form.get('concurrency', BATCH_CONCURRENCY))
+        # Parsed once: a bad block is one 400, not a failure per item
+        house_continuity = parse_house_continuity(request.form.get('house_continuity'))
+    except (ValueError, PipelineError) as e:
+        return jsonify({"error": f"Invalid batch parameters: {str(e)}"}), 400
+    if not isinstance(items, list):
+        return jsonify({"error": "items must be a JSON list"}), 400
+
+    images = iter(request.files.getlist('images'))
+    work = []
+    for index, item in enumerate(items):
+        has_upload = isinstance(item, dict) and bool(item.get('upload_id'))
+        work.append((index, item, None if has_upload else next(images, None)))
+    for image in images:
+        work.append((len(work), {}, image))
+    if not work:
+        return jsonify({"error": "No images provided"}), 400
+    if len(work) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"At most {BATCH_MAX_ITEMS} images per batch"}), 400
+    concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY, len(work)))
+
+    scheduling = request_scheduling(request.headers, request.remote_addr, default_class="batch")
+
+    def run_item(index, item, image_file):
+        if not isinstance(item, dict):
+            raise PipelineError("Batch item must be a JSON object", 400)
+        with metrics.bind_endpoint("generate_batch"), scheduler.bind(*scheduling):
+            if item.get('upload_id'):
+                image = stored_upload(item['upload_id'])
+            elif image_file is None:
+                raise UploadError("No image provided")
+            else:
+                image = ingest_image(image_file.stream)
+            params = parse_generation_params(item, image, house_continuity)
+            return coalesced_generation(image, params, gemini_key)
+
+    def stream():
+        succeeded = failed = 0
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch")
+        try:
+            futures = {executor.submit(run_item, *entry): entry for entry in work}
+            for future in as_completed(futures):
+                index, item = futures[future][:2]
+                line = {"index": index}
+                if isinstance(item, dict) and "id" in item:
+                    line["id"] = item["id"]
+                try:
+                    line["result"] = future.result()
+                    line["status"] = "success"
+                    succeeded += 1
+                except Exception as e:
+                    # One bad photo must not abort the rest of the listing
+                    body, status_code, _ = error_body(e, "Batch item", GENERATION_TIMEOUT_MESSAGE)
+                    line.update(body, status="error", status_code=status_code)
+                    failed += 1
+                yield json.dumps(line) + "\n"
+            yield json.dumps({"status": "complete", "succeeded": succeeded, "failed": failed}) + "\n"
+        finally:
+            # Client went away or we're done: don't start anything still queued,
+            # and let running items finish with the uploads they are reading
+            # before the request context closes them
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    # The request context, and with it the uploaded files, lives until the stream ends
+    return Response(stream_with_context(stream()), mimetype="application/x-ndjson",
+                    headers={"X-Accel-Buffering": "no"})
+
+
+# ============== STAGE + GENERATE ==============
+
+# Claude's description and the Gemini pipeline don't depend on each other, so
+# /stage-and-generate runs them side by side; each has its own time budget
+BRANCH_TIMEOUTS = {
+    "stage": float(os.getenv("STAGE_BRANCH_TIMEOUT_SECONDS", 90)),
+    "generation": float(os.getenv("GENERATION_BRANCH_TIMEOUT_SECONDS", 180)),
+}
+BRANCH_TIMEOUT_MESSAGES = {
+    "stage": "Staging description timed out",
+    "generation": GENERATION_TIMEOUT_MESSAGE,
+}
+branch_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("BRANCH_THREADS", 16)),
+    thread_name_prefix="branch",
+)
+
+
+def branch_success(body):
+    return {**body, "status": "success"}, 200
+
+
+def branch_failure(name, e):
+    """A failed branch reported the way the standalone endpoint would report it"""
+    body, status_code, _ = error_body(e, f"Stage-and-generate {name}", BRANCH_TIMEOUT_MESSAGES[name])
+    return {**body, "status": "error", "status_code": status_code}, status_code
+
+
+def branch_timeout(name):
+    return {"error": BRANCH_TIMEOUT_MESSAGES[name], "status": "error", "status_code": 504}, 504
+
+
+def combined_result(outcomes):
+    """(body, status): 200 when any branch succeeded, else the generation branch's error status"""
+    succeeded = [name for name, (_, status_code) in outcomes.items() if status_code == 200]
+    body = {name: branch_body for name, (branch_body, _) in outcomes.items()}
+    body["status"] = "success" if len(succeeded) == len(outcomes) else "partial" if succeeded else "error"
+    return body, 200 if succeeded else outcomes["generation"][1]
+
+
+def combined_branches(image, form, params, gemini_key, scheduling):
+    """{branch name: zero-argument callable returning the branch's steps};
+    `scheduling` is request_scheduling()'s (tenant, class)
+    """
+    room_type = form.get('room_type', 'LIVING')
+    style = form.get('style', 'MODERN')
+
+    def generation():
+        if not gemini_key:
+            raise PipelineError("GEMINI_API_KEY not configured", 503)
+        with scheduler.bind(*scheduling):
+            return (yield pipeline.call(coalesced_generation, coalesced_generation_async, image, params, gemini_key))
+
+    return {
+        "stage": lambda: stage_description(image, room_type, style),
+        "generation": generation,
+    }
+
+
+def run_branches(branches, heartbeat=None):
+    """Run branches concurrently; yield (name, (body, status)) as each finishes
+    or runs out of time. With `heartbeat`, yields (None, None) at least that
+    often while waiting. A timed-out branch keeps running in the background
+    (it may still complete a coalesced generation) but is no longer waited for.
+    """
+    started = time.monotonic()
+    futures = {}
+    for name, fn in branches.items():
+        # Each branch keeps the request's metrics labels and Server-Timing entries
+        future = branch_executor.submit(contextvars.copy_context().run, pipeline.run, fn())
+        futures[future] = name
+
+    pending = set(futures)
+    while pending:
+        deadline = min(started + BRANCH_TIMEOUTS[futures[f]] for f in pending)
+        timeout = max(0.0, deadline - time.monotonic())
+        if heartbeat is not None:
+            timeout = min(timeout, heartbeat)
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.discard(future)
+            name = futures[future]
+            try:
+                yield name, branch_success(future.result())
+            except Exception as e:
+                yield name, branch_failure(name, e)
+        now = time.monotonic()
+        for future in [f for f in pending if now >= started + BRANCH_TIMEOUTS[futures[f]]]:
+            pending.discard(future)
+            yield futures[future], branch_timeout(futures[future])
+        if not done and pending and heartbeat is not None:
+            yield None, None
+
+
+@app.route("/stage-and-generate", methods=["POST"])
+def stage_and_generate():
+    """Claude's staging plan and the staged image from one upload, produced concurrently.
+
+    Returns {"stage": ..., "generation": ..., "status": "success|partial|error"};
+    a failed or timed-out branch reports its own error without affecting the
+    other. Send `stream=true` (or Accept: text/event-stream) to get a `stage`
+    and a `generation` event as each finishes, then `done`.
+    """
+    try:
+        image = request_image(request.form, request.files)
+        params = parse_generation_params(request.form, image)
+        branches = combined_branches(image, request.form, params, get_gemini_key(),
+                                     request_scheduling(request.headers, request.remote_addr))
+    except Exception as e:
+        return error_response(e, "Stage-and-generate")
+
+    if wants_stage_stream(request.form, request.headers):
+        def stream():
+            outcomes = {}
+            for name, outcome in run_branches(branches, heartbeat=SSE_HEARTBEAT_SECONDS):
+                if name is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                outcomes[name] = outcome
+                yield sse_event(name, outcome[0])
+            yield sse_event("done", {"status": combined_result(outcomes)[0]["status"]})
+
+        return Response(stream(), mimetype="text/event-stream", headers=SSE_HEADERS)
+
+    body, status_code = combined_result(dict(run_branches(branches)))
+    return jsonify(body), status_code
+
+
+# ============== ROOM ANALYSIS (Gemini 3 Flash) ==============
+
+ROOM_AUDIT_MODEL = "gemini-3-flash-preview"
+
+# Bump whenever ROOM_AUDIT_PROMPT changes so stale cached audits are not reused.
+# The prefix keeps it distinct from other prompts on the same model.
+ROOM_AUDIT_PROMPT_VERSION = "audit-v1"
+
+ROOM_AUDIT_PROMPT = """Perform a forensic spatial audit of this room. Identify and map:
 
 Return JSON with:
 {
@@ -690,45 +1884,84 @@ Return JSON with:
   "estimatedDimensions": {"width": "estimate", "length": "estimate", "ceilingHeight": "estimate"},
   "roomCondition": "empty|partial|furnished",
   "suggestedAnchors": [{"item": "sofa", "position": "facing windows", "reason": "natural light"}]
-}"""}
-                ]
-            }],
-            "generationConfig": {
-                "responseMimeType": "application/json"
-            }
+}"""
+
+
+def room_audit_payload(image_part):
+    # Use Gemini 3 Flash Preview for fast analysis
+    return {
+        "contents": [{
+            "parts": [
+                image_part,
+                {"text": ROOM_AUDIT_PROMPT}
+            ]
+        }],
+        "generationConfig": {
+            "responseMimeType": "application/json"
         }
+    }
 
-        response = httpx.post(url, json=payload, timeout=60.0)
 
-        if response.status_code != 200:
-            error_data = response.json()
-            error_msg = error_data.get("error", {}).get("message", "Unknown error")
-            return jsonify({"error": f"Gemini API error: {error_msg}"}), response.status_code
+def room_audit_result(analysis, image, cached):
+    return {
+        "analysis": analysis,
+        "cached": cached,
+        "input_dimensions": image.dimensions(),
+        "status": "success"
+    }
 
-        result = response.json()
-        candidates = result.get("candidates", [])
 
-        if not candidates:
-            return jsonify({"error": "No analysis generated"}), 500
+def read_room_audit(response, key, image):
+    """(body, status) for a Flash audit response; successful audits are cached under key"""
+    if response.status_code != 200:
+        error_data = response.json()
+        error_msg = error_data.get("error", {}).get("message", "Unknown error")
+        return {"error": f"Gemini API error: {error_msg}"}, response.status_code
+
+    result = response.json()
+    candidates = result.get("candidates", [])
+
+    if not candidates:
+        return {"error": "No analysis generated"}, 500
+
+    parts = candidates[0].get("content", {}).get("parts", [])
+
+    for part in parts:
+        if "text" in part:
+            analysis = json.loads(part["text"])
+            analysis_cache.set(key, analysis)
+            return room_audit_result(analysis, image, cached=False), 200
+
+    return {"error": "No analysis in response"}, 500
+
 
-        parts = candidates[0].get("content", {}).get("parts", [])
+def room_audit(image, gemini_key):
+    """Steps for /analyze after the upload is read; they produce (body, status)"""
+    key = cache_key(image_digest(image.data), ROOM_AUDIT_MODEL, ROOM_AUDIT_PROMPT_VERSION)
+    cached = yield pipeline.blocking(analysis_cache.get, key)
+    if cached is not None:
+        return room_audit_result(cached, image, cached=True), 200
 
-        for part in parts:
-            if "text" in part:
-                import json
-                analysis = json.loads(part["text"])
-                return jsonify({
-                    "analysis": analysis,
-                    "status": "success"
-                })
+    with metrics.stage("analysis"):
+        response = yield pipeline.call(gemini_files.generate, gemini_files.agenerate, ROOM_AUDIT_MODEL, image,
+                                       room_audit_payload, gemini_key, "analysis")
+    return (yield pipeline.blocking(read_room_audit, response, key, image))
+
+
+@app.route("/analyze", methods=["POST"])
+def analyze_room():
+    """Analyze room geometry using Gemini 3 Flash Preview"""
+    try:
+        gemini_key = get_gemini_key()
+        if not gemini_key:
+            return jsonify({"error": "GEMINI_API_KEY not configured"}), 503
 
-        return jsonify({"error": "No analysis in response"}), 500
+        image = request_image(request.form, request.files)
+        body, status_code = pipeline.run(room_audit(image, gemini_key))
+        return jsonify(body), status_code
 
-    except httpx.TimeoutException:
-        return jsonify({"error": "Analysis timed out"}), 504
     except Exception as e:
-        app.logger.error(f"Analyze error: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        return error_response(e, "Analyze", "Analysis timed out")
 
 
 # ============== GET OPTIONS ==============
@@ -741,6 +1974,76 @@ def get_styles():
     })
 
 
+# ============== STATS ==============
+
+@app.route("/stats", methods=["GET"])
+def get_stats():
+    """Per-worker cache, coalescing, idempotency, governor, scheduler and pipeline latency counters"""
+    return jsonify({
+        "pid": os.getpid(),
+        "analysis_cache": analysis_cache.stats(),
+        "near_duplicates": phash_index.stats(),
+        "uploads": upload_store.stats(),
+        "artifacts": artifact_store.stats(),
+        "house_palettes": house_palettes.stats(),
+        "adjustment_previews": adjustment_previews.stats(),
+        "gemini_files": gemini_files.stats(),
+        "coalescing": generation_flight.stats(),
+        "idempotency": idempotency_store.stats(),
+        "governor": governor.stats(),
+        "scheduler": admission.stats(),
+        "pipeline": {
+            "deadline_seconds": PIPELINE_DEADLINE_SECONDS,
+            "analysis_latency": {level: tracker.stats() for level, tracker in analysis_latency.items()},
+            "generation_latency": generation_latency.stats(),
+        }
+    })
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Prometheus scrape endpoint, aggregated across gunicorn workers"""
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+
+# ============== PROFILING ==============
+
+# Off unless PROFILE_SLOW_MS or PROFILE_SAMPLE_RATE is set
+profiler = SamplingProfiler(
+    os.getenv("PROFILE_DIR", os.path.join(STATE_DIR, "profiles")),
+    slow_ms=float(os.getenv("PROFILE_SLOW_MS", 0)),
+    sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", 0)),
+    interval=float(os.getenv("PROFILE_INTERVAL_MS", 5)) / 1000,
+    max_captures=int(os.getenv("PROFILE_MAX_CAPTURES", 200)),
+)
+instrument_profiling(app, profiler, {"stage", "generate_image", "analyze_room"})
+
+
+def admin_authorized():
+    token = os.getenv("ADMIN_TOKEN")
+    return bool(token) and request.headers.get("Authorization") == f"Bearer {token}"
+
+
+@app.route("/admin/profiles", methods=["GET"])
+def list_profiles():
+    """Slowest recent profiler captures (requires ADMIN_TOKEN)"""
+    if not admin_authorized():
+        return jsonify({"error": "Not found"}), 404
+    limit = min(request.args.get('limit', 20, type=int), 200)
+    return jsonify({"enabled": profiler.enabled, "captures": profiler.recent(limit)})
+
+
+@app.route("/admin/profiles/<capture_id>", methods=["GET"])
+def get_profile(capture_id):
+    """A capture's folded stacks, ready for flamegraph.pl or speedscope"""
+    if not admin_authorized():
+        return jsonify({"error": "Not found"}), 404
+    folded = profiler.folded(capture_id)
+    if folded is None:
+        return jsonify({"error": "Capture not found"}), 404
+    return Response(folded, mimetype="text/plain")
+
 # ============== MAIN ==============
 
 if __name__ == "__main__":
@@ -750,10 +2053,17 @@ if __name__ == "__main__":
     print(f"\n🏠 Estate Stage Pro Backend v2.0")
     print(f"   http://localhost:{port}")
     print(f"\n   Endpoints:")
+    print(f"   ├─ /uploads        - Upload a photo once, reuse its upload_id")
     print(f"   ├─ /stage          - Claude staging descriptions {'✓' if os.getenv('ANTHROPIC_API_KEY') else '✗'}")
     print(f"   ├─ /generate-image - Gemini 3 Pro Image (Nano Banana Pro) {'✓' if os.getenv('GEMINI_API_KEY') else '✗'}")
+    print(f"   ├─ /stage-and-generate - Staging plan and staged image in one call")
+    print(f"   ├─ /jobs           - Async generation (submit, poll, SSE events)")
+    print(f"   ├─ /generate-batch - Listing batch generation (NDJSON stream)")
     print(f"   ├─ /analyze        - Gemini 3 Flash room analysis {'✓' if os.getenv('GEMINI_API_KEY') else '✗'}")
-    print(f"   └─ /styles         - Available options")
+    print(f"   ├─ /artifacts/<id> - Generated images (binary, cacheable)")
+    print(f"   ├─ /styles         - Available options")
+    print(f"   ├─ /stats          - Cache counters")
+    print(f"   └─ /metrics        - Prometheus metrics")
     print()
 
     app.run(host="0.0.0.0", port=port, debug=debug)
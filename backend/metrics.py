@@ -0,0 +1,292 @@
+"""Prometheus metrics for the API and the generation pipeline.
+
+Under gunicorn every worker writes its samples to PROMETHEUS_MULTIPROC_DIR
+(prepared in gunicorn.conf.py) and /metrics sums them across workers, so any
+worker can answer a scrape. Without that variable, e.g. under the Flask dev
+server, the default in-process registry is used.
+
+Stage timings are labelled with the endpoint that triggered them. Request
+hooks set it for the handler thread; background work (jobs, batch items)
+binds it explicitly with bind_endpoint(). Stages timed while serving a
+request are also reported back to the client in a Server-Timing header.
+ASGIMetrics does the same for the natively async routes in asgi.py.
+"""
+import contextvars
+import functools
+import os
+import time
+from contextlib import contextmanager
+
+import anthropic
+import httpx
+from flask import g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+NAMESPACE = "estate_stage"
+
+# Stages range from sub-millisecond (prompt assembly) to two minutes (Pro Image)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 180)
+
+REQUEST_SECONDS = Histogram(
+    "request_seconds", "Time to produce a response (to first byte for streams)",
+    ["endpoint", "method", "status"], namespace=NAMESPACE, buckets=LATENCY_BUCKETS,
+)
+STAGE_SECONDS = Histogram(
+    "stage_seconds", "Time spent in each stage of a request",
+    ["endpoint", "stage"], namespace=NAMESPACE, buckets=LATENCY_BUCKETS,
+)
+PAYLOAD_BYTES = Counter(
+    "payload_bytes", "Request and response body bytes",
+    ["endpoint", "direction"], namespace=NAMESPACE,
+)
+IN_FLIGHT = Gauge(
+    "in_flight_requests", "Requests currently being handled",
+    ["endpoint"], namespace=NAMESPACE, multiprocess_mode="livesum",
+)
+PROVIDER_SECONDS = Histogram(
+    "provider_seconds", "Provider call latency per attempt",
+    ["model"], namespace=NAMESPACE, buckets=LATENCY_BUCKETS,
+)
+PROVIDER_RESPONSES = Counter(
+    "provider_responses", "Provider responses by HTTP status",
+    ["model", "status_code"], namespace=NAMESPACE,
+)
+PROVIDER_TIMEOUTS = Counter(
+    "provider_timeouts", "Provider calls that timed out",
+    ["model"], namespace=NAMESPACE,
+)
+DEGRADATIONS = Counter(
+    "degradations", "Pipeline steps skipped or cut short to stay within the deadline",
+    ["endpoint", "kind"], namespace=NAMESPACE,
+)
+HEDGED_CALLS = Counter(
+    "hedged_calls", "Provider calls that were sent a second time after running past their p95",
+    ["call"], namespace=NAMESPACE,
+)
+
+NEAR_DUPLICATES = Counter(
+    "near_duplicate_lookups", "Perceptual hash lookups for photos without a cached scene analysis",
+    ["outcome"], namespace=NAMESPACE,
+)
+NEAR_DUPLICATE_AUDITS = Counter(
+    "near_duplicate_audits", "Borrowed scene analyses checked against a fresh one",
+    ["result"], namespace=NAMESPACE,
+)
+
+DELIVERIES = Counter(
+    "deliveries", "Generated images served, by the format negotiated from Accept",
+    ["format"], namespace=NAMESPACE,
+)
+
+SCHEDULER_QUEUE_SECONDS = Histogram(
+    "scheduler_queue_seconds", "Time generations waited for an admission slot",
+    ["request_class"], namespace=NAMESPACE, buckets=LATENCY_BUCKETS,
+)
+SCHEDULER_ADMISSIONS = Counter(
+    "scheduler_admissions", "Generations admitted or refused by the admission scheduler",
+    ["request_class", "outcome"], namespace=NAMESPACE,
+)
+SCHEDULER_SLO_MISSES = Counter(
+    "scheduler_queue_slo_misses", "Generations that waited longer than their class's queue-time SLO",
+    ["request_class"], namespace=NAMESPACE,
+)
+SCHEDULER_QUEUED = Gauge(
+    "scheduler_queued", "Generations waiting for an admission slot",
+    ["request_class"], namespace=NAMESPACE, multiprocess_mode="livesum",
+)
+
+_endpoint = contextvars.ContextVar("metrics_endpoint", default="background")
+# Per-request stage durations for Server-Timing; None outside a request
+_timings = contextvars.ContextVar("metrics_timings", default=None)
+
+
+def current_timings():
+    return _timings.get() or {}
+
+
+@contextmanager
+def bind_endpoint(name):
+    token = _endpoint.set(name)
+    try:
+        yield
+    finally:
+        _endpoint.reset(token)
+
+
+@contextmanager
+def stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.labels(_endpoint.get(), name).observe(elapsed)
+        timings = _timings.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+
+def degraded(kind):
+    DEGRADATIONS.labels(_endpoint.get(), kind).inc()
+
+
+def timed(name):
+    """Decorator form of stage()"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def observe_provider(model, send):
+    """Run one provider attempt, recording its latency, status code or timeout."""
+    started = time.perf_counter()
+    try:
+        result = send()
+    except Exception as e:
+        _count_provider_error(model, e)
+        raise
+    finally:
+        PROVIDER_SECONDS.labels(model).observe(time.perf_counter() - started)
+    PROVIDER_RESPONSES.labels(model, str(getattr(result, "status_code", 200))).inc()
+    return result
+
+
+async def observe_provider_async(model, send):
+    started = time.perf_counter()
+    try:
+        result = await send()
+    except Exception as e:
+        _count_provider_error(model, e)
+        raise
+    finally:
+        PROVIDER_SECONDS.labels(model).observe(time.perf_counter() - started)
+    PROVIDER_RESPONSES.labels(model, str(getattr(result, "status_code", 200))).inc()
+    return result
+
+
+def _count_provider_error(model, error):
+    if isinstance(error, (httpx.TimeoutException, anthropic.APITimeoutError)):
+        PROVIDER_TIMEOUTS.labels(model).inc()
+    else:
+        # SDK errors carry the HTTP status; transport errors get "error"
+        PROVIDER_RESPONSES.labels(model, str(getattr(error, "status_code", "error"))).inc()
+
+
+def instrument(app, reject=None):
+    """Request latency, payload bytes and in-flight gauges for every route.
+
+    `reject`, if given, runs once the request is being timed but before its
+    upload is parsed; a response it returns ends the request there, and is
+    counted like any other.
+    """
+
+    @app.before_request
+    def _start_request():
+        endpoint = request.endpoint or "unmatched"
+        g.metrics_endpoint = endpoint
+        g.metrics_started = time.perf_counter()
+        _endpoint.set(endpoint)
+        _timings.set({})
+        IN_FLIGHT.labels(endpoint).inc()
+        if request.content_length:
+            PAYLOAD_BYTES.labels(endpoint, "in").inc(request.content_length)
+        if reject is not None:
+            rejection = reject()
+            if rejection is not None:
+                return rejection
+        if request.mimetype == "multipart/form-data":
+            # Parse the upload here so its cost shows up as its own stage
+            with stage("upload_read"):
+                request.files
+
+    @app.after_request
+    def _finish_request(response):
+        endpoint = g.get("metrics_endpoint")
+        if endpoint is not None:
+            REQUEST_SECONDS.labels(endpoint, request.method, str(response.status_code)).observe(
+                time.perf_counter() - g.metrics_started)
+            if not response.is_streamed and response.content_length:
+                PAYLOAD_BYTES.labels(endpoint, "out").inc(response.content_length)
+            timings = _timings.get()
+            if timings:
+                response.headers["Server-Timing"] = server_timing_header(timings, time.perf_counter() - g.metrics_started)
+                # The frontend is on another origin; without this Resource Timing hides the entries
+                response.headers["Timing-Allow-Origin"] = "*"
+        return response
+
+    @app.teardown_request
+    def _end_request(error=None):
+        endpoint = g.get("metrics_endpoint")
+        if endpoint is not None:
+            IN_FLIGHT.labels(endpoint).dec()
+
+
+class ASGIMetrics:
+    """instrument() for an ASGI app; `endpoints` maps paths to endpoint labels"""
+
+    def __init__(self, app, endpoints):
+        self.app = app
+        self.endpoints = endpoints
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        endpoint = self.endpoints.get(scope["path"], "unmatched")
+        started = time.perf_counter()
+        timings = {}
+        _endpoint.set(endpoint)
+        _timings.set(timings)
+        for name, value in scope["headers"]:
+            if name == b"content-length" and value.isdigit():
+                PAYLOAD_BYTES.labels(endpoint, "in").inc(int(value))
+
+        async def send_with_metrics(message):
+            if message["type"] == "http.response.start":
+                REQUEST_SECONDS.labels(endpoint, scope["method"], str(message["status"])).observe(
+                    time.perf_counter() - started)
+                if timings:
+                    header = server_timing_header(timings, time.perf_counter() - started)
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"server-timing", header.encode("latin-1")),
+                        (b"timing-allow-origin", b"*"),
+                    ]
+            elif message["type"] == "http.response.body" and message.get("body"):
+                PAYLOAD_BYTES.labels(endpoint, "out").inc(len(message["body"]))
+            await send(message)
+
+        IN_FLIGHT.labels(endpoint).inc()
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            IN_FLIGHT.labels(endpoint).dec()
+
+
+def server_timing_header(timings, total):
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+def render():
+    """(body, content type) for a scrape, aggregated across workers when possible"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
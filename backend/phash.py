@@ -0,0 +1,319 @@
+"""Perceptual hashes of room photos and a host-wide near-duplicate index.
+
+phash() is the DCT hash: the photo is shrunk to 32x32 grayscale, the
+top-left 8x8 block of its 2D DCT (the lowest frequencies) is kept and each
+coefficient becomes one bit, set if it is above the block's median. The
+64-bit result survives re-encoding, resizing, exposure tweaks and small
+crops or watermarks, so the same room photo re-uploaded by another agent or
+listing lands within a few bits of the original.
+
+PhashIndex finds stored hashes within a Hamming radius by multi-index
+hashing. The 64 bits are split into four 16-bit words; two hashes within
+distance r differ by at most r // 4 bits in at least one word, so a lookup
+probes each word's table for the query word and its neighbours within that
+radius and only checks the full distance of what it finds. Tables are
+sorted NumPy arrays searched with searchsorted; new entries go to a small
+unsorted tail that is scanned directly and merged in once it grows.
+
+Entries are fixed-size records appended to one file that every worker on
+the host shares; before each lookup a worker reads what the others
+appended since. Compaction rewrites the file without expired entries.
+"""
+import io
+import math
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+import numpy as np
+from PIL import Image
+
+try:
+    import fcntl
+except ImportError:  # Windows dev boxes: compaction is then only serialized within a worker
+    fcntl = None
+
+# ============== HASHING ==============
+
+_DCT_SIZE = 32
+_HASH_SIZE = 8
+
+
+def _dct_matrix(n):
+    """Orthonormal DCT-II basis; M @ X @ M.T is the 2D DCT of X"""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+_DCT = _dct_matrix(_DCT_SIZE)
+
+
+def phash(img):
+    """64-bit perceptual hash of a PIL image"""
+    small = img.resize((_DCT_SIZE, _DCT_SIZE), Image.LANCZOS, reducing_gap=3.0).convert("L")
+    coefficients = _DCT @ np.asarray(small, dtype=np.float64) @ _DCT.T
+    low = coefficients[:_HASH_SIZE, :_HASH_SIZE].ravel()
+    return int.from_bytes(np.packbits(low > np.median(low)).tobytes(), "big")
+
+
+def phash_bytes(data):
+    """phash() of encoded image bytes, decoded at reduced scale where the codec allows"""
+    with Image.open(io.BytesIO(data)) as img:
+        img.draft("RGB", (_DCT_SIZE * 2, _DCT_SIZE * 2))
+        return phash(img)
+
+
+def distance(a, b):
+    return (a ^ b).bit_count()
+
+
+# ============== INDEX ==============
+
+_WORDS = 4
+_WORD_BITS = 16
+_WORD_MASK = (1 << _WORD_BITS) - 1
+_SHIFTS = np.array([_WORD_BITS * (_WORDS - 1 - w) for w in range(_WORDS)], dtype=np.uint64)
+
+# hash, aspect ratio, image digest, unix time added
+_RECORD = struct.Struct("<Qf32sI")
+RECORD_DTYPE = np.dtype([("hash", "<u8"), ("aspect", "<f4"), ("digest", "u1", (32,)), ("added", "<u4")])
+_WORD_VALUES = np.arange(1 << _WORD_BITS, dtype=np.uint32)
+_WORD_POPCOUNT = np.bitwise_count(_WORD_VALUES)
+
+
+def _masks(bits):
+    """Every 16-bit XOR mask with at most `bits` bits set"""
+    return _WORD_VALUES[_WORD_POPCOUNT <= bits].astype(np.uint16)
+
+
+@dataclass
+class Match:
+    digest: str
+    aspect_ratio: float
+    distance: int
+
+
+class PhashIndex:
+    # Entries appended since the last rebuild are scanned linearly until there are this many
+    MERGE_THRESHOLD = 4096
+    # Recent false matches kept for /stats
+    SAMPLE_SIZE = 20
+
+    def __init__(self, path, max_entries=500_000, ttl_seconds=7 * 24 * 3600, enabled=True):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._reset()
+        self._lookup_seconds = 0.0
+        self._counters = {
+            "lookups": 0,
+            "reused": 0,
+            "misses": 0,
+            "aspect_mismatches": 0,
+            "not_analyzed": 0,
+            "audits": 0,
+            "audit_disagreements": 0,
+        }
+        self._false_matches = deque(maxlen=self.SAMPLE_SIZE)
+
+    # ---------- public API ----------
+
+    def add(self, fingerprint, digest, aspect_ratio):
+        """Record that `digest` (an image digest) has hash `fingerprint`"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._sync()
+            if any(m.digest == digest for m in self._lookup(fingerprint, 0)):
+                return
+            entries = self._count + 1
+
+        record = _RECORD.pack(fingerprint, aspect_ratio, bytes.fromhex(digest), int(time.time()))
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # One write of a whole record to an O_APPEND file, so concurrent
+            # writers never interleave partial records
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, record)
+            finally:
+                os.close(fd)
+        except OSError:
+            return
+        if entries > self.max_entries:
+            self.compact()
+
+    def lookup(self, fingerprint, radius):
+        """Entries within `radius` bits of `fingerprint`, nearest first"""
+        if not self.enabled:
+            return []
+        started = time.perf_counter()
+        with self._lock:
+            self._sync()
+            matches = self._lookup(fingerprint, radius)
+            self._lookup_seconds += time.perf_counter() - started
+            self._counters["lookups"] += 1
+        return matches
+
+    def record(self, outcome):
+        """Count a lookup's outcome: reused, misses, aspect_mismatches or not_analyzed"""
+        with self._lock:
+            self._counters[outcome] += 1
+
+    def record_audit(self, agreed, digest, match):
+        """Count a reused analysis that was checked against a fresh one"""
+        with self._lock:
+            self._counters["audits"] += 1
+            if not agreed:
+                self._counters["audit_disagreements"] += 1
+                self._false_matches.append({"digest": digest, "matched": match.digest,
+                                            "distance": match.distance, "at": int(time.time())})
+
+    def stats(self):
+        with self._lock:
+            self._sync()
+            stats = dict(self._counters)
+            stats["entries"] = self._count
+            stats["mean_lookup_ms"] = round(self._lookup_seconds * 1000 / stats["lookups"], 4) if stats["lookups"] else None
+            stats["recent_false_matches"] = list(self._false_matches)
+        stats["hit_rate"] = round(stats["reused"] / stats["lookups"], 4) if stats["lookups"] else 0.0
+        stats["false_match_rate"] = (round(stats["audit_disagreements"] / stats["audits"], 4)
+                                     if stats["audits"] else None)
+        stats["enabled"] = self.enabled
+        return stats
+
+    def compact(self):
+        """Rewrite the file without expired entries, keeping at most half of max_entries"""
+        try:
+            with self._compacting():
+                with open(self.path, "rb") as f:
+                    data = f.read()
+                records = np.frombuffer(data[:len(data) - len(data) % _RECORD.size], dtype=RECORD_DTYPE)
+                keep = records[records["added"] > time.time() - self.ttl_seconds][-max(1, self.max_entries // 2):]
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix=".tmp")
+                with os.fdopen(fd, "wb") as f:
+                    f.write(keep.tobytes())
+                # A record appended to the old file between the read and the
+                # rename is lost; that only costs a future cache hit.
+                os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+    # ---------- internals ----------
+
+    @contextmanager
+    def _compacting(self):
+        """Exclusive across the host's workers (within this one without fcntl)"""
+        if fcntl is None:
+            with self._compact_lock:
+                yield
+            return
+        with open(self.path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _reset(self):
+        self._inode = None
+        self._offset = 0
+        self._count = 0
+        self._hashes = np.empty(0, dtype=np.uint64)
+        self._aspects = np.empty(0, dtype=np.float32)
+        self._digests = np.empty((0, 32), dtype=np.uint8)
+        self._added = np.empty(0, dtype=np.uint32)
+        self._sorted = 0  # entries covered by the word tables
+        self._tables = [(np.empty(0, dtype=np.uint16), np.empty(0, dtype=np.int32))] * _WORDS
+
+    def _sync(self):
+        """Load whatever was appended to the file since the last sync"""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            if self._count:
+                self._reset()
+            return
+        if st.st_ino != self._inode or st.st_size < self._offset:
+            self._reset()  # compacted by some worker
+            self._inode = st.st_ino
+        available = (st.st_size - self._offset) // _RECORD.size * _RECORD.size
+        if not available:
+            return
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(self._offset)
+                data = f.read(available)
+        except OSError:
+            return
+        available = len(data) - len(data) % _RECORD.size
+        self._append(np.frombuffer(data[:available], dtype=RECORD_DTYPE))
+        self._offset += available
+
+    def _append(self, records):
+        new_count = self._count + len(records)
+        if new_count > len(self._hashes):
+            capacity = max(new_count, 2 * len(self._hashes), 1024)
+            self._hashes = _grow(self._hashes, capacity)
+            self._aspects = _grow(self._aspects, capacity)
+            self._digests = _grow(self._digests, capacity)
+            self._added = _grow(self._added, capacity)
+        self._hashes[self._count:new_count] = records["hash"]
+        self._aspects[self._count:new_count] = records["aspect"]
+        self._digests[self._count:new_count] = records["digest"]
+        self._added[self._count:new_count] = records["added"]
+        self._count = new_count
+        if self._count - self._sorted > self.MERGE_THRESHOLD:
+            self._rebuild()
+
+    def _rebuild(self):
+        hashes = self._hashes[:self._count]
+        tables = []
+        for shift in _SHIFTS:
+            words = ((hashes >> shift) & np.uint64(_WORD_MASK)).astype(np.uint16)
+            order = np.argsort(words, kind="stable")
+            tables.append((words[order], order.astype(np.int32)))
+        self._tables = tables
+        self._sorted = self._count
+
+    def _lookup(self, fingerprint, radius):
+        query = np.uint64(fingerprint)
+        masks = _masks(radius // _WORDS)
+        candidates = [np.arange(self._sorted, self._count)]
+        for (words, ids), shift in zip(self._tables, _SHIFTS):
+            probes = (np.uint16((fingerprint >> int(shift)) & _WORD_MASK) ^ masks)
+            starts = np.searchsorted(words, probes, side="left")
+            ends = np.searchsorted(words, probes, side="right")
+            candidates.extend(ids[start:end] for start, end in zip(starts, ends) if end > start)
+        ids = np.unique(np.concatenate(candidates))
+        if not len(ids):
+            return []
+
+        distances = np.bitwise_count(self._hashes[ids] ^ query)
+        fresh = self._added[ids] > time.time() - self.ttl_seconds
+        hits = np.flatnonzero((distances <= radius) & fresh)
+        hits = hits[np.argsort(distances[hits], kind="stable")]
+        return [Match(self._digests[ids[i]].tobytes().hex(), float(self._aspects[ids[i]]), int(distances[i])) for i in hits]
+
+
+def _grow(array, capacity):
+    grown = np.empty((capacity,) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+def aspect_matches(a, b, tolerance):
+    """Whether two width/height ratios differ by at most `tolerance` (relative)"""
+    return abs(math.log(a / b)) <= math.log1p(tolerance)
@@ -0,0 +1,67 @@
+"""Request pipelines written once and run under either server.
+
+A pipeline is a generator that yields the Steps it needs performed and is
+sent each step's result back (or has its exception thrown in at the
+yield). run() performs every step in the calling thread, as the Flask
+views do; arun() awaits a step's coroutine form on the event loop and runs
+blocking steps (file-backed stores, decoding, CPU work) in the default
+thread pool, as asgi.py does. The code between the yields is cheap and is
+the same for both, so the two servers differ only in how they do I/O.
+"""
+import asyncio
+
+
+class Step:
+    """One unit of I/O: a blocking callable and an equivalent coroutine function"""
+
+    __slots__ = ("run", "arun")
+
+    def __init__(self, run, arun):
+        self.run = run
+        self.arun = arun
+
+
+def call(sync_fn, async_fn, *args, **kwargs):
+    """A step with a blocking and a coroutine implementation, like
+    gemini_files.generate / agenerate
+    """
+    return Step(lambda: sync_fn(*args, **kwargs), lambda: async_fn(*args, **kwargs))
+
+
+def blocking(fn, *args, **kwargs):
+    """A step that only has a blocking form; kept off the event loop under ASGI"""
+    return Step(lambda: fn(*args, **kwargs), lambda: asyncio.to_thread(fn, *args, **kwargs))
+
+
+def run(steps):
+    """The pipeline's return value, performing each step in this thread"""
+    try:
+        result, error = None, None
+        while True:
+            try:
+                step = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, error = step.run(), None
+            except Exception as e:
+                result, error = None, e
+    finally:
+        steps.close()
+
+
+async def arun(steps):
+    """run() on the event loop; cancelling it closes the pipeline at its current step"""
+    try:
+        result, error = None, None
+        while True:
+            try:
+                step = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, error = await step.arun(), None
+            except Exception as e:
+                result, error = None, e
+    finally:
+        steps.close()
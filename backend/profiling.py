@@ -0,0 +1,217 @@
+"""Opt-in sampling profiler for individual slow requests.
+
+When enabled, a background thread snapshots the stack of every request
+thread that is being profiled every `interval` seconds. A request's samples
+are kept if it ran longer than `slow_ms` or was picked by `sample_rate`, and
+dropped otherwise. Kept captures go to a directory as a small JSON summary
+plus a folded-stack file (one `frame;frame;frame count` line per stack, the
+input format of flamegraph.pl and speedscope). Only the newest
+`max_captures` are kept.
+
+Off by default, and when off no request hooks are installed at all. Only
+the handler thread is sampled. Work handed to the job or batch pools is
+not included in a capture.
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+
+from flask import g, request
+
+from metrics import current_timings
+
+
+class _Session:
+    def __init__(self, sampled):
+        self.sampled = sampled
+        self.stacks = Counter()
+        self.samples = 0
+
+
+class SamplingProfiler:
+    def __init__(self, directory, slow_ms=0, sample_rate=0.0, interval=0.005, max_captures=200):
+        self.directory = directory
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.max_captures = max_captures
+        self.enabled = slow_ms > 0 or sample_rate > 0
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def begin(self):
+        """Start sampling the calling thread; returns a session or None."""
+        if not self.enabled:
+            return None
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        if not sampled and self.slow_ms <= 0:
+            return None
+        session = _Session(sampled)
+        with self._lock:
+            self._sessions[threading.get_ident()] = session
+            self._ensure_sampler()
+        self._wake.set()
+        return session
+
+    def cancel(self):
+        with self._lock:
+            self._sessions.pop(threading.get_ident(), None)
+
+    def end(self, session, duration_ms, **info):
+        """Stop sampling; write a capture if the request qualified. Returns its id."""
+        self.cancel()
+        slow = self.slow_ms > 0 and duration_ms >= self.slow_ms
+        if not session.samples or not (slow or session.sampled):
+            return None
+        return self._write(session, duration_ms, "slow" if slow else "sampled", info)
+
+    def recent(self, limit=20):
+        """Summaries of stored captures, slowest first"""
+        captures = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), "r", encoding="utf-8") as f:
+                    captures.append(json.load(f))
+            except (ValueError, OSError):
+                continue
+        captures.sort(key=lambda c: c["duration_ms"], reverse=True)
+        return captures[:limit]
+
+    def folded(self, capture_id):
+        if not capture_id.replace("-", "").isalnum():
+            return None
+        try:
+            with open(os.path.join(self.directory, f"{capture_id}.folded"), "r", encoding="utf-8") as f:
+                return f.read()
+        except (FileNotFoundError, OSError):
+            return None
+
+    def _ensure_sampler(self):
+        # Threads don't survive fork, so this also restarts it in workers
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                sessions = dict(self._sessions)
+            if not sessions:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            frames = sys._current_frames()
+            for ident, session in sessions.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    session.stacks[_fold(frame)] += 1
+                    session.samples += 1
+            del frames
+            time.sleep(self.interval)
+
+    def _write(self, session, duration_ms, reason, info):
+        capture_id = f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}"
+        summary = {
+            "id": capture_id,
+            "reason": reason,
+            "duration_ms": round(duration_ms, 1),
+            "samples": session.samples,
+            "interval_ms": self.interval * 1000,
+            "pid": os.getpid(),
+            "created_at": time.time(),
+            "top_frames": _top_frames(session.stacks),
+            **info,
+        }
+        folded = "".join(f"{stack} {count}\n" for stack, count in session.stacks.most_common())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Folded stacks first: a capture is only listed once its summary exists
+            _atomic_write(os.path.join(self.directory, f"{capture_id}.folded"), folded)
+            _atomic_write(os.path.join(self.directory, f"{capture_id}.json"), json.dumps(summary))
+            self._rotate()
+        except OSError:
+            return None
+        return capture_id
+
+    def _rotate(self):
+        names = sorted(n for n in os.listdir(self.directory) if n.endswith(".json"))
+        # Ids start with a millisecond timestamp, so name order is age order
+        for name in names[:max(0, len(names) - self.max_captures)]:
+            for suffix in (".json", ".folded"):
+                try:
+                    os.remove(os.path.join(self.directory, name[:-5] + suffix))
+                except OSError:
+                    pass
+
+
+def _fold(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+def _top_frames(stacks, limit=10):
+    """Leaf frames that held the most samples: where the time actually went"""
+    leaves = Counter()
+    for stack, count in stacks.items():
+        leaves[stack.rsplit(";", 1)[-1]] += count
+    return [{"frame": frame, "samples": count} for frame, count in leaves.most_common(limit)]
+
+
+def _atomic_write(path, text):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def instrument(app, profiler, endpoints):
+    """Profile requests to the given endpoints (by Flask endpoint name)"""
+    if not profiler.enabled:
+        return
+
+    @app.before_request
+    def _start_profile():
+        if request.endpoint in endpoints:
+            g.profile_session = profiler.begin()
+            g.profile_started = time.perf_counter()
+
+    @app.after_request
+    def _finish_profile(response):
+        session = g.get("profile_session")
+        if session is not None:
+            capture_id = profiler.end(
+                session,
+                (time.perf_counter() - g.profile_started) * 1000,
+                endpoint=request.endpoint,
+                method=request.method,
+                status=response.status_code,
+                stages_ms={name: round(seconds * 1000, 1) for name, seconds in current_timings().items()},
+            )
+            g.profile_session = None
+            if capture_id:
+                response.headers["X-Profile-Id"] = capture_id
+        return response
+
+    @app.teardown_request
+    def _drop_profile(error=None):
+        # after_request is skipped when a handler raises; stop sampling this thread anyway
+        if g.get("profile_session") is not None:
+            profiler.cancel()
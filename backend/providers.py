@@ -0,0 +1,368 @@
+"""Process-wide provider clients.
+
+Every Gemini call in a worker goes through one pooled, keep-alive
+httpx.Client (HTTP/2 when h2 is installed) instead of paying DNS, TCP and TLS
+setup per request. Clients are dropped in forked children so each gunicorn
+worker builds its own pool rather than sharing the parent's sockets.
+
+All outbound calls, Gemini and Anthropic alike, pass through the shared
+Governor (rate limits, retries, circuit breakers; see governor.py). Gemini
+timeouts are further capped by the request's deadline, if any (deadlines.py).
+
+Gemini request bodies are streamed: image bytes in a payload are wrapped
+in Base64Bytes and encoded chunk by chunk as the body is sent, so a request
+never holds a base64 copy of its photo or a serialized JSON document.
+
+The `*_async` variants serve the ASGI handlers (asgi.py). Their clients are
+bound to the running event loop and get a much larger connection pool, since
+one async worker is expected to hold hundreds of calls open at once.
+"""
+import asyncio
+import base64
+import json
+import os
+import threading
+import uuid
+
+import anthropic
+import httpx
+
+import metrics
+import scheduler
+from deadlines import clamp_timeout
+from governor import Governor, Outcome, parse_retry_after
+
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com").rstrip("/")
+
+# connect/pool stay short so a dead host fails fast; read is sized per model
+TIMEOUTS = {
+    "analysis": httpx.Timeout(connect=5.0, read=60.0, write=20.0, pool=10.0),
+    "generation": httpx.Timeout(connect=5.0, read=120.0, write=30.0, pool=10.0),
+    "stage": httpx.Timeout(connect=5.0, read=90.0, write=20.0, pool=10.0),
+    "upload": httpx.Timeout(connect=5.0, read=30.0, write=30.0, pool=10.0),
+}
+
+# Governor lane and metrics label for Files API uploads
+FILES_LANE = "gemini-files"
+
+# The pool only ever talks to the Gemini host, so these are per-host limits
+POOL_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("PROVIDER_MAX_CONNECTIONS", 20)),
+    max_keepalive_connections=int(os.getenv("PROVIDER_MAX_KEEPALIVE", 10)),
+    keepalive_expiry=float(os.getenv("PROVIDER_KEEPALIVE_SECONDS", 60)),
+)
+
+# Async workers multiplex many more in-flight calls over one process
+ASYNC_POOL_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("ASYNC_PROVIDER_MAX_CONNECTIONS", 500)),
+    max_keepalive_connections=int(os.getenv("ASYNC_PROVIDER_MAX_KEEPALIVE", 100)),
+    keepalive_expiry=float(os.getenv("PROVIDER_KEEPALIVE_SECONDS", 60)),
+)
+
+_lock = threading.Lock()
+_http_client = None
+_anthropic_client = None
+# (event loop, client): async clients can't be shared across loops
+_async_http_client = (None, None)
+_async_anthropic_client = (None, None)
+
+
+def _build_governor():
+    return Governor(
+        limits=json.loads(os.getenv("PROVIDER_RATE_LIMITS") or "{}"),
+        max_wait=float(os.getenv("PROVIDER_MAX_WAIT_SECONDS", 10)),
+        max_retries=int(os.getenv("PROVIDER_MAX_RETRIES", 2)),
+        failure_threshold=int(os.getenv("PROVIDER_BREAKER_THRESHOLD", 5)),
+        reset_seconds=float(os.getenv("PROVIDER_BREAKER_RESET_SECONDS", 30)),
+        # Batch items only take provider tokens nobody else is waiting for
+        deferred=scheduler.is_batch,
+        deferred_max_wait=float(os.getenv("PROVIDER_BATCH_MAX_WAIT_SECONDS", 120)),
+        headroom=int(os.getenv("PROVIDER_INTERACTIVE_HEADROOM", 1)),
+    )
+
+
+governor = _build_governor()
+
+
+def _http2_enabled():
+    if os.getenv("PROVIDER_HTTP2", "true").lower() != "true":
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def get_http_client():
+    global _http_client
+    if _http_client is None:
+        with _lock:
+            if _http_client is None:
+                _http_client = httpx.Client(http2=_http2_enabled(), limits=POOL_LIMITS)
+    return _http_client
+
+
+def get_anthropic_client():
+    global _anthropic_client
+    if _anthropic_client is None:
+        with _lock:
+            if _anthropic_client is None:
+                _anthropic_client = anthropic.Anthropic(
+                    api_key=os.getenv("ANTHROPIC_API_KEY"),
+                    timeout=TIMEOUTS["stage"],
+                    max_retries=0,  # the governor owns retries
+                )
+    return _anthropic_client
+
+
+def get_async_http_client():
+    global _async_http_client
+    loop = asyncio.get_running_loop()
+    if _async_http_client[0] is not loop:
+        _async_http_client = (loop, httpx.AsyncClient(http2=_http2_enabled(), limits=ASYNC_POOL_LIMITS))
+    return _async_http_client[1]
+
+
+def get_async_anthropic_client():
+    global _async_anthropic_client
+    loop = asyncio.get_running_loop()
+    if _async_anthropic_client[0] is not loop:
+        _async_anthropic_client = (loop, anthropic.AsyncAnthropic(
+            api_key=os.getenv("ANTHROPIC_API_KEY"),
+            timeout=TIMEOUTS["stage"],
+            max_retries=0,
+        ))
+    return _async_anthropic_client[1]
+
+
+# A multiple of 3, so chunks encode without padding
+BASE64_CHUNK_BYTES = 3 * 64 * 1024
+
+
+class Base64Bytes:
+    """Bytes that serialize as a base64 JSON string when streamed by StreamedJSON"""
+
+    def __init__(self, data):
+        self.data = data
+
+    def encoded_length(self):
+        return 4 * ((len(self.data) + 2) // 3)
+
+    def chunks(self):
+        view = memoryview(self.data)
+        for start in range(0, len(view), BASE64_CHUNK_BYTES):
+            yield base64.b64encode(view[start:start + BASE64_CHUNK_BYTES])
+
+
+class StreamedJSON:
+    """A JSON request body produced piecewise, with its length known up front.
+
+    Iterate it (or async-iterate aiter()) once per attempt; each pass
+    re-encodes the Base64Bytes values rather than keeping the encoded text.
+    """
+
+    def __init__(self, payload):
+        marker = f"@@{uuid.uuid4().hex}@@"
+        blobs = []
+
+        def swap(value):
+            if isinstance(value, Base64Bytes):
+                blobs.append(value)
+                return marker
+            if isinstance(value, dict):
+                return {k: swap(v) for k, v in value.items()}
+            if isinstance(value, list):
+                return [swap(v) for v in value]
+            return value
+
+        text = json.dumps(swap(payload), separators=(",", ":"))
+        self._pieces = [piece.encode("utf-8") for piece in text.split(marker)]
+        self._blobs = blobs
+        self.length = sum(len(p) for p in self._pieces) + sum(b.encoded_length() for b in blobs)
+
+    def __iter__(self):
+        yield self._pieces[0]
+        for blob, piece in zip(self._blobs, self._pieces[1:]):
+            yield from blob.chunks()
+            yield piece
+
+    async def aiter(self):
+        for chunk in self:
+            yield chunk
+
+    def headers(self):
+        return {"Content-Type": "application/json", "Content-Length": str(self.length)}
+
+
+def gemini_url(model):
+    return f"{GEMINI_API_BASE}/v1beta/models/{model}:generateContent"
+
+
+def gemini_upload_url():
+    return f"{GEMINI_API_BASE}/upload/v1beta/files"
+
+
+def _upload_start(data, mime_type, gemini_key, display_name):
+    """(kwargs for the resumable-upload start request, headers for the upload itself)"""
+    start = {
+        "json": {"file": {"display_name": display_name}},
+        "headers": {
+            "x-goog-api-key": gemini_key,
+            "X-Goog-Upload-Protocol": "resumable",
+            "X-Goog-Upload-Command": "start",
+            "X-Goog-Upload-Header-Content-Length": str(len(data)),
+            "X-Goog-Upload-Header-Content-Type": mime_type,
+        },
+    }
+    finish = {
+        "x-goog-api-key": gemini_key,
+        "X-Goog-Upload-Command": "upload, finalize",
+        "X-Goog-Upload-Offset": "0",
+    }
+    return start, finish
+
+
+def gemini_upload_file(data, mime_type, gemini_key, display_name=None):
+    """Upload bytes to the Gemini Files API in one resumable chunk.
+
+    Returns the final response; on success its JSON holds the `file` resource.
+    """
+    start, finish = _upload_start(data, mime_type, gemini_key, display_name)
+
+    def send():
+        client = get_http_client()
+        response = client.post(gemini_upload_url(), **start, timeout=clamp_timeout(TIMEOUTS["upload"]))
+        if response.status_code != 200:
+            return response
+        return client.post(response.headers["x-goog-upload-url"], content=data, headers=finish,
+                           timeout=clamp_timeout(TIMEOUTS["upload"]))
+
+    return governor.call(FILES_LANE, lambda: metrics.observe_provider(FILES_LANE, send), classify_http)
+
+
+async def gemini_upload_file_async(data, mime_type, gemini_key, display_name=None):
+    start, finish = _upload_start(data, mime_type, gemini_key, display_name)
+
+    async def send():
+        client = get_async_http_client()
+        response = await client.post(gemini_upload_url(), **start, timeout=clamp_timeout(TIMEOUTS["upload"]))
+        if response.status_code != 200:
+            return response
+        return await client.post(response.headers["x-goog-upload-url"], content=data, headers=finish,
+                                 timeout=clamp_timeout(TIMEOUTS["upload"]))
+
+    return await governor.acall(FILES_LANE, lambda: metrics.observe_provider_async(FILES_LANE, send), classify_http)
+
+
+def classify_http(response, error):
+    if error is not None:
+        if isinstance(error, httpx.TimeoutException):
+            # Only connect timeouts are cheap to retry; a read timeout already
+            # spent the whole budget.
+            return Outcome(retryable=isinstance(error, httpx.ConnectTimeout), failure=True)
+        if isinstance(error, httpx.TransportError):
+            return Outcome(retryable=True, failure=True)
+        return Outcome()
+    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+    if response.status_code == 429:
+        return Outcome(retryable=True, retry_after=retry_after)
+    if response.status_code >= 500:
+        return Outcome(retryable=response.status_code in (500, 502, 503, 504), retry_after=retry_after, failure=True)
+    return Outcome()
+
+
+def classify_anthropic(result, error):
+    if error is None:
+        return Outcome()
+    if isinstance(error, anthropic.RateLimitError):
+        return Outcome(retryable=True, retry_after=parse_retry_after(error.response.headers.get("retry-after")))
+    if isinstance(error, anthropic.APITimeoutError):
+        return Outcome(failure=True)
+    if isinstance(error, anthropic.APIConnectionError):
+        return Outcome(retryable=True, failure=True)
+    if isinstance(error, anthropic.APIStatusError) and error.status_code >= 500:
+        return Outcome(retryable=True, failure=True)
+    return Outcome()
+
+
+def gemini_generate(model, payload, gemini_key, endpoint):
+    """POST a generateContent request over the shared pool, under the governor.
+
+    The key travels in a header rather than the query string so it never ends
+    up in proxy or access logs.
+    """
+    body = StreamedJSON(payload)
+
+    def send():
+        return metrics.observe_provider(model, lambda: get_http_client().post(
+            gemini_url(model),
+            content=iter(body),
+            headers={**body.headers(), "x-goog-api-key": gemini_key},
+            timeout=clamp_timeout(TIMEOUTS[endpoint]),
+        ))
+
+    return governor.call(model, send, classify_http)
+
+
+def anthropic_create(**kwargs):
+    """Prompt-caching messages.create under the governor"""
+    client = get_anthropic_client()
+    model = kwargs["model"]
+    return governor.call(
+        model,
+        lambda: metrics.observe_provider(model, lambda: client.beta.prompt_caching.messages.create(**kwargs)),
+        classify_anthropic,
+    )
+
+
+def anthropic_stream(**kwargs):
+    """Prompt-caching message stream; wrap its use in governor.guard(model, classify_anthropic)"""
+    return get_anthropic_client().beta.prompt_caching.messages.stream(**kwargs)
+
+
+async def gemini_generate_async(model, payload, gemini_key, endpoint):
+    body = StreamedJSON(payload)
+
+    async def send():
+        return await metrics.observe_provider_async(model, lambda: get_async_http_client().post(
+            gemini_url(model),
+            content=body.aiter(),
+            headers={**body.headers(), "x-goog-api-key": gemini_key},
+            timeout=clamp_timeout(TIMEOUTS[endpoint]),
+        ))
+
+    return await governor.acall(model, send, classify_http)
+
+
+async def anthropic_create_async(**kwargs):
+    client = get_async_anthropic_client()
+    model = kwargs["model"]
+    return await governor.acall(
+        model,
+        lambda: metrics.observe_provider_async(model, lambda: client.beta.prompt_caching.messages.create(**kwargs)),
+        classify_anthropic,
+    )
+
+
+def anthropic_stream_async(**kwargs):
+    """Async message stream; wrap its use in governor.aguard(model, classify_anthropic)"""
+    return get_async_anthropic_client().beta.prompt_caching.messages.stream(**kwargs)
+
+
+def _reset_after_fork():
+    # Drop (don't close) inherited clients: closing would tear down sockets the
+    # parent may still be using.
+    global _lock, _http_client, _anthropic_client, _async_http_client, _async_anthropic_client
+    _lock = threading.Lock()
+    _http_client = None
+    _anthropic_client = None
+    _async_http_client = (None, None)
+    _async_anthropic_client = (None, None)
+    # Its locks may have been held by a parent thread at fork time. Reset in
+    # place: main.py and asgi.py hold references to this very object.
+    governor.reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,377 @@
+"""Scene analysis detail levels, response schemas and typed results.
+
+Flash's latency grows with the tokens it writes, so scene analysis comes in
+three detail levels, each sent as an explicit responseSchema built from the
+dataclasses below. A field is requested at its own level and every level
+above it:
+
+- fast: what the generation prompt can't do without (room size, doors,
+  windows, light, focal point and anchor piece)
+- standard: adds perspective, depth zones, finishes, sizing and placement
+- full: adds every optional detail the prompt builder can use
+
+parse() validates a response (or a cached entry) into a SceneAnalysis.
+Values of the wrong type are dropped rather than trusted, so the prompt
+builder reads attributes instead of chaining .get() calls.
+"""
+import dataclasses
+import functools
+from dataclasses import dataclass, field
+from typing import List, Optional, get_args, get_origin, get_type_hints
+
+SCENE_ANALYSIS_MODEL = "gemini-3-flash-preview"
+
+# Bump whenever the prompt or the schemas change so stale cached analyses are
+# not reused. The prefix keeps it distinct from other prompts on the same model.
+SCENE_ANALYSIS_PROMPT_VERSION = "scene-v2"
+
+SCENE_ANALYSIS_PROMPT = """Analyze this room image for virtual staging. Use doors (80" tall, 32-36" wide) and outlets (12-18" from floor) as size references.
+
+Fill in actual values based on what you see. Be specific about dimensions and depths: give depths in feet from the camera and furniture sizes in inches."""
+
+LEVELS = ("fast", "standard", "full")
+
+
+class AnalysisInvalid(ValueError):
+    pass
+
+
+def _field(level="fast", enum=None, key=None):
+    """A scene field requested from `level` up; `key` is its JSON name if not the attribute's"""
+    return field(default=None, metadata={"level": level, "enum": enum, "key": key})
+
+
+def _list(level="fast"):
+    return field(default_factory=list, metadata={"level": level})
+
+
+@dataclass
+class Estimate:
+    estimate_feet: Optional[float] = _field()
+    estimate_range: Optional[str] = _field("standard")
+
+
+@dataclass
+class RoomDimensions:
+    width: Optional[Estimate] = _field()
+    length: Optional[Estimate] = _field()
+    ceiling_height: Optional[Estimate] = _field()
+    total_floor_area_sqft: Optional[float] = _field("standard")
+
+
+@dataclass
+class Perspective:
+    camera_height: Optional[str] = _field()
+    camera_angle: Optional[str] = _field(enum=["straight on", "corner view", "angled"])
+    lens_type: Optional[str] = _field(enum=["normal", "wide angle"])
+    vanishing_point_location: Optional[str] = _field(enum=["center", "left", "right"])
+
+
+@dataclass
+class DepthZone:
+    depth_range: Optional[str] = _field()
+    suitable_for: List[str] = _list()
+    floor_area_percentage: Optional[float] = _field("full")
+
+
+@dataclass
+class DepthMapping:
+    total_depth_estimate: Optional[str] = _field()
+    foreground_zone: Optional[DepthZone] = _field()
+    midground_zone: Optional[DepthZone] = _field()
+    background_zone: Optional[DepthZone] = _field()
+
+
+@dataclass
+class Doorway:
+    location: Optional[str] = _field()
+    width_inches: Optional[float] = _field()
+    type: Optional[str] = _field("standard")
+    depth_from_camera_feet: Optional[float] = _field("standard")
+    clearance_needed_inches: Optional[float] = _field("full")
+
+
+@dataclass
+class Window:
+    location: Optional[str] = _field()
+    type: Optional[str] = _field()
+    width_inches: Optional[float] = _field("standard")
+    depth_from_camera_feet: Optional[float] = _field("standard")
+    natural_light_contribution: Optional[str] = _field("standard", enum=["primary", "secondary", "minimal"])
+    height_inches: Optional[float] = _field("full")
+
+
+@dataclass
+class Fireplace:
+    present: Optional[bool] = _field()
+    location: Optional[str] = _field("full")
+    width_inches: Optional[float] = _field("full")
+    depth_from_camera_feet: Optional[float] = _field("full")
+
+
+@dataclass
+class ArchitecturalFeatures:
+    ceiling: Optional[str] = _field()
+    ceiling_height_inches: Optional[float] = _field()
+    flooring: Optional[str] = _field()
+    flooring_color: Optional[str] = _field()
+    walls: Optional[str] = _field()
+    wall_color: Optional[str] = _field()
+    fireplace: Optional[Fireplace] = _field()
+    floor_pattern: Optional[str] = _field("full")
+    baseboard_height_inches: Optional[float] = _field("full")
+
+
+@dataclass
+class FurnitureZone:
+    zone: Optional[str] = _field()
+    size_sqft: Optional[float] = _field()
+    ideal_for: Optional[str] = _field()
+
+
+@dataclass
+class SpatialLayout:
+    focal_point: Optional[str] = _field()
+    focal_point_location: Optional[str] = _field()
+    natural_traffic_flow: Optional[str] = _field()
+    shape: Optional[str] = _field("standard")
+    width_feet: Optional[float] = _field("standard")
+    length_feet: Optional[float] = _field("standard")
+    primary_walkway_width_needed_inches: Optional[float] = _field("full")
+    best_furniture_zones: List[FurnitureZone] = _list("full")
+
+
+@dataclass
+class Lighting:
+    primary_light_source: Optional[str] = _field()
+    light_direction: Optional[str] = _field()
+    color_temperature: Optional[str] = _field()
+    shadow_direction: Optional[str] = _field("standard")
+    light_intensity: Optional[str] = _field("full")
+    shadow_softness: Optional[str] = _field("full")
+
+
+@dataclass
+class FurnitureSize:
+    item: Optional[str] = _field()
+    recommended_width_inches: Optional[str] = _field()
+    recommended_size: Optional[str] = _field()
+    placement: Optional[str] = _field()
+    recommended_length_inches: Optional[str] = _field("full")
+    recommended_depth_inches: Optional[str] = _field("full")
+    recommended_height_inches: Optional[str] = _field("full")
+    recommended_diameter_inches: Optional[str] = _field("full")
+
+
+@dataclass
+class AnchorPiece:
+    item: Optional[str] = _field()
+    suggested_width_inches: Optional[float] = _field()
+    suggested_location: Optional[str] = _field()
+    orientation: Optional[str] = _field()
+
+
+@dataclass
+class DepthPlacement:
+    item: Optional[str] = _field()
+    depth_from_camera_feet: Optional[float] = _field()
+    reason: Optional[str] = _field("full")
+
+
+@dataclass
+class TrafficPath:
+    from_: Optional[str] = _field(key="from")
+    to: Optional[str] = _field()
+    minimum_width_inches: Optional[float] = _field()
+
+
+@dataclass
+class StagingRecommendations:
+    anchor_piece: Optional[AnchorPiece] = _field()
+    scale_guidance: Optional[str] = _field()
+    areas_to_avoid: List[str] = _list()
+    depth_placement_guide: List[DepthPlacement] = _list("standard")
+    traffic_paths_to_preserve: List[TrafficPath] = _list("full")
+
+
+@dataclass
+class SceneAnalysis:
+    detected_room_type: Optional[str] = _field(
+        enum=["living room", "bedroom", "kitchen", "dining room", "office", "other"])
+    room_state: Optional[str] = _field(enum=["empty", "partially_furnished", "furnished"])
+    confidence: Optional[float] = _field()
+    room_dimensions: Optional[RoomDimensions] = _field()
+    doorways: List[Doorway] = _list()
+    windows: List[Window] = _list()
+    spatial_layout: Optional[SpatialLayout] = _field()
+    lighting_analysis: Optional[Lighting] = _field()
+    staging_recommendations: Optional[StagingRecommendations] = _field()
+    perspective_analysis: Optional[Perspective] = _field("standard")
+    depth_mapping: Optional[DepthMapping] = _field("standard")
+    architectural_features: Optional[ArchitecturalFeatures] = _field("standard")
+    furniture_sizing_guide: List[FurnitureSize] = _list("standard")
+    # The level this analysis was produced at; never part of the schema
+    level: Optional[str] = field(default=None, metadata={"schema": False})
+
+
+# ============== SCHEMAS ==============
+
+_GEMINI_TYPES = {str: "STRING", float: "NUMBER", int: "INTEGER", bool: "BOOLEAN"}
+
+
+def _unwrap(hint):
+    """(base type, is_list) for Optional[X] / List[X] / X"""
+    origin = get_origin(hint)
+    if origin in (list, List):
+        return get_args(hint)[0], True
+    if origin is not None:  # Optional[X]
+        return next(a for a in get_args(hint) if a is not type(None)), False
+    return hint, False
+
+
+_hints = functools.lru_cache(maxsize=None)(get_type_hints)
+
+
+def _key(f):
+    return f.metadata.get("key") or f.name
+
+
+def _included(f, level):
+    if not f.metadata.get("schema", True):
+        return False
+    return LEVELS.index(f.metadata.get("level", "fast")) <= LEVELS.index(level)
+
+
+def _schema(hint, level, enum=None):
+    base, is_list = _unwrap(hint)
+    if is_list:
+        return {"type": "ARRAY", "items": _schema(base, level)}
+    if dataclasses.is_dataclass(base):
+        hints = _hints(base)
+        fields = [f for f in dataclasses.fields(base) if _included(f, level)]
+        return {
+            "type": "OBJECT",
+            "properties": {_key(f): _schema(hints[f.name], level, f.metadata.get("enum")) for f in fields},
+            "required": [_key(f) for f in fields],
+            "propertyOrdering": [_key(f) for f in fields],
+        }
+    schema = {"type": _GEMINI_TYPES[base]}
+    if enum:
+        schema["enum"] = enum
+    return schema
+
+
+def response_schema(level):
+    """Gemini responseSchema (OpenAPI subset) for a detail level"""
+    return _schema(SceneAnalysis, level)
+
+
+SCHEMAS = {level: response_schema(level) for level in LEVELS}
+
+
+def payload_builder(level):
+    """generateContent payload for a level, as a function of the photo's part"""
+    schema = SCHEMAS[level]
+    return lambda image_part: {
+        "contents": [{
+            "parts": [
+                image_part,
+                {"text": SCENE_ANALYSIS_PROMPT}
+            ]
+        }],
+        "generationConfig": {
+            "responseMimeType": "application/json",
+            "responseSchema": schema,
+            "temperature": 0.1  # Low temperature for consistent analysis
+        }
+    }
+
+
+# ============== PARSING ==============
+
+def _coerce(hint, value):
+    base, is_list = _unwrap(hint)
+    if is_list:
+        if not isinstance(value, list):
+            return []
+        items = [_coerce(base, item) for item in value]
+        return [item for item in items if item is not None]
+    if value is None:
+        return None
+    if dataclasses.is_dataclass(base):
+        return _build(base, value) if isinstance(value, dict) else None
+    if base is bool:
+        return value if isinstance(value, bool) else None
+    if isinstance(value, bool):
+        return None
+    if base in (float, int) and isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            return None
+        if value.is_integer():
+            value = int(value)
+    if base is float:
+        return value if isinstance(value, (int, float)) else None
+    if base is int:
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        return value if isinstance(value, int) else None
+    # Strings: models sometimes answer "84-96" fields with a bare number
+    if isinstance(value, (int, float)):
+        return str(value)
+    return value if isinstance(value, str) else None
+
+
+def _build(cls, data):
+    hints = _hints(cls)
+    return cls(**{f.name: _coerce(hints[f.name], data.get(_key(f))) for f in dataclasses.fields(cls)})
+
+
+def parse(data, level=None):
+    """A SceneAnalysis from decoded JSON; raises AnalysisInvalid if it isn't an object"""
+    if not isinstance(data, dict):
+        raise AnalysisInvalid("Scene analysis is not a JSON object")
+    analysis = _build(SceneAnalysis, data)
+    if level is not None:
+        analysis.level = level
+    return analysis
+
+
+def to_dict(value):
+    """JSON-ready form of a parsed analysis (or part of one), without empty fields"""
+    if dataclasses.is_dataclass(value):
+        out = {}
+        for f in dataclasses.fields(value):
+            item = to_dict(getattr(value, f.name))
+            if item is not None and item != []:
+                out[_key(f)] = item
+        return out
+    if isinstance(value, list):
+        return [to_dict(item) for item in value]
+    return value
+
+
+def agrees(a, b, tolerance=0.2):
+    """Whether two analyses plausibly describe the same room: same room type,
+    door and window counts, and width and length within `tolerance`
+    """
+    if (a.detected_room_type, len(a.doorways), len(a.windows)) != (b.detected_room_type, len(b.doorways), len(b.windows)):
+        return False
+    for name in ("width", "length"):
+        x = getattr(a.room_dimensions, name, None)
+        y = getattr(b.room_dimensions, name, None)
+        x, y = getattr(x, "estimate_feet", None), getattr(y, "estimate_feet", None)
+        if x and y and abs(x - y) > tolerance * max(x, y):
+            return False
+    return True
+
+
+def parse_level(value, default):
+    """Analysis level from an `enable_analysis` form value: a level name, true/false"""
+    value = str(value).strip().lower()
+    if value in LEVELS:
+        return value
+    if value == "true":
+        return default
+    return None
@@ -0,0 +1,313 @@
+"""Admission scheduler in front of the generation pipeline.
+
+Every generation takes a slot before it starts, so a listing pushed
+through /generate-batch cannot occupy every worker and the whole provider
+quota while agents wait behind it.
+
+- Requests belong to a tenant (a header, an API key or the client address)
+  and a class: interactive single-image requests or batch items.
+- Interactive requests are always dispatched before batch ones, and batch
+  work may never hold the last RESERVED slots. A newly arrived interactive
+  request then finds a slot free instead of waiting out a minute-long
+  generation.
+- Within a class, tenants share slots by weighted fair queuing. Each queued
+  request gets a virtual finish tag of max(virtual time, the tenant's last
+  tag) + 1 / weight, and the smallest tag goes next. A tenant with weight 2
+  gets twice the slots of one with weight 1 while both have work queued,
+  and a tenant's backlog only delays that tenant.
+- A tenant never runs more than its concurrency cap at once.
+
+Queue time is recorded per class against a target (SLO). A request that
+can't get a slot within its class's max wait, or the request deadline
+(deadlines.py), is refused with a Retry-After.
+
+Slots only bound how many generations run at once; the provider's request
+rate is the governor's. Batch calls there are deferred (governor.py): they
+take a rate-limit token only when one is free beyond a small headroom, so
+interactive calls never queue for tokens behind a listing.
+
+bind() sets the tenant and class for the current context, like
+metrics.bind_endpoint(); work handed to another thread binds them itself.
+Slots are per worker process, like the governor's limits.
+"""
+import asyncio
+import contextvars
+import hashlib
+import itertools
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+import deadlines
+import metrics
+from deadlines import LatencyTracker
+
+CLASSES = ("interactive", "batch")
+
+_tenant = contextvars.ContextVar("scheduler_tenant", default="anonymous")
+_class = contextvars.ContextVar("scheduler_class", default="interactive")
+
+
+class SchedulerBusy(Exception):
+    def __init__(self, message, status_code=503, retry_after=None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+@contextmanager
+def bind(tenant, request_class):
+    tenant_token = _tenant.set(tenant)
+    class_token = _class.set(request_class if request_class in CLASSES else "interactive")
+    try:
+        yield
+    finally:
+        _class.reset(class_token)
+        _tenant.reset(tenant_token)
+
+
+def is_batch():
+    """Whether the current context runs batch work (the governor's deferred calls)"""
+    return _class.get() == "batch"
+
+
+def tenant_id(headers, remote_addr, tenant_header="X-Tenant-ID"):
+    """Tenant of a request: the tenant header, else a digest of its API key, else its address"""
+    tenant = (headers.get(tenant_header) or "").strip()
+    if tenant:
+        return tenant[:64]
+    key = headers.get("X-API-Key") or ""
+    authorization = headers.get("Authorization") or ""
+    if not key and authorization.lower().startswith("bearer "):
+        key = authorization[7:]
+    if key.strip():
+        return "key:" + hashlib.sha256(key.strip().encode("utf-8")).hexdigest()[:12]
+    return f"addr:{remote_addr or 'unknown'}"
+
+
+class _Waiter:
+    def __init__(self, tenant, request_class, tag, notify):
+        self.tenant = tenant
+        self.request_class = request_class
+        self.tag = tag
+        self.notify = notify
+        self.granted = False
+        self.enqueued_at = time.monotonic()
+
+
+class _Tenant:
+    def __init__(self, weight, max_concurrency):
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.running = 0
+        self.last_tag = {c: 0.0 for c in CLASSES}
+        self.queues = {c: deque() for c in CLASSES}
+        self.admitted = 0
+
+
+class AdmissionScheduler:
+    # Idle tenants are forgotten once there are more than this many
+    MAX_IDLE_TENANTS = 1000
+
+    def __init__(self, slots=16, reserved=4, tenant_max_concurrency=8, tenants=None,
+                 max_wait=None, slo_seconds=None):
+        self.slots = slots
+        self.reserved = min(reserved, slots - 1)
+        self.tenant_max_concurrency = tenant_max_concurrency
+        # {tenant: {"weight": w, "max_concurrency": n}} overrides
+        self.tenant_overrides = tenants or {}
+        self.max_wait = {"interactive": 30.0, "batch": 600.0, **(max_wait or {})}
+        self.slo_seconds = {"interactive": 2.0, "batch": 300.0, **(slo_seconds or {})}
+
+        self._lock = threading.Lock()
+        self._tenants = {}
+        self._running = {c: 0 for c in CLASSES}
+        self._queued = {c: 0 for c in CLASSES}
+        self._virtual_time = {c: 0.0 for c in CLASSES}
+        self._sequence = itertools.count()
+        self._queue_time = {c: LatencyTracker(window=1000, min_samples=1) for c in CLASSES}
+        self._counters = {c: {"admitted": 0, "rejected": 0, "slo_misses": 0} for c in CLASSES}
+
+    # ---------- public API ----------
+
+    @contextmanager
+    def slot(self):
+        """Hold a generation slot for the bound tenant and class for the block"""
+        tenant, request_class = _tenant.get(), _class.get()
+        event = threading.Event()
+        waiter = self._enqueue(tenant, request_class, event.set)
+        event.wait(self._wait_limit(request_class))
+        self._settle(waiter)
+        try:
+            yield
+        finally:
+            self._release(waiter)
+
+    @asynccontextmanager
+    async def aslot(self):
+        tenant, request_class = _tenant.get(), _class.get()
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        waiter = self._enqueue(tenant, request_class, notify)
+        try:
+            await asyncio.wait_for(asyncio.shield(granted), self._wait_limit(request_class))
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+        self._settle(waiter)
+        try:
+            yield
+        finally:
+            self._release(waiter)
+
+    def stats(self):
+        with self._lock:
+            classes = {
+                c: {
+                    **self._counters[c],
+                    "queued": self._queued[c],
+                    "running": self._running[c],
+                    "max_wait_seconds": self.max_wait[c],
+                    "slo_seconds": self.slo_seconds[c],
+                }
+                for c in CLASSES
+            }
+            busy = sorted(self._tenants.items(),
+                          key=lambda item: -(item[1].running + sum(len(q) for q in item[1].queues.values())))
+            tenants = {
+                name: {
+                    "weight": t.weight,
+                    "max_concurrency": t.max_concurrency,
+                    "running": t.running,
+                    "queued": {c: len(t.queues[c]) for c in CLASSES},
+                    "admitted": t.admitted,
+                }
+                for name, t in busy[:20]
+            }
+        for c in CLASSES:
+            classes[c]["queue_time"] = self._queue_time[c].stats()
+        return {"slots": self.slots, "reserved_interactive": self.reserved, "classes": classes, "tenants": tenants}
+
+    # ---------- internals ----------
+
+    def _wait_limit(self, request_class):
+        limit = self.max_wait[request_class]
+        left = deadlines.remaining()
+        return limit if left is None else min(limit, left)
+
+    def _tenant(self, name):
+        tenant = self._tenants.get(name)
+        if tenant is None:
+            # Prune before adding: the new tenant has nothing queued yet either
+            if len(self._tenants) >= self.MAX_IDLE_TENANTS:
+                self._forget_idle()
+            override = self.tenant_overrides.get(name, {})
+            tenant = self._tenants[name] = _Tenant(
+                float(override.get("weight", 1.0)),
+                int(override.get("max_concurrency", self.tenant_max_concurrency)),
+            )
+        return tenant
+
+    def _forget_idle(self):
+        for name, tenant in list(self._tenants.items()):
+            if not tenant.running and not any(tenant.queues.values()):
+                del self._tenants[name]
+
+    def _enqueue(self, tenant_name, request_class, notify):
+        with self._lock:
+            tenant = self._tenant(tenant_name)
+            # Start tag: no earlier than now in virtual time, nor than the
+            # tenant's previous request; finish tag one slot's work later
+            start = max(self._virtual_time[request_class], tenant.last_tag[request_class])
+            tenant.last_tag[request_class] = start + 1.0 / tenant.weight
+            waiter = _Waiter(tenant_name, request_class, (tenant.last_tag[request_class], next(self._sequence)), notify)
+            tenant.queues[request_class].append(waiter)
+            self._queued[request_class] += 1
+            metrics.SCHEDULER_QUEUED.labels(request_class).inc()
+            self._dispatch()
+        return waiter
+
+    def _settle(self, waiter):
+        """After waiting: record the queue time, or give up and refuse the request"""
+        waited = time.monotonic() - waiter.enqueued_at
+        request_class = waiter.request_class
+        with self._lock:
+            if not waiter.granted:
+                self._remove(waiter)
+                self._counters[request_class]["rejected"] += 1
+        if not waiter.granted:
+            metrics.SCHEDULER_ADMISSIONS.labels(request_class, "rejected").inc()
+            deadlines.check()
+            raise SchedulerBusy("Too much work queued, try again shortly", 503,
+                                retry_after=max(1, round(self.max_wait[request_class] / 4)))
+
+        self._queue_time[request_class].observe(waited)
+        metrics.SCHEDULER_QUEUE_SECONDS.labels(request_class).observe(waited)
+        metrics.SCHEDULER_ADMISSIONS.labels(request_class, "admitted").inc()
+        if waited > self.slo_seconds[request_class]:
+            metrics.SCHEDULER_SLO_MISSES.labels(request_class).inc()
+            with self._lock:
+                self._counters[request_class]["slo_misses"] += 1
+
+    def _abandon(self, waiter):
+        """A cancelled async waiter: leave the queue, or hand back a slot granted meanwhile"""
+        with self._lock:
+            if not waiter.granted:
+                self._remove(waiter)
+                return
+        self._release(waiter)
+
+    def _remove(self, waiter):
+        queue = self._tenants[waiter.tenant].queues[waiter.request_class]
+        queue.remove(waiter)
+        self._queued[waiter.request_class] -= 1
+        metrics.SCHEDULER_QUEUED.labels(waiter.request_class).dec()
+
+    def _release(self, waiter):
+        with self._lock:
+            self._tenants[waiter.tenant].running -= 1
+            self._running[waiter.request_class] -= 1
+            self._dispatch()
+
+    def _dispatch(self):
+        """Grant free slots to queued requests; called with the lock held"""
+        while True:
+            busy = sum(self._running.values())
+            if busy >= self.slots:
+                return
+            waiter = self._next("interactive")
+            if waiter is None and busy < self.slots - self.reserved:
+                waiter = self._next("batch")
+            if waiter is None:
+                return
+
+            tenant = self._tenants[waiter.tenant]
+            tenant.queues[waiter.request_class].popleft()
+            tenant.running += 1
+            tenant.admitted += 1
+            self._queued[waiter.request_class] -= 1
+            self._running[waiter.request_class] += 1
+            self._counters[waiter.request_class]["admitted"] += 1
+            metrics.SCHEDULER_QUEUED.labels(waiter.request_class).dec()
+            # Virtual time advances to the start tag of the request being served
+            self._virtual_time[waiter.request_class] = max(
+                self._virtual_time[waiter.request_class], waiter.tag[0] - 1.0 / tenant.weight)
+            waiter.granted = True
+            waiter.notify()
+
+    def _next(self, request_class):
+        """The head-of-line request with the smallest finish tag among tenants under their cap"""
+        best = None
+        for tenant in self._tenants.values():
+            queue = tenant.queues[request_class]
+            if queue and tenant.running < tenant.max_concurrency and (best is None or queue[0].tag < best.tag):
+                best = queue[0]
+        return best
@@ -0,0 +1,67 @@
+"""Shared fixtures: the backend on sys.path and one stub provider for the session.
+
+providers.py reads GEMINI_API_BASE when it is imported, so the stub server
+is started and the environment pointed at it before any test module
+imports backend code. From backend/:
+
+    pip install -r requirements-dev.txt
+    python -m pytest tests
+"""
+import io
+import os
+import random
+import sys
+import tempfile
+
+import pytest
+from PIL import Image, ImageChops, ImageDraw
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from bench import stub_server  # noqa: E402
+
+STUB = stub_server.start_in_thread(latency_ms=0)
+STUB_URL = f"http://127.0.0.1:{STUB.server_address[1]}"
+os.environ.update(
+    GEMINI_API_BASE=STUB_URL,
+    ANTHROPIC_BASE_URL=STUB_URL,
+    GEMINI_API_KEY="stub",
+    ANTHROPIC_API_KEY="stub",
+    STATE_DIR=tempfile.mkdtemp(prefix="estate-stage-tests-"),
+    PHASH_INDEX_ENABLED="false",
+)
+
+
+@pytest.fixture
+def stub():
+    """The stub provider, with per-test state cleared"""
+    STUB.files.clear()
+    STUB.file_ttl = 48 * 3600
+    with STUB._counts_lock:
+        STUB._counts.clear()
+    return STUB
+
+
+def room_photo(seed=0, size=(320, 240), fmt="JPEG", mode="RGB"):
+    """Encoded bytes of a synthetic photo: smooth gradients plus a few shapes, like a room"""
+    rng = random.Random(seed)
+    width, height = size
+    # A 2x2 image scaled up bilinearly is a smooth gradient between its corners
+    corners = Image.new("RGB", (2, 2))
+    base = [(rng.uniform(40, 200), rng.uniform(-60, 60), rng.uniform(-60, 60)) for _ in range(3)]
+    for x, y in ((0, 0), (1, 0), (0, 1), (1, 1)):
+        corners.putpixel((x, y), tuple(int(max(0, min(255, c + dx * x + dy * y))) for c, dx, dy in base))
+    img = corners.resize(size, Image.BILINEAR)
+    draw = ImageDraw.Draw(img)
+    for _ in range(6):
+        x0, y0 = rng.randrange(max(1, width - 20)), rng.randrange(max(1, height - 20))
+        x1 = x0 + rng.randrange(10, max(11, width // 2))
+        y1 = y0 + rng.randrange(10, max(11, height // 2))
+        draw.rectangle((x0, y0, x1, y1), fill=tuple(rng.randrange(256) for _ in range(3)))
+    # Sensor noise, so encoders have something to spend bytes on
+    noise = Image.frombytes("L", size, rng.randbytes(width * height)).point(lambda v: 120 + v // 16)
+    img = ImageChops.add(img, Image.merge("RGB", [noise] * 3), offset=-128)
+    buf = io.BytesIO()
+    img.convert(mode).save(buf, fmt, **({"quality": 90} if fmt == "JPEG" else {}))
+    return buf.getvalue()
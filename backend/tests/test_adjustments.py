@@ -0,0 +1,112 @@
+import io
+import itertools
+
+import pytest
+from PIL import Image, ImageStat
+
+import main
+from adjustments import AdjustmentError, StylisticSettings, parse_settings, render_adjusted, variant_name
+from conftest import room_photo
+
+SEEDS = itertools.count(200)
+
+
+@pytest.fixture
+def generated():
+    data = room_photo(seed=next(SEEDS), size=(640, 480), fmt="PNG")
+    return main.artifact_store.put(data, "image/png", width=640, height=480)
+
+
+def mean(data):
+    with Image.open(io.BytesIO(data)) as img:
+        return ImageStat.Stat(img.convert("RGB")).mean
+
+
+def test_parse_settings_defaults_and_ranges():
+    assert parse_settings({}) == StylisticSettings()
+    assert parse_settings({"brightness": "-20", "grain": "35"}) == StylisticSettings(brightness=-20, grain=35)
+    for args in ({"grain": "-1"}, {"warmth": "101"}, {"texture": "soft"}):
+        with pytest.raises(AdjustmentError) as rejected:
+            parse_settings(args)
+        assert rejected.value.status_code == 400
+
+
+def test_minimalism_needs_a_new_generation():
+    with pytest.raises(AdjustmentError) as rejected:
+        parse_settings({"minimalism": "40"})
+
+    assert rejected.value.status_code == 422
+
+
+def test_settings_name_their_variant():
+    assert variant_name(StylisticSettings(brightness=10, grain=5)) == "adjust-b10-w0-g5-s0-t0"
+
+
+def test_neutral_settings_leave_the_image_alone():
+    source = room_photo(seed=60, size=(320, 240), fmt="PNG")
+
+    data, mime = render_adjusted(source, StylisticSettings())
+
+    assert mime == "image/png"
+    assert all(abs(a - b) < 1 for a, b in zip(mean(data), mean(source)))
+
+
+def test_brightness_and_warmth_move_the_tones():
+    source = room_photo(seed=61, size=(320, 240), fmt="PNG")
+    r, g, b = mean(source)
+
+    brighter, _ = render_adjusted(source, StylisticSettings(brightness=50))
+    warmer, _ = render_adjusted(source, StylisticSettings(warmth=80))
+
+    assert all(after > before for after, before in zip(mean(brighter), (r, g, b)))
+    wr, _, wb = mean(warmer)
+    assert wr > r and wb < b
+
+
+def test_jpeg_sources_stay_jpeg():
+    _, mime = render_adjusted(room_photo(seed=62, size=(320, 240)), StylisticSettings(sharpness=40))
+
+    assert mime == "image/jpeg"
+
+
+def test_preview_is_a_downscaled_jpeg(generated, monkeypatch):
+    monkeypatch.setattr(main.adjustment_previews, "edge", 320)
+
+    response = main.app.test_client().get(f"/artifacts/{generated}/adjust?preview=true&warmth=30")
+
+    assert response.status_code == 200
+    assert response.mimetype == "image/jpeg"
+    with Image.open(io.BytesIO(response.data)) as img:
+        assert img.size == (320, 240)
+
+
+def test_full_renders_are_cached_per_settings(generated):
+    client = main.app.test_client()
+
+    first = client.get(f"/artifacts/{generated}/adjust?brightness=10")
+    second = client.get(f"/artifacts/{generated}/adjust?brightness=10")
+
+    assert first.status_code == 200
+    assert first.get_etag() == second.get_etag()
+    with Image.open(io.BytesIO(first.data)) as img:
+        assert img.size == (640, 480)
+
+
+def test_only_the_most_recent_full_renders_are_kept(generated, monkeypatch):
+    monkeypatch.setattr(main, "ADJUST_MAX_VARIANTS", 2)
+    client = main.app.test_client()
+    ids = [client.get(f"/artifacts/{generated}/adjust?brightness={value}").get_etag()[0] for value in (10, 20, 30)]
+
+    kept = [main.artifact_store.path(artifact_id) is not None for artifact_id in ids]
+
+    assert kept == [False, True, True]
+    assert main.artifact_store.get_variant(generated, variant_name(StylisticSettings(brightness=10))) is None
+    assert main.artifact_store.path(generated) is not None
+
+
+def test_adjust_errors(generated):
+    client = main.app.test_client()
+
+    assert client.get(f"/artifacts/{generated}/adjust?minimalism=50").status_code == 422
+    assert client.get(f"/artifacts/{generated}/adjust?grain=500").status_code == 400
+    assert client.get(f"/artifacts/{'0' * 64}/adjust?grain=5").status_code == 404
@@ -0,0 +1,99 @@
+import io
+import os
+import time
+
+import main
+from artifacts import ArtifactStore
+from conftest import room_photo
+
+
+def age(store, artifact_id, seconds):
+    """Pretend the artifact was last used `seconds` ago"""
+    path = store._blob_path(artifact_id)
+    used_at = time.time() - seconds
+    os.utime(path, (used_at, used_at))
+
+
+def test_put_is_content_addressed_and_idempotent(tmp_path):
+    store = ArtifactStore(str(tmp_path))
+    data = room_photo(seed=20)
+
+    first = store.put(data, "image/jpeg", width=320, height=240)
+    second = store.put(data, "image/jpeg", width=320, height=240)
+
+    assert first == second
+    assert store.read(first) == data
+    assert store.metadata(first)["mime_type"] == "image/jpeg"
+    assert store.stats()["stored"] == 1 and store.stats()["reused"] == 1
+    assert store.path("../" + first[3:]) is None
+
+
+def test_artifacts_idle_past_the_ttl_expire(tmp_path):
+    store = ArtifactStore(str(tmp_path), ttl_seconds=60)
+    artifact_id = store.put(room_photo(seed=21), "image/jpeg")
+    age(store, artifact_id, 120)
+
+    assert store.path(artifact_id) is None
+    assert store.metadata(artifact_id) is None
+    assert store.stats()["expired"] == 1
+
+
+def test_trim_evicts_the_least_recently_used_first(tmp_path):
+    store = ArtifactStore(str(tmp_path))
+    ids = [store.put(room_photo(seed=seed), "image/jpeg") for seed in (22, 23, 24)]
+    for n, artifact_id in enumerate(ids):
+        age(store, artifact_id, 300 - n * 100)
+    store.path(ids[0])  # Served just now: most recently used
+
+    store.max_disk_bytes = sum(os.path.getsize(store._blob_path(i)) for i in ids[:2])
+    store.trim()
+
+    assert [store.path(i) is not None for i in ids] == [True, False, True]
+    assert store.stats()["evictions"] == 1
+
+
+def test_artifact_is_served_with_etag_and_immutable_caching():
+    artifact_id = main.artifact_store.put(room_photo(seed=25), "image/jpeg")
+    client = main.app.test_client()
+
+    response = client.get(f"/artifacts/{artifact_id}")
+
+    assert response.status_code == 200
+    assert response.mimetype == "image/jpeg"
+    assert response.get_etag() == (artifact_id, False)
+    assert response.cache_control.immutable and response.cache_control.public
+    assert response.cache_control.max_age == main.ARTIFACT_MAX_AGE
+    revalidated = client.get(f"/artifacts/{artifact_id}", headers={"If-None-Match": f'"{artifact_id}"'})
+    assert revalidated.status_code == 304
+
+
+def test_artifact_range_requests():
+    data = room_photo(seed=26)
+    artifact_id = main.artifact_store.put(data, "image/jpeg")
+
+    response = main.app.test_client().get(f"/artifacts/{artifact_id}", headers={"Range": "bytes=0-99"})
+
+    assert response.status_code == 206
+    assert response.data == data[:100]
+    assert response.headers["Content-Range"] == f"bytes 0-99/{len(data)}"
+
+
+def test_unknown_artifacts_are_404():
+    client = main.app.test_client()
+
+    assert client.get("/artifacts/" + "0" * 64).status_code == 404
+    assert client.get("/artifacts/not-an-id").status_code == 404
+
+
+def test_generation_returns_a_url_instead_of_the_image(stub):
+    response = main.app.test_client().post("/generate-image", data={
+        "image": (io.BytesIO(room_photo(seed=27)), "room.jpg"),
+        "enable_analysis": "false",
+    })
+
+    assert response.status_code == 200
+    assert "image" not in response.json
+    url = response.json["image_url"]
+    artifact = main.app.test_client().get(url)
+    assert artifact.status_code == 200
+    assert len(artifact.data) == response.json["artifact"]["bytes"]
@@ -0,0 +1,118 @@
+import asyncio
+import io
+import json
+
+import pytest
+from starlette.testclient import TestClient
+
+import asgi
+import main
+import pipeline
+from conftest import room_photo
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(asgi.app) as client:
+        yield client
+
+
+def upload(seed, **fields):
+    return {"files": {"image": ("room.jpg", room_photo(seed=seed), "image/jpeg")}, "data": fields}
+
+
+def steps(log):
+    """A pipeline with a blocking step, an I/O step and a failure it recovers from"""
+    first = yield pipeline.blocking(lambda: "blocking")
+    log.append(first)
+    second = yield pipeline.call(lambda: "sync", lambda: asyncio.sleep(0, "async"))
+    log.append(second)
+    try:
+        yield pipeline.blocking(lambda: 1 / 0)
+    except ZeroDivisionError:
+        log.append("recovered")
+    return len(log)
+
+
+def test_one_pipeline_runs_in_a_thread_or_on_the_loop():
+    blocking_log, async_log = [], []
+
+    assert pipeline.run(steps(blocking_log)) == 3
+    assert asyncio.run(pipeline.arun(steps(async_log))) == 3
+    assert blocking_log == ["blocking", "sync", "recovered"]
+    assert async_log == ["blocking", "async", "recovered"]
+
+
+def test_cancelling_a_pipeline_closes_it():
+    closed = []
+
+    def waits():
+        try:
+            yield pipeline.call(lambda: None, lambda: asyncio.sleep(5))
+        finally:
+            closed.append(True)
+
+    async def run():
+        task = asyncio.ensure_future(pipeline.arun(waits()))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert closed == [True]
+
+
+def test_stage(client, stub):
+    response = client.post("/stage", **upload(70, room_type="BEDROOM"))
+
+    assert response.status_code == 200
+    assert response.json()["room_type"] == "BEDROOM"
+    assert response.json()["description"]
+
+
+def test_analyze_is_cached(client, stub):
+    first = client.post("/analyze", **upload(71))
+    second = client.post("/analyze", **upload(71))
+
+    assert (first.status_code, second.status_code) == (200, 200)
+    assert (first.json()["cached"], second.json()["cached"]) == (False, True)
+    assert first.json()["analysis"] == second.json()["analysis"]
+
+
+def test_generate_image_matches_flask_and_replays(client, stub):
+    headers = {"Idempotency-Key": "asgi-replay"}
+    first = client.post("/generate-image", headers=headers, **upload(72, enable_analysis="fast"))
+    replay = client.post("/generate-image", headers=headers, **upload(72, enable_analysis="fast"))
+
+    assert first.status_code == 200
+    assert first.json()["scene_analysis"]
+    assert replay.headers["Idempotent-Replayed"] == "true"
+    assert replay.json() == first.json()
+    flask = main.app.test_client().post("/generate-image", data={
+        "image": (io.BytesIO(room_photo(seed=72)), "room.jpg"), "enable_analysis": "fast"})
+    assert flask.json["image_url"] == first.json()["image_url"]
+
+
+def test_stage_and_generate(client, stub):
+    response = client.post("/stage-and-generate", **upload(73, enable_analysis="false"))
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["status"] == "success"
+    assert body["stage"]["description"] and body["generation"]["image_url"]
+
+
+def test_stage_and_generate_streams_each_branch(client, stub):
+    response = client.post("/stage-and-generate", **upload(74, enable_analysis="false", stream="true"))
+
+    events = [block.split("\n") for block in response.text.strip().split("\n\n")]
+    names = [lines[0].removeprefix("event: ") for lines in events]
+    assert sorted(names[:2]) == ["generation", "stage"] and names[2] == "done"
+    assert json.loads(events[2][1].removeprefix("data: ")) == {"status": "success"}
+
+
+def test_bad_house_continuity_is_one_400(client, stub):
+    response = client.post("/stage-and-generate", **upload(75, house_continuity="{not json"))
+
+    assert response.status_code == 400
@@ -0,0 +1,139 @@
+import io
+import json
+import threading
+import time
+
+import pytest
+
+import main
+from conftest import room_photo
+
+HOUSE = {"id": "batch-house", "name": "Elm St", "roomsStaged": 1,
+         "designDNA": {"primaryColors": "white", "accentColors": "navy", "woodTone": "oak",
+                       "metalFinish": "brass", "textileStyle": "linen"}}
+
+
+@pytest.fixture
+def client():
+    return main.app.test_client()
+
+
+def batch(client, photos, items=None, **fields):
+    data = {"images": [(io.BytesIO(photo), f"room{n}.jpg") for n, photo in enumerate(photos)], **fields}
+    if items is not None:
+        data["items"] = json.dumps(items)
+    return client.post("/generate-batch", data=data)
+
+
+def lines(response):
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+class Tracker:
+    """Stands in for coalesced_generation, recording how many items ran at once"""
+
+    def __init__(self, seconds=0.1):
+        self.seconds = seconds
+        self.lock = threading.Lock()
+        self.active = self.peak = self.finished = 0
+
+    def __call__(self, image, params, gemini_key, on_stage=None):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(self.seconds)
+        with self.lock:
+            self.active -= 1
+            self.finished += 1
+        return {"room_type": params["room_type"], "house": params["house_continuity"]}
+
+
+def test_streams_one_line_per_image_then_a_summary(stub, client):
+    items = [{"id": "kitchen", "room_type": "KITCHEN", "enable_analysis": "false"},
+             {"id": "bedroom", "room_type": "BEDROOM", "enable_analysis": "false"}]
+
+    response = batch(client, [room_photo(seed=31), room_photo(seed=32)], items)
+
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    results, summary = lines(response)[:-1], lines(response)[-1]
+    assert sorted(line["id"] for line in results) == ["bedroom", "kitchen"]
+    assert all(line["status"] == "success" and line["result"]["image_url"] for line in results)
+    assert summary == {"status": "complete", "succeeded": 2, "failed": 0}
+
+
+def test_fan_out_is_bounded_by_concurrency(client, monkeypatch):
+    tracker = Tracker()
+    monkeypatch.setattr(main, "coalesced_generation", tracker)
+
+    response = batch(client, [room_photo(seed=n) for n in range(6)], concurrency="2")
+
+    assert lines(response)[-1]["succeeded"] == 6
+    assert tracker.peak == 2
+
+
+def test_a_bad_item_does_not_abort_the_listing(client, monkeypatch):
+    monkeypatch.setattr(main, "coalesced_generation", Tracker(0))
+
+    response = batch(client, [b"not a photo", room_photo(seed=33)], [{"id": "bad"}, {"id": "good"}])
+
+    by_id = {line["id"]: line for line in lines(response)[:-1]}
+    assert by_id["bad"]["status"] == "error"
+    assert by_id["bad"]["status_code"] == 400
+    assert by_id["good"]["status"] == "success"
+    assert lines(response)[-1] == {"status": "complete", "succeeded": 1, "failed": 1}
+
+
+def test_shared_house_continuity_is_parsed_once(client, monkeypatch):
+    monkeypatch.setattr(main, "coalesced_generation", Tracker(0))
+
+    response = batch(client, [room_photo(seed=34)] * 2, house_continuity=json.dumps(HOUSE))
+
+    assert all(line["result"]["house"] == HOUSE for line in lines(response)[:-1])
+
+
+@pytest.mark.parametrize("house_continuity", ["{not json", json.dumps({"name": "Elm St"}), "[]"])
+def test_malformed_house_continuity_is_one_400(client, monkeypatch, house_continuity):
+    tracker = Tracker(0)
+    monkeypatch.setattr(main, "coalesced_generation", tracker)
+
+    response = batch(client, [room_photo(seed=35)] * 3, house_continuity=house_continuity)
+
+    assert response.status_code == 400
+    assert "house_continuity" in response.json["error"]
+    assert tracker.finished == 0
+
+
+def test_invalid_batch_parameters(client):
+    assert batch(client, [room_photo(seed=36)], items={"not": "a list"}).status_code == 400
+    assert batch(client, []).status_code == 400
+    assert batch(client, [room_photo(seed=36)], concurrency="many").status_code == 400
+
+
+def test_closing_the_stream_waits_for_running_items(client, monkeypatch):
+    tracker = Tracker(0.3)
+    monkeypatch.setattr(main, "coalesced_generation", tracker)
+
+    response = batch(client, [room_photo(seed=n) for n in range(8)], concurrency="2")
+    body = iter(response.response)
+    next(body)  # The first result
+    response.close()
+
+    # Nothing still reads the request's spooled files, and nothing queued started
+    assert tracker.active == 0
+    assert tracker.finished < 8
+
+
+def test_upload_id_items_take_no_file(client, monkeypatch):
+    monkeypatch.setattr(main, "coalesced_generation", Tracker(0))
+    upload_id = client.post("/uploads", data={"image": (io.BytesIO(room_photo(seed=37)), "room.jpg")}).json["upload_id"]
+    items = [{"id": "stored", "upload_id": upload_id, "room_type": "KITCHEN"},
+             {"id": "fresh", "room_type": "BEDROOM"},
+             {"id": "expired", "upload_id": "0" * 64}]
+
+    response = batch(client, [room_photo(seed=38)], items)
+
+    by_id = {line["id"]: line for line in lines(response)[:-1]}
+    assert by_id["stored"]["result"]["room_type"] == "KITCHEN"
+    assert by_id["fresh"]["result"]["room_type"] == "BEDROOM"
+    assert by_id["expired"]["code"] == "upload_expired"
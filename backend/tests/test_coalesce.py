@@ -0,0 +1,198 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+from coalesce import IdempotencyConflict, IdempotencyStore, SingleFlight, fingerprint
+
+
+def run_concurrently(count, target):
+    results = [None] * count
+    errors = [None] * count
+
+    def run(i):
+        try:
+            results[i] = target()
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results, errors
+
+
+def test_fingerprint_is_stable_and_order_independent_for_dicts():
+    assert fingerprint({"a": 1, "b": 2}, "x") == fingerprint({"b": 2, "a": 1}, "x")
+    assert fingerprint("a", "b") != fingerprint("b", "a")
+
+
+def test_concurrent_identical_calls_run_once(tmp_path):
+    flight = SingleFlight(str(tmp_path))
+    calls = []
+
+    def generate():
+        calls.append(1)
+        time.sleep(0.2)
+        return {"image_url": "/artifacts/x"}
+
+    results, errors = run_concurrently(5, lambda: flight.do("key", generate))
+
+    assert errors == [None] * 5
+    assert len(calls) == 1
+    assert [shared for _, shared in results].count(False) == 1
+    assert all(result == {"image_url": "/artifacts/x"} for result, _ in results)
+    assert flight.stats()["coalesced_local"] == 4
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_different_keys_do_not_wait_on_each_other(tmp_path):
+    flight = SingleFlight(str(tmp_path))
+    keys = iter(["a", "b", "c"])
+    lock = threading.Lock()
+
+    def next_key():
+        with lock:
+            return next(keys)
+
+    results, _ = run_concurrently(3, lambda: flight.do(next_key(), lambda: time.sleep(0.1) or "done"))
+
+    assert flight.stats()["leaders"] == 3
+    assert all(not shared for _, shared in results)
+
+
+def test_leader_failure_reaches_every_waiter_and_is_not_cached(tmp_path):
+    flight = SingleFlight(str(tmp_path))
+
+    def fail():
+        time.sleep(0.1)
+        raise RuntimeError("provider down")
+
+    _, errors = run_concurrently(3, lambda: flight.do("key", fail))
+
+    assert all(isinstance(e, RuntimeError) for e in errors)
+    assert flight.do("key", lambda: "recovered") == ("recovered", False)
+
+
+def test_workers_on_a_host_share_a_published_result(tmp_path):
+    worker_a, worker_b = SingleFlight(str(tmp_path)), SingleFlight(str(tmp_path))
+    started = threading.Event()
+
+    def slow():
+        started.set()
+        time.sleep(0.3)
+        return {"from": "a"}
+
+    leader = threading.Thread(target=lambda: worker_a.do("key", slow))
+    leader.start()
+    started.wait(2)
+
+    result = worker_b.do("key", lambda: pytest.fail("worker b should reuse worker a's result"))
+    leader.join()
+
+    assert result == ({"from": "a"}, True)
+    assert worker_b.stats()["coalesced_remote"] == 1
+
+
+def test_an_old_published_result_is_not_replayed(tmp_path):
+    flight = SingleFlight(str(tmp_path))
+    flight.do("key", lambda: {"run": 1})
+
+    assert flight.do("key", lambda: {"run": 2}) == ({"run": 2}, False)
+
+
+def test_async_callers_coalesce(tmp_path):
+    flight = SingleFlight(str(tmp_path))
+    calls = []
+
+    async def generate():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return "staged"
+
+    async def run():
+        return await asyncio.gather(*(flight.ado("key", generate) for _ in range(4)))
+
+    results = asyncio.run(run())
+
+    assert len(calls) == 1
+    assert [result for result, _ in results] == ["staged"] * 4
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_async_caller_reuses_another_workers_result(tmp_path):
+    worker_a, worker_b = SingleFlight(str(tmp_path)), SingleFlight(str(tmp_path))
+    started = threading.Event()
+
+    def slow():
+        started.set()
+        time.sleep(0.3)
+        return {"from": "a"}
+
+    leader = threading.Thread(target=lambda: worker_a.do("key", slow))
+    leader.start()
+    started.wait(2)
+
+    async def never():
+        pytest.fail("the async caller should reuse worker a's result")
+
+    result = asyncio.run(worker_b.ado("key", never))
+    leader.join()
+
+    assert result == ({"from": "a"}, True)
+
+
+def test_cancelled_async_waiter_leaves_the_lock_free(tmp_path):
+    worker_a, worker_b = SingleFlight(str(tmp_path)), SingleFlight(str(tmp_path))
+    started = threading.Event()
+    leader = threading.Thread(target=lambda: worker_a.do("key", lambda: started.set() or time.sleep(0.3) or "a"))
+    leader.start()
+    started.wait(2)
+
+    async def quick():
+        return "b"
+
+    async def run():
+        waiting = asyncio.ensure_future(worker_b.ado("key", quick))
+        await asyncio.sleep(0.1)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        leader.join()
+        return await asyncio.wait_for(worker_b.ado("key", quick), 2)
+
+    assert asyncio.run(run()) == ("b", False)
+
+
+def test_idempotency_store_replays_and_detects_conflicts(tmp_path):
+    store = IdempotencyStore(str(tmp_path))
+    store.set("generate-image", "key-1", "fp-1", 200, {"image_url": "/artifacts/x"})
+
+    assert store.get("generate-image", "key-1", "fp-1") == {
+        "fingerprint": "fp-1", "status_code": 200, "body": {"image_url": "/artifacts/x"}}
+    assert store.get("generate-image", "key-2", "fp-1") is None
+    assert store.get("jobs", "key-1", "fp-1") is None
+    with pytest.raises(IdempotencyConflict):
+        store.get("generate-image", "key-1", "fp-other")
+    assert store.stats() == {"stored": 1, "replayed": 1, "conflicts": 1}
+
+
+def test_idempotency_records_expire(tmp_path):
+    store = IdempotencyStore(str(tmp_path), ttl_seconds=60)
+    store.set("generate-image", "key", "fp", 200, {})
+    path = store._path("generate-image", "key")
+    os.utime(path, (time.time() - 120, time.time() - 120))
+
+    assert store.get("generate-image", "key", "fp") is None
+    assert not os.path.exists(path)
+
+
+def test_idempotency_key_cannot_steer_the_path(tmp_path):
+    store = IdempotencyStore(str(tmp_path))
+    store.set("generate-image", "../../escape", "fp", 200, {})
+
+    assert os.listdir(tmp_path) == [os.path.basename(store._path("generate-image", "../../escape"))]
@@ -0,0 +1,155 @@
+import asyncio
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+
+import deadlines
+import main
+import providers
+from bench.stub_server import Latency
+from conftest import room_photo
+from deadlines import DeadlineExceeded, LatencyTracker, ahedged, clamp_timeout, deadline_scope, hedged
+
+
+@pytest.fixture(scope="module")
+def executor():
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        yield pool
+
+
+def slow_then_fast(first_seconds, answer="answer"):
+    """A call whose first copy takes `first_seconds` and later copies answer at once"""
+    calls = []
+    lock = threading.Lock()
+
+    def call():
+        with lock:
+            calls.append(time.monotonic())
+            first = len(calls) == 1
+        if first:
+            time.sleep(first_seconds)
+            return "slow"
+        return answer
+    return call, calls
+
+
+def test_scopes_nest_and_never_outlive_the_outer_one():
+    assert deadlines.remaining() is None
+    with deadline_scope(0.5):
+        with deadline_scope(60) as inner:
+            assert inner.remaining() <= 0.5
+        with deadline_scope(0.1):
+            assert deadlines.remaining() <= 0.1
+    assert deadlines.remaining() is None
+
+
+def test_check_raises_once_the_deadline_passes():
+    with deadline_scope(0.05):
+        deadlines.check()
+        time.sleep(0.06)
+        with pytest.raises(DeadlineExceeded):
+            deadlines.check()
+
+
+def test_timeouts_are_clamped_to_the_time_left():
+    timeout = httpx.Timeout(connect=10, read=300, write=30, pool=10)
+
+    assert clamp_timeout(timeout) is timeout
+    with deadline_scope(2):
+        clamped = clamp_timeout(timeout)
+    assert max(clamped.connect, clamped.read, clamped.write, clamped.pool) <= 2
+
+
+def test_latency_tracker_needs_enough_samples():
+    tracker = LatencyTracker(window=100, min_samples=10)
+    assert tracker.quantile(0.95, default=7) == 7
+    for n in range(100):
+        tracker.observe(n / 100)
+
+    assert tracker.quantile(0.5) == pytest.approx(0.5)
+    assert tracker.quantile(0.95) == pytest.approx(0.95)
+    assert tracker.stats()["samples"] == 100
+
+
+def test_fast_calls_are_not_hedged(executor):
+    assert hedged(lambda: "answer", hedge_after=1, timeout=2, executor=executor) == ("answer", False, False)
+
+
+def test_a_slow_call_is_hedged_and_the_copy_wins(executor):
+    call, calls = slow_then_fast(1.0)
+    started = time.monotonic()
+
+    assert hedged(call, hedge_after=0.05, timeout=2, executor=executor) == ("answer", True, False)
+    assert time.monotonic() - started < 0.5
+    assert len(calls) == 2
+
+
+def test_a_failed_copy_does_not_win(executor):
+    call, _ = slow_then_fast(0.2, answer=None)
+
+    assert hedged(call, hedge_after=0.05, timeout=2, executor=executor) == ("slow", True, False)
+
+
+def test_hedged_gives_up_at_the_timeout(executor):
+    assert hedged(lambda: time.sleep(1), hedge_after=0.05, timeout=0.1, executor=executor) == (None, True, True)
+    assert hedged(lambda: time.sleep(1), hedge_after=0.2, timeout=0.1, executor=executor) == (None, False, True)
+
+
+def test_async_hedging_cancels_the_loser():
+    cancelled = []
+
+    async def run():
+        copies = 0
+
+        async def call():
+            nonlocal copies
+            copies += 1
+            if copies == 1:
+                try:
+                    await asyncio.sleep(5)
+                except asyncio.CancelledError:
+                    cancelled.append(True)
+                    raise
+            return "answer"
+
+        result = await ahedged(call, hedge_after=0.05, timeout=2)
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(run()) == ("answer", True, False)
+    assert cancelled == [True]
+
+
+def generate(seed, **fields):
+    return main.app.test_client().post("/generate-image", data={
+        "image": (io.BytesIO(room_photo(seed=seed)), "room.jpg"),
+        **fields,
+    })
+
+
+def test_analysis_is_skipped_when_generation_needs_the_budget(stub, monkeypatch):
+    monkeypatch.setattr(main, "GENERATION_RESERVE_SECONDS", main.PIPELINE_DEADLINE_SECONDS - 1)
+
+    response = generate(seed=50)
+
+    assert response.status_code == 200
+    assert response.json["degradations"] == ["analysis_skipped"]
+    assert "scene_analysis" not in response.json
+
+
+def test_generation_past_the_deadline_is_504(stub, monkeypatch):
+    # Earlier tests may have spent the image model's burst; a rate-limit wait
+    # longer than the deadline would be refused with 429 instead
+    providers.governor.reset()
+    monkeypatch.setattr(main, "PIPELINE_DEADLINE_SECONDS", 0.3)
+    monkeypatch.setitem(stub.latency, "image", Latency("fixed:2000"))
+    started = time.monotonic()
+
+    response = generate(seed=51, enable_analysis="false")
+
+    assert response.status_code == 504
+    assert time.monotonic() - started < 1.5
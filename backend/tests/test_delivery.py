@@ -0,0 +1,174 @@
+import io
+import itertools
+import time
+
+import pytest
+from PIL import Image
+
+import main
+from conftest import room_photo
+from delivery import MIN_QUALITY, acceptable, negotiate, probe, supported_formats, transcode
+
+BROWSER_ACCEPT = "image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8"
+SEEDS = itertools.count(100)
+needs_webp = pytest.mark.skipif("webp" not in supported_formats(), reason="Pillow built without WebP")
+
+
+def encode(fmt, size=(320, 240), mode="RGB"):
+    return room_photo(seed=2, size=size, fmt=fmt, mode=mode)
+
+
+@pytest.mark.parametrize("fmt,mime", [
+    ("PNG", "image/png"),
+    ("JPEG", "image/jpeg"),
+    ("WEBP", "image/webp"),
+    ("GIF", "image/gif"),
+])
+def test_probe_reads_format_and_size_from_the_header(fmt, mime):
+    info = probe(encode(fmt, size=(333, 217)))
+
+    assert (info.format, info.mime_type, info.width, info.height) == (fmt, mime, 333, 217)
+
+
+def test_probe_reads_lossless_and_alpha_webp():
+    lossless = io.BytesIO()
+    Image.new("RGBA", (97, 45), (10, 20, 30, 128)).save(lossless, "WEBP", lossless=True)
+
+    info = probe(lossless.getvalue())
+
+    assert (info.format, info.width, info.height) == ("WEBP", 97, 45)
+
+
+def test_probe_survives_truncated_and_unknown_data():
+    assert probe(b"not an image") is None
+    assert probe(encode("JPEG")[:4]) is None
+
+
+@pytest.mark.parametrize("accept,expected", [
+    (BROWSER_ACCEPT, ["avif", "webp", "jpeg"]),
+    ("image/webp,image/*;q=0.8", ["webp", "jpeg"]),
+    ("image/*", ["jpeg"]),
+    ("image/jpeg;q=0.9,image/webp;q=0.5", ["jpeg", "webp"]),
+    ("image/avif;q=0,image/webp", ["webp"]),
+    ("*/*", []),
+    ("application/json", []),
+    ("", []),
+    (None, []),
+])
+def test_acceptable_formats(accept, expected):
+    assert acceptable(accept, ["avif", "webp", "jpeg"]) == expected
+
+
+def test_acceptable_only_offers_the_formats_given():
+    assert acceptable(BROWSER_ACCEPT, ["webp", "jpeg"]) == ["webp", "jpeg"]
+
+
+def test_negotiate_picks_the_best_or_none():
+    assert negotiate(BROWSER_ACCEPT, ["avif", "webp", "jpeg"]) == "avif"
+    assert negotiate("image/*", ["avif", "webp", "jpeg"]) == "jpeg"
+    assert negotiate("*/*", ["avif", "webp", "jpeg"]) is None
+
+
+@pytest.mark.parametrize("fmt", supported_formats())
+def test_transcode_shrinks_a_png_into_the_target(fmt):
+    original = encode("PNG", size=(800, 600))
+
+    data, mime = transcode(original, fmt, target_bytes=len(original) // 2, quality=90)
+
+    assert len(data) <= len(original) // 2
+    assert mime == f"image/{fmt}"
+    with Image.open(io.BytesIO(data)) as img:
+        assert img.size == (800, 600)
+
+
+def test_transcode_steps_quality_down_but_not_below_the_floor():
+    original = encode("PNG", size=(800, 600))
+    floor = io.BytesIO()
+    Image.open(io.BytesIO(original)).convert("RGB").save(floor, "JPEG", quality=MIN_QUALITY, optimize=True,
+                                                         progressive=True)
+
+    data, _ = transcode(original, "jpeg", target_bytes=1, quality=90)
+
+    assert len(data) == len(floor.getvalue())
+
+
+def test_transcode_keeps_the_original_when_it_is_not_smaller():
+    buf = io.BytesIO()
+    Image.open(io.BytesIO(encode("PNG"))).save(buf, "JPEG", quality=10)
+    small = buf.getvalue()
+
+    data, mime = transcode(small, "jpeg", target_bytes=1 << 20, quality=95)
+
+    assert data == small
+    assert mime == "image/jpeg"
+
+
+def test_jpeg_flattens_transparency_onto_white():
+    buf = io.BytesIO()
+    Image.new("RGBA", (400, 300), (255, 0, 0, 0)).save(buf, "PNG", compress_level=0)
+
+    data, mime = transcode(buf.getvalue(), "jpeg", target_bytes=1 << 20, quality=90)
+
+    assert mime == "image/jpeg"
+    with Image.open(io.BytesIO(data)) as img:
+        assert img.mode == "RGB"
+        assert all(channel > 245 for channel in img.getpixel((200, 150)))
+
+
+@needs_webp
+def test_webp_keeps_transparency():
+    buf = io.BytesIO()
+    Image.new("RGBA", (400, 300), (255, 0, 0, 0)).save(buf, "PNG", compress_level=0)
+
+    data, _ = transcode(buf.getvalue(), "webp", target_bytes=1 << 20, quality=90)
+
+    with Image.open(io.BytesIO(data)) as img:
+        assert img.mode == "RGBA"
+        assert img.getpixel((200, 150))[3] == 0
+
+
+@pytest.fixture
+def generated():
+    """Artifact id of a new stored "generated" PNG, as read_generation stores one"""
+    data = room_photo(seed=next(SEEDS), size=(800, 600), fmt="PNG")
+    return main.artifact_store.put(data, "image/png", width=800, height=600)
+
+
+def wait_for_deliveries():
+    deadline = time.monotonic() + 10
+    while main.pending_deliveries and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+@needs_webp
+def test_artifact_request_serves_the_original_until_its_format_is_encoded(generated):
+    client = main.app.test_client()
+    first = client.get(f"/artifacts/{generated}", headers={"Accept": "image/webp,image/*"})
+    wait_for_deliveries()
+    second = client.get(f"/artifacts/{generated}", headers={"Accept": "image/webp,image/*"})
+
+    assert first.mimetype == "image/png"
+    assert first.cache_control.max_age == main.DELIVERY_PENDING_MAX_AGE
+    assert not first.cache_control.immutable
+    assert "Accept" in first.vary
+    assert second.mimetype == "image/webp"
+    assert second.cache_control.immutable
+    assert len(second.data) < len(first.data)
+
+
+@needs_webp
+def test_only_negotiated_formats_are_encoded(generated):
+    client = main.app.test_client()
+    client.get(f"/artifacts/{generated}", headers={"Accept": "image/webp"})
+    client.get(f"/artifacts/{generated}", headers={"Accept": "*/*"})
+    wait_for_deliveries()
+
+    assert main.artifact_store.get_variant(generated, main.delivery_variant_name("webp"))
+    assert not main.artifact_store.get_variant(generated, main.delivery_variant_name("jpeg"))
+
+
+def test_original_is_available_on_request(generated):
+    response = main.app.test_client().get(f"/artifacts/{generated}?original=true", headers={"Accept": "image/webp"})
+
+    assert response.mimetype == "image/png"
+    assert response.cache_control.immutable
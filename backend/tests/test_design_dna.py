@@ -0,0 +1,92 @@
+import io
+import json
+
+import pytest
+from PIL import Image, ImageDraw
+
+import main
+from design_dna import HousePalettes, color_name, describe, extract_swatches, merge_swatches, rgb_to_lab
+
+EMPTY_ROOM = (214, 200, 178)
+NAVY = (32, 42, 78)
+TERRACOTTA = (190, 100, 70)
+
+
+def photo(*furniture):
+    """JPEG of a plain room with (box, color) pieces of furniture drawn in"""
+    img = Image.new("RGB", (640, 480), EMPTY_ROOM)
+    draw = ImageDraw.Draw(img)
+    for box, color in furniture:
+        draw.rectangle(box, fill=color)
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=92)
+    return buf.getvalue()
+
+
+def swatch(rgb, weight):
+    return {"lab": [float(v) for v in rgb_to_lab(rgb)], "weight": weight}
+
+
+def house(house_id):
+    return {"id": house_id, "name": "Elm St", "roomsStaged": 1,
+            "designDNA": {"primaryColors": "white", "accentColors": "navy", "woodTone": "oak",
+                          "metalFinish": "brass", "textileStyle": "linen"}}
+
+
+def test_swatches_come_from_what_the_generation_added():
+    staged = photo(((100, 250, 400, 420), NAVY), ((450, 300, 560, 420), TERRACOTTA))
+
+    swatches = extract_swatches(staged, photo())
+
+    assert [color_name(s["lab"]) for s in swatches[:2]] == ["navy", "terracotta"]
+    assert sum(s["weight"] for s in swatches) == pytest.approx(1, abs=0.01)
+    # The walls the photo already had are not part of the palette
+    assert "beige" not in [color_name(s["lab"]) for s in swatches]
+
+
+def test_an_unchanged_room_has_no_swatches():
+    assert extract_swatches(photo(), photo()) == []
+
+
+def test_merge_folds_close_colors_and_caps_the_palette():
+    merged = merge_swatches([swatch(NAVY, 0.5)], [swatch((34, 44, 80), 0.5), swatch(TERRACOTTA, 0.5)])
+
+    assert len(merged) == 2
+    assert merged[0]["weight"] == pytest.approx(1.0)
+    many = [swatch((n * 20, 255 - n * 20, 128), 0.1) for n in range(12)]
+    assert len(merge_swatches(many, many[:6], max_swatches=5)) <= 5
+
+
+def test_describe_names_wood_only_when_there_is_some():
+    dna = describe([swatch(NAVY, 0.6), swatch((190, 150, 105), 0.4)])
+
+    assert dna["primaryColors"].startswith("navy (#")
+    assert "wood" in dna["woodTone"]
+    assert "woodTone" not in describe([swatch(NAVY, 1.0)])
+
+
+def test_house_palette_merges_each_room_once(tmp_path):
+    palettes = HousePalettes(str(tmp_path))
+    navy_room = [swatch(NAVY, 1.0)]
+
+    palettes.add_room("house-1", "artifact-a", navy_room)
+    palettes.add_room("house-1", "artifact-a", navy_room)  # A replayed result
+    palette = palettes.add_room("house-1", "artifact-b", [swatch(TERRACOTTA, 1.0)])
+
+    assert palette["rooms"] == 2
+    assert HousePalettes(str(tmp_path)).get("house-1")["rooms"] == 2
+    assert palettes.stats()["duplicates"] == 1
+    assert palettes.add_room("../escape", "artifact-c", navy_room) is None
+
+
+def test_prompt_and_fingerprint_use_the_measured_palette():
+    form = {"house_continuity": json.dumps(house("fingerprinted")), "enable_analysis": "false"}
+    before = main.parse_generation_params(form)
+
+    main.house_palettes.add_room("fingerprinted", "artifact-a", [swatch(NAVY, 0.7), swatch(TERRACOTTA, 0.3)])
+    after = main.parse_generation_params(form)
+
+    assert after["house_continuity"]["designDNA"]["primaryColors"].startswith("navy")
+    assert main.generation_fingerprint("digest", before) != main.generation_fingerprint("digest", after)
+    payload = main.generation_payload_builder(after, None)({"text": "photo"})
+    assert after["house_continuity"]["designDNA"]["primaryColors"] in payload["contents"][0]["parts"][1]["text"]
@@ -0,0 +1,114 @@
+import io
+import os
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+import main
+from artifacts import ArtifactStore
+from conftest import room_photo
+from exports import ExportError, ExportService, export_size, parse_export_options, render_export
+
+
+@pytest.fixture
+def generated():
+    """A stored 1600x1200 PNG, the way generations come back"""
+    return main.artifact_store.put(room_photo(seed=30, size=(1600, 1200), fmt="PNG"), "image/png",
+                                   width=1600, height=1200)
+
+
+@pytest.mark.parametrize("size,long_edge,expected", [
+    ((1600, 1200), 1024, (1024, 768)),
+    ((1200, 1600), 1024, (768, 1024)),
+    ((1920, 1080), 3840, (3840, 2160)),
+    ((1000, 1000), 2048, (2048, 2048)),
+])
+def test_export_size_scales_the_long_edge(size, long_edge, expected):
+    assert export_size(size, long_edge) == expected
+
+
+@pytest.mark.parametrize("args,expected", [
+    ((None, None, None), ("png", "original", None)),
+    (("JPG", "MLS", "80"), ("jpeg", "mls", 80)),
+    (("webp", "4k", None), ("webp", "4k", 92)),
+    (("png", "mls_small", "70"), ("png", "mls_small", None)),
+])
+def test_export_options(args, expected):
+    assert parse_export_options(*args) == expected
+
+
+@pytest.mark.parametrize("args", [("tiff", None, None), ("png", "8k", None), ("jpeg", None, "40"),
+                                  ("jpeg", None, "high")])
+def test_bad_export_options_are_400(args):
+    with pytest.raises(ExportError) as rejected:
+        parse_export_options(*args)
+
+    assert rejected.value.status_code == 400
+
+
+@pytest.mark.parametrize("fmt,size,dimensions", [
+    ("jpeg", "mls_small", (1024, 768)),
+    ("webp", "mls", (2048, 1536)),
+    ("png", "original", (1600, 1200)),
+])
+def test_render_export_size_and_format(fmt, size, dimensions):
+    source = room_photo(seed=31, size=(1600, 1200), fmt="PNG")
+
+    with Image.open(io.BytesIO(render_export(source, fmt, size, 90))) as img:
+        assert (img.format.lower(), img.size) == (fmt, dimensions)
+
+
+def test_export_endpoint_names_the_download_after_the_format(generated):
+    response = main.app.test_client().get(
+        f"/artifacts/{generated}/export?format=jpeg&size=mls_small&filename=../staged-living.png")
+
+    assert response.status_code == 200
+    assert response.mimetype == "image/jpeg"
+    assert response.headers["Content-Disposition"] == "attachment; filename=staged-living.jpg"
+    with Image.open(io.BytesIO(response.data)) as img:
+        assert img.size == (1024, 768)
+
+
+def test_export_endpoint_errors(generated):
+    client = main.app.test_client()
+
+    assert client.get(f"/artifacts/{generated}/export?format=bmp").status_code == 400
+    assert client.get(f"/artifacts/{'0' * 64}/export?format=png").status_code == 404
+
+
+def test_derivatives_are_rendered_once(tmp_path, monkeypatch):
+    store = ArtifactStore(str(tmp_path))
+    source = store.put(room_photo(seed=32, size=(800, 600), fmt="PNG"), "image/png")
+    service = ExportService(store)
+    renders = []
+    render = render_export
+    monkeypatch.setattr("exports.render_export", lambda *args: renders.append(args) or render(*args))
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(service.get_or_create(source, "jpeg", "mls_small", 90)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    assert len(renders) == 1
+    assert len(set(results)) == 1 and len(results) == 4
+
+
+def test_an_evicted_artifact_takes_its_exports_with_it(tmp_path):
+    store = ArtifactStore(str(tmp_path))
+    source = store.put(room_photo(seed=33, size=(800, 600), fmt="PNG"), "image/png")
+    export = ExportService(store).get_or_create(source, "jpeg", "mls_small", 90)
+
+    old = time.time() - 300
+    os.utime(store._blob_path(source), (old, old))
+
+    # The export alone fits the budget, but goes with the source it came from
+    store.max_disk_bytes = os.path.getsize(store._blob_path(export))
+    store.trim()
+
+    assert store.path(source) is None
+    assert store.path(export) is None
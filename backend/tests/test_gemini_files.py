@@ -0,0 +1,107 @@
+import asyncio
+import time
+
+import pytest
+
+from analysis_cache import AnalysisCache
+from conftest import room_photo
+from gemini_files import GeminiFiles
+from ingest import ingest_image
+
+MODEL = "gemini-3-flash-preview"
+
+
+def payload(part):
+    return {"contents": [{"parts": [part, {"text": "Describe the room"}]}]}
+
+
+@pytest.fixture
+def files(tmp_path):
+    cache = AnalysisCache(str(tmp_path / "gemini-files"), max_entries=16, ttl_seconds=3600)
+    return GeminiFiles(cache, enabled=True)
+
+
+@pytest.fixture
+def photo():
+    return ingest_image(room_photo(seed=1))
+
+
+def file_uri(part):
+    return part["fileData"]["fileUri"]
+
+
+def test_uploads_once_and_reuses_the_file(stub, files, photo):
+    first = files.generate(MODEL, photo, payload, "stub", "analysis")
+    second = files.generate(MODEL, photo, payload, "stub", "analysis")
+
+    assert first.status_code == second.status_code == 200
+    assert files.stats()["uploads"] == 1
+    assert files.stats()["reused"] >= 1
+    assert len(stub.files) == 1
+    assert file_uri(files.part(photo, "stub")) in stub.files
+
+
+def test_reuse_survives_a_new_worker(stub, files, photo, tmp_path):
+    uri = file_uri(files.part(photo, "stub"))
+
+    # Another worker on the host shares the cache directory
+    other = GeminiFiles(AnalysisCache(str(tmp_path / "gemini-files"), max_entries=16, ttl_seconds=3600), enabled=True)
+    assert file_uri(other.part(photo, "stub")) == uri
+    assert other.stats()["uploads"] == 0
+
+
+def test_file_gone_at_the_provider_is_uploaded_again(stub, files, photo):
+    uri = file_uri(files.part(photo, "stub"))
+    stub.files[uri] = 0  # Expired or deleted on the provider's side
+
+    response = files.generate(MODEL, photo, payload, "stub", "analysis")
+
+    assert response.status_code == 200
+    assert files.stats()["reuploads"] == 1
+    assert files.stats()["uploads"] == 2
+    assert file_uri(files.part(photo, "stub")) != uri
+
+
+def test_file_close_to_expiry_counts_as_a_miss(stub, files, photo):
+    stub.file_ttl = files.expiry_margin / 2
+    first = file_uri(files.part(photo, "stub"))
+
+    second = file_uri(files.part(photo, "stub"))
+
+    assert second != first
+    assert files.stats()["uploads"] == 2
+    assert files.stats()["reused"] == 0
+
+
+def test_disabled_sends_the_photo_inline(stub, tmp_path, photo):
+    files = GeminiFiles(AnalysisCache(str(tmp_path / "off")), enabled=False)
+
+    part = files.part(photo, "stub")
+
+    assert "inlineData" in part
+    assert files.generate(MODEL, photo, payload, "stub", "analysis").status_code == 200
+    assert not stub.files
+
+
+def test_async_path_shares_the_cache(stub, files, photo):
+    uri = file_uri(files.part(photo, "stub"))
+
+    async def run():
+        part = await files.apart(photo, "stub")
+        response = await files.agenerate(MODEL, photo, payload, "stub", "analysis")
+        return part, response
+
+    part, response = asyncio.run(run())
+    assert file_uri(part) == uri
+    assert response.status_code == 200
+    assert files.stats()["uploads"] == 1
+
+
+def test_async_reupload_after_expiry(stub, files, photo):
+    uri = file_uri(files.part(photo, "stub"))
+    stub.files[uri] = time.time() - 1
+
+    response = asyncio.run(files.agenerate(MODEL, photo, payload, "stub", "analysis"))
+
+    assert response.status_code == 200
+    assert files.stats()["reuploads"] == 1
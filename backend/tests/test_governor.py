@@ -0,0 +1,225 @@
+import asyncio
+import time
+
+import pytest
+
+import deadlines
+from governor import CircuitBreaker, Governor, Outcome, ProviderUnavailable, TokenBucket, parse_retry_after
+
+
+def always(outcome):
+    return lambda result, error: outcome
+
+
+def test_bucket_serves_the_burst_then_paces_callers():
+    bucket = TokenBucket(rpm=600, burst=2)
+
+    assert bucket.reserve(max_wait=1) == 0
+    assert bucket.reserve(max_wait=1) == 0
+    # 10 per second: each further caller queues 0.1s behind the one before
+    assert bucket.reserve(max_wait=1) == pytest.approx(0.1, abs=0.02)
+    assert bucket.reserve(max_wait=1) == pytest.approx(0.2, abs=0.02)
+
+
+def test_bucket_refuses_a_wait_longer_than_max_wait():
+    bucket = TokenBucket(rpm=60, burst=1)
+    bucket.reserve(max_wait=1)
+
+    with pytest.raises(ProviderUnavailable) as refused:
+        bucket.reserve(max_wait=0.5)
+
+    assert refused.value.status_code == 429
+    assert refused.value.retry_after >= 1
+    # A refused caller didn't take a token
+    assert bucket.reserve(max_wait=1.5) == pytest.approx(1, abs=0.05)
+
+
+def test_pause_holds_every_caller():
+    bucket = TokenBucket(rpm=6000, burst=5)
+    bucket.pause(0.3)
+
+    assert bucket.reserve(max_wait=1) == pytest.approx(0.3, abs=0.02)
+
+
+def test_deferred_calls_leave_headroom():
+    bucket = TokenBucket(rpm=60, burst=3)
+
+    # Three tokens and a headroom of one: two go to deferred calls
+    assert bucket.reserve_deferred(headroom=1) == 0
+    assert bucket.reserve_deferred(headroom=1) == 0
+    assert bucket.reserve_deferred(headroom=1) > 0
+    # The last token is still there for everyone else
+    assert bucket.reserve(max_wait=0) == 0
+
+
+def test_deferred_acquire_gives_up_after_max_wait():
+    bucket = TokenBucket(rpm=60, burst=1)
+    bucket.reserve(max_wait=0)
+
+    started = time.monotonic()
+    with pytest.raises(ProviderUnavailable):
+        bucket.acquire_deferred(max_wait=0.2, headroom=0)
+    assert time.monotonic() - started < 0.5
+    assert bucket.waiting == 0
+
+
+def test_breaker_opens_after_repeated_failures_and_probes_once():
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=0.1)
+    breaker.record(failure=True)
+    assert breaker.allow()
+    breaker.record(failure=True)
+
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    time.sleep(0.12)
+    assert breaker.allow()  # the probe
+    assert not breaker.allow()  # nobody else until it reports back
+    breaker.record(failure=False)
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def test_failed_probe_reopens_the_breaker():
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0.05)
+    breaker.record(failure=True)
+    time.sleep(0.06)
+    assert breaker.allow()
+
+    breaker.record(failure=True)
+
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+
+def test_call_retries_retryable_outcomes_and_returns_the_last_result():
+    governor = Governor(limits={"m": {"rpm": 6000, "burst": 10}}, max_retries=2, base_backoff=0.01)
+    attempts = []
+
+    def send():
+        attempts.append(1)
+        return len(attempts)
+
+    result = governor.call("m", send, lambda result, error: Outcome(retryable=result < 3))
+
+    assert result == 3
+    assert governor.stats()["m"]["retries"] == 2
+
+
+def test_call_reraises_the_last_error():
+    governor = Governor(limits={"m": {"rpm": 6000, "burst": 10}}, max_retries=1, base_backoff=0.01)
+
+    def send():
+        raise ConnectionError("reset")
+
+    with pytest.raises(ConnectionError):
+        governor.call("m", send, always(Outcome(retryable=True, failure=True)))
+    assert governor.stats()["m"]["calls"] == 2
+
+
+def test_retry_after_pauses_the_lane():
+    governor = Governor(limits={"m": {"rpm": 6000, "burst": 10}}, max_retries=1, base_backoff=0.01)
+    outcomes = iter([Outcome(retryable=True, retry_after=0.2), Outcome()])
+
+    started = time.monotonic()
+    governor.call("m", lambda: "ok", lambda result, error: next(outcomes))
+
+    assert time.monotonic() - started >= 0.2
+    # Other callers on the lane wait out the pause too
+    assert governor.lane("m").bucket.paused_until > 0
+
+
+def test_retry_after_longer_than_max_backoff_is_not_waited_out():
+    governor = Governor(limits={"m": {"rpm": 6000, "burst": 10}}, max_retries=3, max_backoff=1)
+    calls = []
+
+    result = governor.call("m", lambda: calls.append(1) or "429", always(Outcome(retryable=True, retry_after=30)))
+
+    assert result == "429"
+    assert len(calls) == 1
+
+
+def test_open_breaker_fails_fast():
+    governor = Governor(limits={"m": {"rpm": 6000, "burst": 10}}, max_retries=0, failure_threshold=1,
+                        reset_seconds=60)
+    governor.call("m", lambda: "500", always(Outcome(failure=True)))
+
+    with pytest.raises(ProviderUnavailable) as refused:
+        governor.call("m", lambda: "never sent", always(Outcome()))
+
+    assert refused.value.status_code == 503
+    assert governor.stats()["m"]["rejected_open"] == 1
+    assert governor.stats()["m"]["circuit"] == "open"
+
+
+def test_deferred_context_uses_its_own_wait_and_headroom():
+    batch = {"on": False}
+    governor = Governor(max_wait=5, deferred=lambda: batch["on"], deferred_max_wait=60, headroom=2)
+
+    assert governor._admission() == (5, None)
+    batch["on"] = True
+    assert governor._admission() == (60, 2)
+    with deadlines.deadline_scope(1):
+        max_wait, headroom = governor._admission()
+    assert max_wait <= 1 and headroom == 2
+
+
+def test_no_attempt_once_the_deadline_has_passed():
+    governor = Governor()
+    sent = []
+
+    with deadlines.deadline_scope(0), pytest.raises(deadlines.DeadlineExceeded):
+        governor.call("m", lambda: sent.append(1), always(Outcome()))
+    assert not sent
+
+
+def test_backoff_never_runs_past_the_deadline():
+    governor = Governor(limits={"m": {"rpm": 6000, "burst": 10}}, max_retries=5, base_backoff=2, max_backoff=8)
+    calls = []
+
+    started = time.monotonic()
+    with deadlines.deadline_scope(0.3):
+        governor.call("m", lambda: calls.append(1), always(Outcome(retryable=True, retry_after=1)))
+
+    assert time.monotonic() - started < 0.3
+    assert len(calls) == 1
+
+
+def test_async_call_shares_the_lane():
+    governor = Governor(limits={"m": {"rpm": 6000, "burst": 10}}, max_retries=1, base_backoff=0.01)
+    governor.call("m", lambda: "sync", always(Outcome()))
+
+    async def send():
+        return "async"
+
+    assert asyncio.run(governor.acall("m", send, always(Outcome()))) == "async"
+    assert governor.stats()["m"]["calls"] == 2
+
+
+def test_guard_records_stream_failures():
+    governor = Governor(limits={"m": {"rpm": 6000, "burst": 10}}, failure_threshold=1)
+
+    with pytest.raises(RuntimeError):
+        with governor.guard("m", always(Outcome(failure=True))):
+            raise RuntimeError("stream broke")
+
+    assert governor.stats()["m"]["circuit"] == "open"
+
+
+def test_reset_forgets_every_lane():
+    governor = Governor(failure_threshold=1)
+    governor.call("m", lambda: "500", always(Outcome(failure=True)))
+    lock = governor._lock
+
+    governor.reset()
+
+    assert governor.stats() == {}
+    assert governor._lock is not lock
+    assert governor.lane("m").breaker.state == "closed"
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("3") == 3.0
+    assert parse_retry_after("-1") == 0.0
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") is None
+    assert parse_retry_after(None) is None
@@ -0,0 +1,81 @@
+import io
+
+import pytest
+from PIL import Image
+
+import main
+from conftest import room_photo
+from ingest import UploadError, ingest_image
+
+
+def decoded(ingested):
+    img = Image.open(io.BytesIO(ingested.data))
+    img.load()
+    return img
+
+
+@pytest.mark.parametrize("fmt", ["JPEG", "PNG", "WEBP", "GIF"])
+def test_every_format_becomes_a_jpeg(fmt):
+    ingested = ingest_image(room_photo(seed=3, size=(320, 240), fmt=fmt))
+
+    assert (ingested.mime_type, ingested.original_format) == ("image/jpeg", fmt)
+    assert decoded(ingested).format == "JPEG"
+    assert (ingested.width, ingested.height) == (320, 240)
+
+
+def test_large_photos_are_downscaled_to_the_max_edge():
+    ingested = ingest_image(room_photo(seed=4, size=(1600, 1200)), max_edge=800)
+
+    assert (ingested.width, ingested.height) == (800, 600)
+    assert ingested.dimensions() == {"width": 800, "height": 600, "original_width": 1600, "original_height": 1200}
+    assert decoded(ingested).size == (800, 600)
+
+
+def test_exif_orientation_is_applied_and_metadata_dropped():
+    img = Image.open(io.BytesIO(room_photo(seed=5, size=(400, 300))))
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Rotated 90 degrees: displayed portrait
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", exif=exif)
+
+    ingested = ingest_image(buf.getvalue())
+
+    assert (ingested.width, ingested.height) == (300, 400)
+    assert (ingested.original_width, ingested.original_height) == (300, 400)
+    assert not decoded(ingested).getexif()
+
+
+def test_transparency_is_flattened_onto_white():
+    buf = io.BytesIO()
+    Image.new("RGBA", (64, 48), (255, 0, 0, 0)).save(buf, "PNG")
+
+    img = decoded(ingest_image(buf.getvalue()))
+
+    assert img.mode == "RGB"
+    assert all(channel > 245 for channel in img.getpixel((32, 24)))
+
+
+def test_output_is_kept_within_the_byte_budget():
+    photo = room_photo(seed=6, size=(1200, 900))
+
+    ingested = ingest_image(photo, target_bytes=60 * 1024)
+
+    assert len(ingested.data) <= 60 * 1024
+    assert len(ingested.data) < len(ingest_image(photo).data)
+
+
+@pytest.mark.parametrize("raw", [b"", b"not an image", room_photo(seed=7)[:200]], ids=["empty", "text", "truncated"])
+def test_undecodable_uploads_are_rejected(raw):
+    with pytest.raises(UploadError) as rejected:
+        ingest_image(raw)
+
+    assert rejected.value.status_code == 400
+
+
+def test_endpoints_reject_a_non_image_with_400():
+    response = main.app.test_client().post("/generate-image", data={
+        "image": (io.BytesIO(b"GIF89a but not really"), "room.jpg"),
+    })
+
+    assert response.status_code == 400
+    assert "error" in response.json
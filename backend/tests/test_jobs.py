@@ -0,0 +1,123 @@
+import io
+import threading
+import time
+
+import pytest
+
+import main
+from conftest import room_photo
+from jobs import JobQueueFull, JobRunner, JobStore
+
+
+class Failure(Exception):
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def wait_finished(store, job_id, timeout=5):
+    deadline = time.monotonic() + timeout
+    job = store.get(job_id)
+    while job["stage"] not in ("done", "failed") and time.monotonic() < deadline:
+        job = store.wait_for_change(job_id, job["version"], deadline - time.monotonic())
+    return job
+
+
+def test_job_moves_through_its_stages(tmp_path):
+    store = JobStore(str(tmp_path))
+    runner = JobRunner(store, max_workers=1)
+    seen = []
+
+    def pipeline(set_stage):
+        for stage in ("analyzing", "generating"):
+            seen.append(set_stage(stage)["stage"])
+        return {"image_url": "/artifacts/x"}
+
+    job = runner.submit(pipeline)
+    assert job["stage"] == "queued"
+    done = wait_finished(store, job["id"])
+
+    assert seen == ["analyzing", "generating"]
+    assert (done["stage"], done["status_code"], done["result"]) == ("done", 200, {"image_url": "/artifacts/x"})
+    assert done["version"] == 4
+
+
+def test_failed_job_keeps_the_status_and_message(tmp_path):
+    store = JobStore(str(tmp_path))
+    runner = JobRunner(store)
+
+    def pipeline(set_stage):
+        raise Failure("Gemini API error: quota", 429)
+
+    failed = wait_finished(store, runner.submit(pipeline)["id"])
+
+    assert (failed["stage"], failed["error"], failed["status_code"]) == ("failed", "Gemini API error: quota", 429)
+
+
+def test_submissions_past_the_queue_are_refused(tmp_path):
+    runner = JobRunner(JobStore(str(tmp_path)), max_workers=1, max_queued=1)
+    release = threading.Event()
+    runner.submit(lambda set_stage: release.wait(5))
+    runner.submit(lambda set_stage: None)
+
+    with pytest.raises(JobQueueFull):
+        runner.submit(lambda set_stage: None)
+    release.set()
+
+
+def test_a_job_whose_worker_died_is_failed_when_read(tmp_path):
+    store = JobStore(str(tmp_path), stale_seconds=0.2)
+    job = store.create()  # Its worker is gone: nothing touches it
+    time.sleep(0.3)
+
+    lost = store.get(job["id"])
+
+    assert (lost["stage"], lost["status_code"], lost["error"]) == ("failed", 503, JobStore.LOST_MESSAGE)
+    # Waiters are woken with the failure instead of waiting forever
+    assert store.wait_for_change(job["id"], job["version"], 1)["stage"] == "failed"
+
+
+def test_a_running_job_is_kept_alive_by_its_worker(tmp_path):
+    store = JobStore(str(tmp_path), stale_seconds=0.2)
+    runner = JobRunner(store)
+    job = runner.submit(lambda set_stage: time.sleep(0.6) or {"ok": True})
+
+    time.sleep(0.4)
+    assert store.get(job["id"])["stage"] == "queued"
+    assert wait_finished(store, job["id"])["stage"] == "done"
+
+
+def test_expired_jobs_are_trimmed(tmp_path):
+    store = JobStore(str(tmp_path), ttl_seconds=0)
+    job = store.create()
+
+    store.trim()
+
+    assert store.get(job["id"]) is None
+    assert store.get("../../etc/passwd") is None
+
+
+def test_job_endpoints(stub):
+    client = main.app.test_client()
+    submitted = client.post("/jobs", data={"image": (io.BytesIO(room_photo(seed=41)), "room.jpg"),
+                                           "enable_analysis": "false"})
+
+    assert submitted.status_code == 202
+    job_id = submitted.json["job_id"]
+    assert submitted.headers["Location"] == submitted.json["status_url"]
+    assert wait_finished(main.job_store, job_id)["stage"] == "done"
+    assert client.get(f"/jobs/{job_id}").json["result"]["image_url"].startswith("/artifacts/")
+    events = client.get(f"/jobs/{job_id}/events").get_data(as_text=True)
+    assert events.startswith("event: done\n")
+    assert client.get("/jobs/unknown").status_code == 404
+
+
+def test_job_upload_is_validated_before_queueing():
+    client = main.app.test_client()
+
+    assert client.post("/jobs", data={}).status_code == 400
+    assert client.post("/jobs", data={"upload_id": "0" * 64}).status_code == 404
+    response = client.post("/jobs", data={"image": (io.BytesIO(room_photo(seed=42)), "room.jpg"),
+                                          "house_continuity": "{not json"})
+    assert response.status_code == 400
@@ -0,0 +1,135 @@
+import hashlib
+import io
+import random
+
+import pytest
+from PIL import Image, ImageEnhance
+
+from conftest import room_photo
+from phash import PhashIndex, aspect_matches, distance, phash, phash_bytes
+
+
+def digest(n):
+    return hashlib.sha256(str(n).encode()).hexdigest()
+
+
+def reencode(data, transform=None, **save):
+    img = Image.open(io.BytesIO(data)).convert("RGB")
+    if transform:
+        img = transform(img)
+    buf = io.BytesIO()
+    img.save(buf, save.pop("format", "JPEG"), **save)
+    return buf.getvalue()
+
+
+@pytest.fixture
+def photo():
+    return room_photo(seed=7, size=(640, 480))
+
+
+@pytest.mark.parametrize("variant", [
+    lambda data: reencode(data, quality=55),
+    lambda data: reencode(data, format="PNG"),
+    lambda data: reencode(data, lambda img: img.resize((320, 240), Image.LANCZOS), quality=85),
+    lambda data: reencode(data, lambda img: ImageEnhance.Brightness(img).enhance(1.15), quality=90),
+    lambda data: reencode(data, lambda img: img.crop((8, 6, 632, 474)), quality=90),
+], ids=["jpeg_q55", "png", "half_size", "brighter", "small_crop"])
+def test_edits_of_a_photo_stay_within_a_few_bits(photo, variant):
+    assert distance(phash_bytes(photo), phash_bytes(variant(photo))) <= 6
+
+
+def test_different_rooms_are_far_apart():
+    hashes = [phash_bytes(room_photo(seed=seed, size=(640, 480))) for seed in range(8)]
+
+    nearest = min(distance(a, b) for i, a in enumerate(hashes) for b in hashes[i + 1:])
+    assert nearest > 10
+
+
+def test_hash_of_bytes_matches_hash_of_the_decoded_image(photo):
+    assert distance(phash_bytes(photo), phash(Image.open(io.BytesIO(photo)))) <= 2
+
+
+def test_lookup_finds_entries_within_the_radius(tmp_path):
+    index = PhashIndex(str(tmp_path / "index.bin"))
+    base = 0x0F0F_F0F0_1234_ABCD
+    index.add(base, digest(1), 1.5)
+    index.add(base ^ 0b111, digest(2), 1.5)  # 3 bits away
+    index.add(base ^ 0xFFFF, digest(3), 1.5)  # 16 bits away
+
+    matches = index.lookup(base, 6)
+
+    assert [(m.digest, m.distance) for m in matches] == [(digest(1), 0), (digest(2), 3)]
+    assert matches[0].aspect_ratio == pytest.approx(1.5)
+    assert index.lookup(base, 0)[0].digest == digest(1)
+
+
+@pytest.mark.parametrize("merge_threshold", [10_000, 8], ids=["tail_scan", "word_tables"])
+def test_lookup_agrees_with_a_linear_scan(tmp_path, merge_threshold):
+    index = PhashIndex(str(tmp_path / "index.bin"))
+    index.MERGE_THRESHOLD = merge_threshold
+    rng = random.Random(3)
+    entries = {}
+    for n in range(300):
+        # Clusters of near-duplicates around a few room hashes
+        if n % 5 == 0:
+            fingerprint = rng.getrandbits(64)
+        else:
+            fingerprint = rng.choice(list(entries.values())) ^ (1 << rng.randrange(64))
+        entries[digest(n)] = fingerprint
+        index.add(fingerprint, digest(n), 1.0)
+
+    for query in list(entries.values())[:40]:
+        expected = sorted(d for d, h in entries.items() if distance(h, query) <= 6)
+        assert sorted(m.digest for m in index.lookup(query, 6)) == expected
+
+
+def test_workers_share_the_index_file(tmp_path):
+    path = str(tmp_path / "index.bin")
+    worker_a, worker_b = PhashIndex(path), PhashIndex(path)
+
+    worker_a.add(42, digest(1), 1.0)
+
+    assert [m.digest for m in worker_b.lookup(42, 0)] == [digest(1)]
+
+
+def test_adding_the_same_photo_twice_keeps_one_entry(tmp_path):
+    index = PhashIndex(str(tmp_path / "index.bin"))
+    index.add(42, digest(1), 1.0)
+    index.add(42, digest(1), 1.0)
+
+    assert index.stats()["entries"] == 1
+
+
+def test_expired_entries_are_not_returned(tmp_path):
+    index = PhashIndex(str(tmp_path / "index.bin"), ttl_seconds=0)
+    index.add(42, digest(1), 1.0)
+
+    assert index.lookup(42, 6) == []
+
+
+def test_compaction_keeps_the_newest_half(tmp_path):
+    path = str(tmp_path / "index.bin")
+    index = PhashIndex(path, max_entries=4)
+    other = PhashIndex(path)
+    for n in range(5):
+        index.add(n << 32, digest(n), 1.0)
+
+    # The fifth entry went over max_entries and triggered a rewrite
+    assert other.stats()["entries"] == 2
+    assert [m.digest for m in other.lookup(4 << 32, 0)] == [digest(4)]
+    assert other.lookup(0, 0) == []
+
+
+def test_disabled_index_is_inert(tmp_path):
+    index = PhashIndex(str(tmp_path / "index.bin"), enabled=False)
+    index.add(42, digest(1), 1.0)
+
+    assert index.lookup(42, 6) == []
+    assert not (tmp_path / "index.bin").exists()
+
+
+def test_aspect_matches_is_relative():
+    assert aspect_matches(1.5, 1.51, 0.02)
+    assert aspect_matches(0.75, 0.7575, 0.02)
+    assert not aspect_matches(1.5, 1.6, 0.02)
+    assert not aspect_matches(1.5, 1 / 1.5, 0.02)
@@ -0,0 +1,118 @@
+import pytest
+
+import main
+from analysis_cache import AnalysisCache
+from scene_analysis import LEVELS, AnalysisInvalid, parse, parse_level, payload_builder, response_schema, to_dict
+
+
+def properties(schema):
+    return schema["properties"]
+
+
+def test_each_level_asks_for_more_than_the_one_below():
+    fast, standard, full = (set(properties(response_schema(level))) for level in LEVELS)
+
+    assert {"room_dimensions", "doorways", "windows", "lighting_analysis"} <= fast
+    assert "perspective_analysis" not in fast and "perspective_analysis" in standard
+    assert fast < standard <= full
+
+
+def test_nested_fields_follow_their_own_level():
+    doorway = {level: set(properties(properties(response_schema(level))["doorways"]["items"])) for level in LEVELS}
+
+    assert doorway["fast"] == {"location", "width_inches"}
+    assert "depth_from_camera_feet" in doorway["standard"]
+    assert "clearance_needed_inches" in doorway["full"] - doorway["standard"]
+
+
+def test_schema_is_gemini_flavoured():
+    schema = response_schema("fast")
+
+    assert schema["type"] == "OBJECT"
+    assert schema["required"] == schema["propertyOrdering"] == list(schema["properties"])
+    room_state = properties(schema)["room_state"]
+    assert room_state == {"type": "STRING", "enum": ["empty", "partially_furnished", "furnished"]}
+    assert "level" not in properties(schema)
+
+
+def test_payload_carries_the_level_schema():
+    part = {"inlineData": {"mimeType": "image/jpeg", "data": "..."}}
+
+    payload = payload_builder("standard")(part)
+
+    assert payload["contents"][0]["parts"][0] is part
+    config = payload["generationConfig"]
+    assert config["responseMimeType"] == "application/json"
+    assert config["responseSchema"] == response_schema("standard")
+
+
+def test_parse_coerces_what_it_can_and_drops_the_rest():
+    analysis = parse({
+        "detected_room_type": "bedroom",
+        "confidence": "0.8",
+        "room_dimensions": {"width": {"estimate_feet": "12"}, "length": "long", "ceiling_height": None},
+        "doorways": [{"location": "left", "width_inches": 32.0}, "a door", {"width_inches": True}],
+        "windows": {"location": "north"},
+        "architectural_features": {"ceiling_height_inches": "about nine feet", "wall_color": 7},
+    }, level="fast")
+
+    assert analysis.level == "fast"
+    assert analysis.confidence == 0.8
+    assert analysis.room_dimensions.width.estimate_feet == 12
+    assert analysis.room_dimensions.length is None
+    assert [d.width_inches for d in analysis.doorways] == [32, None]
+    assert analysis.windows == []
+    assert analysis.architectural_features.ceiling_height_inches is None
+    assert analysis.architectural_features.wall_color == "7"
+    assert analysis.staging_recommendations is None
+
+
+def test_to_dict_round_trips_without_empty_fields():
+    data = {"detected_room_type": "office", "doorways": [{"location": "right", "width_inches": 30}]}
+
+    assert to_dict(parse(data)) == data
+
+
+@pytest.mark.parametrize("data", [None, [], "room", 3])
+def test_parse_rejects_non_objects(data):
+    with pytest.raises(AnalysisInvalid):
+        parse(data)
+
+
+@pytest.mark.parametrize("value,expected", [
+    ("fast", "fast"), ("FULL", "full"), ("true", "standard"), ("True", "standard"),
+    ("false", None), ("", None), ("medium", None),
+])
+def test_parse_level(value, expected):
+    assert parse_level(value, "standard") == expected
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = AnalysisCache(str(tmp_path))
+    monkeypatch.setattr(main, "analysis_cache", cache)
+    return cache
+
+
+def test_a_more_detailed_cached_analysis_serves_a_cheaper_level(cache):
+    cache.set(main.scene_analysis_key("f" * 64, "full"), {"detected_room_type": "kitchen"})
+
+    analysis = main.cached_scene_analysis("f" * 64, "fast")
+
+    assert (analysis.detected_room_type, analysis.level) == ("kitchen", "full")
+    assert main.cached_scene_analysis("f" * 64, "full") is not None
+
+
+def test_a_cheaper_cached_analysis_does_not_serve_a_detailed_level(cache):
+    cache.set(main.scene_analysis_key("a" * 64, "fast"), {"detected_room_type": "kitchen"})
+
+    assert main.cached_scene_analysis("a" * 64, "full") is None
+
+
+def test_one_lookup_counts_once_whichever_level_answers(cache):
+    main.cached_scene_analysis("b" * 64, "fast")
+    cache.set(main.scene_analysis_key("b" * 64, "full"), {"detected_room_type": "office"})
+    main.cached_scene_analysis("b" * 64, "fast")
+
+    stats = cache.stats()
+    assert (stats["misses"], stats["memory_hits"], stats["hit_rate"]) == (1, 1, 0.5)
@@ -0,0 +1,209 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import deadlines
+import scheduler
+from scheduler import AdmissionScheduler, SchedulerBusy
+
+
+class Holder:
+    """Holds one slot in a background thread until released"""
+
+    def __init__(self, sched, tenant="holder", request_class="interactive"):
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(sched, tenant, request_class), daemon=True)
+        self.thread.start()
+        assert self.entered.wait(2)
+
+    def _run(self, sched, tenant, request_class):
+        with scheduler.bind(tenant, request_class), sched.slot():
+            self.entered.set()
+            self.release.wait(5)
+
+    def done(self):
+        self.release.set()
+        self.thread.join(2)
+
+
+def queued(sched, request_class):
+    return sched.stats()["classes"][request_class]["queued"]
+
+
+def enqueue_in_order(sched, requests, order):
+    """Queue (tenant, class) requests one at a time; each appends its tenant to `order` once admitted"""
+    threads = []
+    for tenant, request_class in requests:
+        before = queued(sched, request_class)
+
+        def run(tenant=tenant, request_class=request_class):
+            with scheduler.bind(tenant, request_class), sched.slot():
+                order.append(tenant)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        threads.append(thread)
+        deadline = time.monotonic() + 2
+        while queued(sched, request_class) == before and time.monotonic() < deadline:
+            time.sleep(0.001)
+    return threads
+
+
+def test_interactive_goes_before_batch():
+    sched = AdmissionScheduler(slots=1, reserved=0)
+    holder = Holder(sched)
+    order = []
+    threads = enqueue_in_order(sched, [("a", "batch"), ("b", "batch"), ("c", "interactive")], order)
+
+    holder.done()
+    for thread in threads:
+        thread.join(2)
+
+    assert order == ["c", "a", "b"]
+
+
+def test_batch_never_takes_the_reserved_slots():
+    sched = AdmissionScheduler(slots=2, reserved=1, max_wait={"batch": 0.05})
+    batch = Holder(sched, "lister", "batch")
+    with scheduler.bind("other-lister", "batch"), pytest.raises(SchedulerBusy):
+        with sched.slot():
+            pass
+
+    # The reserved slot is still free for an interactive request
+    with scheduler.bind("agent", "interactive"), sched.slot():
+        assert sched.stats()["classes"]["interactive"]["running"] == 1
+    batch.done()
+
+
+def test_weighted_fair_queuing_between_tenants():
+    sched = AdmissionScheduler(slots=1, reserved=0, tenants={"heavy": {"weight": 2}})
+    holder = Holder(sched)
+    order = []
+    requests = [("heavy", "interactive")] * 4 + [("light", "interactive")] * 2
+    threads = enqueue_in_order(sched, requests, order)
+
+    holder.done()
+    for thread in threads:
+        thread.join(2)
+
+    # Twice the weight, twice the slots while both tenants have work queued
+    assert order == ["heavy", "heavy", "light", "heavy", "heavy", "light"]
+
+
+def test_a_tenant_backlog_does_not_delay_other_tenants():
+    sched = AdmissionScheduler(slots=1, reserved=0)
+    holder = Holder(sched)
+    order = []
+    threads = enqueue_in_order(sched, [("busy", "interactive")] * 3 + [("other", "interactive")], order)
+
+    holder.done()
+    for thread in threads:
+        thread.join(2)
+
+    assert order.index("other") == 1
+
+
+def test_tenant_concurrency_cap():
+    sched = AdmissionScheduler(slots=4, reserved=0, tenant_max_concurrency=1, max_wait={"interactive": 0.05})
+    holder = Holder(sched, "capped")
+
+    with scheduler.bind("capped", "interactive"), pytest.raises(SchedulerBusy):
+        with sched.slot():
+            pass
+    with scheduler.bind("someone-else", "interactive"), sched.slot():
+        pass
+    holder.done()
+
+
+def test_refusal_after_max_wait_carries_retry_after():
+    sched = AdmissionScheduler(slots=1, reserved=0, max_wait={"interactive": 0.05})
+    holder = Holder(sched)
+
+    started = time.monotonic()
+    with pytest.raises(SchedulerBusy) as refused:
+        with sched.slot():
+            pass
+
+    assert time.monotonic() - started < 1
+    assert refused.value.status_code == 503
+    assert refused.value.retry_after >= 1
+    stats = sched.stats()["classes"]["interactive"]
+    assert stats["rejected"] == 1
+    assert stats["queued"] == 0
+    holder.done()
+
+
+def test_wait_is_bounded_by_the_request_deadline():
+    sched = AdmissionScheduler(slots=1, reserved=0, max_wait={"interactive": 30})
+    holder = Holder(sched)
+
+    started = time.monotonic()
+    with deadlines.deadline_scope(0.1), pytest.raises(deadlines.DeadlineExceeded):
+        with sched.slot():
+            pass
+
+    assert time.monotonic() - started < 1
+    holder.done()
+
+
+def test_slot_is_released_when_the_block_raises():
+    sched = AdmissionScheduler(slots=1, reserved=0)
+    with pytest.raises(RuntimeError):
+        with sched.slot():
+            raise RuntimeError("generation failed")
+
+    assert sched.stats()["classes"]["interactive"]["running"] == 0
+    with sched.slot():
+        pass
+
+
+def test_async_slot_and_cancellation():
+    sched = AdmissionScheduler(slots=1, reserved=0)
+
+    async def wait_for_slot():
+        async with sched.aslot():
+            pass
+
+    async def run():
+        async with sched.aslot():
+            waiter = asyncio.ensure_future(wait_for_slot())
+            await asyncio.sleep(0.05)
+            assert queued(sched, "interactive") == 1
+            waiter.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiter
+        async with sched.aslot():
+            return sched.stats()
+
+    stats = asyncio.run(run())
+    assert stats["classes"]["interactive"]["queued"] == 0
+    assert stats["classes"]["interactive"]["running"] == 1
+
+
+def test_idle_tenants_are_forgotten_without_losing_a_new_one():
+    sched = AdmissionScheduler(slots=1, reserved=0, max_wait={"interactive": 1})
+    sched.MAX_IDLE_TENANTS = 50
+    for n in range(sched.MAX_IDLE_TENANTS):
+        with scheduler.bind(f"addr:10.0.0.{n}", "interactive"), sched.slot():
+            pass
+    holder = Holder(sched, "busy")
+    order = []
+
+    # Past the limit: the newcomer must still be queued where dispatch sees it
+    threads = enqueue_in_order(sched, [("new", "interactive")], order)
+    holder.done()
+    threads[0].join(2)
+
+    assert order == ["new"]
+    assert len(sched._tenants) <= sched.MAX_IDLE_TENANTS
+
+
+def test_tenant_id_prefers_header_then_key_then_address():
+    assert scheduler.tenant_id({"X-Tenant-ID": " brokerage "}, "10.0.0.1") == "brokerage"
+    keyed = scheduler.tenant_id({"Authorization": "Bearer secret"}, "10.0.0.1")
+    assert keyed.startswith("key:") and "secret" not in keyed
+    assert keyed == scheduler.tenant_id({"X-API-Key": "secret"}, "10.0.0.2")
+    assert scheduler.tenant_id({}, "10.0.0.1") == "addr:10.0.0.1"
@@ -0,0 +1,64 @@
+import io
+
+import httpx
+import pytest
+
+import main
+from conftest import room_photo
+from uploads import UploadStore
+
+
+@pytest.fixture
+def client():
+    return main.app.test_client()
+
+
+def upload(client, data):
+    return client.post("/uploads", data={"image": (io.BytesIO(data), "room.jpg")})
+
+
+def generate(client, **fields):
+    return client.post("/generate-image", data={"enable_analysis": "false", **fields})
+
+
+def test_upload_once_then_generate_by_id(stub, client):
+    created = upload(client, room_photo(seed=21))
+
+    assert created.status_code == 201
+    upload_id = created.json["upload_id"]
+    assert created.json["input_dimensions"]["width"] == 320
+    # The same photo again is the same upload
+    assert upload(client, room_photo(seed=21)).json["upload_id"] == upload_id
+
+    response = generate(client, upload_id=upload_id)
+    assert response.status_code == 200
+    assert response.json["image_url"].startswith("/artifacts/")
+
+
+def test_unknown_upload_id_has_its_own_error_code(client):
+    response = generate(client, upload_id="0" * 64)
+
+    assert response.status_code == 404
+    assert response.json["code"] == "upload_expired"
+
+
+def test_other_404s_are_not_reported_as_an_expired_upload(stub, client, monkeypatch):
+    upload_id = upload(client, room_photo(seed=22)).json["upload_id"]
+    not_found = httpx.Response(404, json={"error": {"message": "model not found"}})
+    monkeypatch.setattr(main.gemini_files, "generate", lambda *args, **kwargs: not_found)
+
+    response = generate(client, upload_id=upload_id)
+
+    assert response.status_code == 404
+    assert "code" not in response.json
+
+
+def test_expired_and_malformed_ids_are_misses(tmp_path):
+    store = UploadStore(str(tmp_path), ttl_seconds=0)
+    image = main.ingest_image(io.BytesIO(room_photo(seed=23)))
+
+    upload_id = store.put(image)
+
+    assert store.get(upload_id) is None
+    assert store.get("../../etc/passwd") is None
+    assert store.stats()["misses"] == 2
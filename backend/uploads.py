@@ -0,0 +1,159 @@
+"""Content-addressed store for normalized uploads (POST /uploads).
+
+A photo is ingested once and kept under the SHA-256 of its normalized JPEG,
+which doubles as its upload_id and as the analysis cache's image digest.
+Later requests pass the id instead of re-sending the file. Entries live on
+disk so every worker on the host can resolve them; reading one refreshes
+its mtime, so the TTL and the oldest-first byte-budget trim together behave
+as an LRU.
+"""
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from analysis_cache import image_digest
+from ingest import IngestedImage, UploadError
+
+UPLOAD_ID = re.compile(r"^[0-9a-f]{64}$")
+
+
+class UnknownUpload(UploadError):
+    """An upload_id the store doesn't have (never issued, or expired).
+
+    Answered with `code` so clients can tell it from any other 404 and send
+    the photo again, which is safe: nothing was generated.
+    """
+    code = "upload_expired"
+
+    def __init__(self):
+        super().__init__("Unknown or expired upload_id (upload the image again)", 404)
+
+
+class UploadStore:
+    # Trimming walks the whole directory, so don't do it on every write
+    TRIM_INTERVAL_SECONDS = 60
+
+    def __init__(self, directory, ttl_seconds=24 * 3600, max_disk_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_bytes = max_disk_bytes
+
+        self._lock = threading.Lock()
+        self._last_trim = 0.0
+        self._counters = {"stored": 0, "reused": 0, "hits": 0, "misses": 0, "evictions": 0}
+
+    def put(self, image):
+        """Store an IngestedImage (idempotently) and return its upload id"""
+        upload_id = image_digest(image.data)
+        blob_path = self._blob_path(upload_id)
+        if os.path.exists(blob_path):
+            self._touch(upload_id)
+            self._count("reused")
+            return upload_id
+
+        meta = {k: v for k, v in vars(image).items() if k != "data"}
+        # Metadata first: an upload is only visible once its blob exists
+        self._atomic_write(self._meta_path(upload_id), json.dumps(meta).encode("utf-8"))
+        self._atomic_write(blob_path, image.data)
+        self._count("stored")
+
+        now = time.time()
+        if now - self._last_trim > self.TRIM_INTERVAL_SECONDS:
+            self._last_trim = now
+            self.trim()
+        return upload_id
+
+    def get(self, upload_id):
+        """The IngestedImage for an upload id, or None if unknown or expired"""
+        if not UPLOAD_ID.match(upload_id or ""):
+            self._count("misses")
+            return None
+        blob_path = self._blob_path(upload_id)
+        try:
+            if os.path.getmtime(blob_path) + self.ttl_seconds <= time.time():
+                self._remove(upload_id)
+                self._count("misses")
+                return None
+            with open(self._meta_path(upload_id), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            with open(blob_path, "rb") as f:
+                data = f.read()
+        except (FileNotFoundError, ValueError, OSError):
+            self._count("misses")
+            return None
+        self._touch(upload_id)
+        self._count("hits")
+        return IngestedImage(data=data, **meta)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def trim(self):
+        """Drop expired uploads, then the least recently used until under the byte budget."""
+        now = time.time()
+        entries = []
+        total = 0
+        for upload_id in self._upload_ids():
+            try:
+                st = os.stat(self._blob_path(upload_id))
+            except FileNotFoundError:
+                continue
+            if st.st_mtime + self.ttl_seconds <= now:
+                self._remove(upload_id)
+                continue
+            entries.append((st.st_mtime, st.st_size, upload_id))
+            total += st.st_size
+
+        entries.sort()
+        for _, size, upload_id in entries:
+            if total <= self.max_disk_bytes:
+                break
+            self._remove(upload_id)
+            total -= size
+
+    def _upload_ids(self):
+        if not os.path.isdir(self.directory):
+            return
+        for shard in os.listdir(self.directory):
+            shard_dir = os.path.join(self.directory, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for name in os.listdir(shard_dir):
+                if UPLOAD_ID.match(name):
+                    yield name
+
+    def _touch(self, upload_id):
+        try:
+            os.utime(self._blob_path(upload_id))
+        except OSError:
+            pass
+
+    def _remove(self, upload_id):
+        # Blob first, so a half-removed upload is already invisible
+        for path in (self._blob_path(upload_id), self._meta_path(upload_id)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._count("evictions")
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _blob_path(self, upload_id):
+        return os.path.join(self.directory, upload_id[:2], upload_id)
+
+    def _meta_path(self, upload_id):
+        return self._blob_path(upload_id) + ".json"
+
+    def _atomic_write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)